@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import AI_ATTEMPTS, timed_stage
+from parse_cache import parse_cache, source_sha256
+
+logger = logging.getLogger(__name__)
+
+# AI and extraction config
+API_URL = os.getenv('AI_API_URL', 'https://openrouter.ai/api/v1/chat/completions')
+AI_MODEL = 'openai/gpt-3.5-turbo'
+# Special marker for AI exhaustion or error
+AI_ERROR = '__AI_ERROR__'
+# Files parsed by the AI at the same time, and pooled connections to the API
+AI_CONCURRENCY = int(os.getenv('AI_CONCURRENCY', '8'))
+# Seconds one HTTP attempt may take, and one whole upload's AI work
+AI_REQUEST_TIMEOUT_S = float(os.getenv('AI_REQUEST_TIMEOUT_S', '60'))
+AI_UPLOAD_DEADLINE_S = float(os.getenv('AI_UPLOAD_DEADLINE_S', '300'))
+# Retries after a 429, a 5xx or a connection error; waits double from AI_BACKOFF_S
+AI_MAX_RETRIES = int(os.getenv('AI_MAX_RETRIES', '4'))
+AI_BACKOFF_S = float(os.getenv('AI_BACKOFF_S', '1'))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    # One keep-alive session for all calls, with a connection per concurrent call
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, AI_CONCURRENCY))
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _retry_wait(attempt: int, response) -> float:
+    # Exponential backoff with jitter; a longer Retry-After from the server wins
+    wait = AI_BACKOFF_S * (2 ** attempt) * random.uniform(0.5, 1.0)
+    try:
+        return max(wait, float(response.headers.get('Retry-After', 0)))
+    except (AttributeError, TypeError, ValueError):
+        return wait
+
+
+def ask_ai(prompt: str, deadline: Optional[float] = None):
+    """Send one prompt to OpenRouter and return the JSON the model answered with, or AI_ERROR.
+
+    Rate limits, server errors and dropped connections are retried with
+    backoff. deadline is a time.monotonic() value no attempt or wait may
+    run past.
+    """
+    headers = {
+        # Read per call: the apps load .env after importing this module
+        'Authorization': f"Bearer {os.getenv('API_KEY')}",
+        'Content-Type': 'application/json',
+    }
+    data = {
+        "model": AI_MODEL,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ]
+    }
+    with timed_stage('ai_call') as sample:
+        sample['size'] = len(prompt)
+        return _post_with_retries(headers, data, deadline)
+
+
+def _post_with_retries(headers, data, deadline):
+    for attempt in range(AI_MAX_RETRIES + 1):
+        timeout = AI_REQUEST_TIMEOUT_S
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                AI_ATTEMPTS.inc(outcome='deadline')
+                logger.warning('AI call skipped: upload deadline reached')
+                return AI_ERROR
+        response = None
+        try:
+            response = get_session().post(API_URL, headers=headers, json=data, timeout=timeout)
+            retry = response.status_code in RETRY_STATUSES
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logger.warning('AI request failed: %s', e)
+            retry = True
+        AI_ATTEMPTS.inc(outcome='retry' if retry else 'answered')
+        if not retry:
+            break
+        wait = _retry_wait(attempt, response)
+        if attempt == AI_MAX_RETRIES or (deadline is not None and time.monotonic() + wait >= deadline):
+            logger.warning('AI request failed after %d attempts: %s', attempt + 1,
+                           getattr(response, 'status_code', None))
+            return AI_ERROR
+        time.sleep(wait)
+    try:
+        response.raise_for_status()
+        result = response.json()
+        content = result['choices'][0]['message']['content']
+        # Remove code block markers if present
+        if content.strip().startswith('```'):
+            content = content.strip().split('\n', 1)[1].rsplit('```', 1)[0]
+        return json.loads(content)
+    except Exception as e:
+        logger.warning('Failed to parse AI response: %s', e)
+        logger.debug('AI response: %s', getattr(response, 'text', None))
+        return AI_ERROR
+
+
+def ai_map(fn: Callable, items: List, default=AI_ERROR, deadline_s: float = AI_UPLOAD_DEADLINE_S) -> List:
+    """Run fn(item, deadline) for all items on up to AI_CONCURRENCY threads; results keep item order.
+
+    All calls share one deadline, deadline_s from now. Items that raise, or
+    have not started by then, get default.
+    """
+    deadline = time.monotonic() + deadline_s
+
+    def run(item):
+        if time.monotonic() >= deadline:
+            return default
+        try:
+            return fn(item, deadline)
+        except Exception as e:
+            logger.warning('AI call failed: %s', e)
+            return default
+
+    if len(items) <= 1:
+        return [run(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(AI_CONCURRENCY, len(items))) as executor:
+        return list(executor.map(run, items))
+
+
+def _cached_ask(kind: str, text: str, prompt: str, deadline: Optional[float], valid: Callable):
+    # Answers are cached by the text sent and the model, so the same block never costs twice
+    digest = source_sha256(text.encode('utf-8'))
+    cache_kind = f"{kind}-{AI_MODEL.replace('/', '_')}"
+    answer = parse_cache.get(digest, cache_kind)
+    if answer is None:
+        answer = ask_ai(prompt, deadline)
+        if valid(answer):
+            parse_cache.put(digest, cache_kind, answer)
+    return answer
+
+
+def parse_block_with_ai(block, deadline: Optional[float] = None):
+#     prompt = f"""
+# Extract all data rows (ignore any table headers or column names) from the following text block (between 'Ab- und Zusetzungen' and 'Summe Ab- und Zusetzungen').
+# For each row, extract:
+# - Name (the first part of the main entry line, before the invoice numbers)
+# - Rechnungs-Nr. DZR (the invoice number, on the main entry line)
+# - Ihre Rechnungs-Nr. (your invoice number, on the main entry line)
+# - Betrag (the amount, on the main entry line)
+# - Rechnungsempfängers (the line(s) that come after the Betrag for each entry, until the next entry starts; join all such lines as one field. If there is no such line, leave this field blank.)
+
+# Return the result as a JSON array, where each element is an object with these keys: Name, Rechnungsempfängers, Rechnungs-Nr. DZR, Ihre Rechnungs-Nr., Betrag. Do not include any header or column name rows in the output.
+
+# Important:
+# If, for any entry, one or more of the five required fields (Name, Rechnungsempfängers, Rechnungs-Nr. DZR, Ihre Rechnungs-Nr., Betrag) is missing or empty, do not return any data. Instead, return only this JSON:
+# {{
+#   "error": "This file could not be processed automatically. Please handle it manually."
+# }}
+
+# Example input block:
+# Lisa Anne Sibbing 297426/12/2023 130 (GOZ) -123,64
+# Telefonisch: Direktzahlung vom 19.02.2024
+# Emine Sarihan 506432/03/2024 459 (EA) -179,26
+# Telefonat - Hakam El Daghma - Absetzung auf Wunsch der Praxis
+
+# Example output:
+# [
+#   {{
+#     "Name": "Lisa Anne Sibbing",
+#     "Rechnungsempfängers": "Telefonisch: Direktzahlung vom 19.02.2024",
+#     "Rechnungs-Nr. DZR": "297426/12/2023",
+#     "Ihre Rechnungs-Nr.": "130 (GOZ)",
+#     "Betrag": "-123,64"
+#   }},
+#   {{
+#     "Name": "Emine Sarihan",
+#     "Rechnungsempfängers": "Telefonat - Hakam El Daghma - Absetzung auf Wunsch der Praxis",
+#     "Rechnungs-Nr. DZR": "506432/03/2024",
+#     "Ihre Rechnungs-Nr.": "459 (EA)",
+#     "Betrag": "-179,26"
+#   }},
+# ]
+
+# Text block:
+# {block}
+# """
+
+
+
+    prompt = f"""
+# Extract all data rows (ignore any table headers or column names) from the following text block (between 'Ab- und Zusetzungen' and 'Summe Ab- und Zusetzungen').
+
+Each row must explicitly have these fields:
+1. Name: Text at the start of the line before the first invoice number.
+2. Rechnungs-Nr. DZR: Invoice number in the exact format 'XXXXXX/XX/XXXX'.
+3. Ihre Rechnungs-Nr.: Invoice identifier (e.g. '1029 (GOZ)'). 
+4. Betrag: Numeric amount at the end of the line (e.g. '-61,14').
+5. Rechnungsempfängers: Any lines following the main line until the next main entry.
+
+Critical instructions to detect missing fields clearly:
+- A valid main line always has at least three clear elements in sequence after the Name: "Rechnungs-Nr. DZR", "Ihre Rechnungs-Nr.", "Betrag".
+- "Rechnungs-Nr. DZR" is ALWAYS a number in the explicit format "XXXXXX/XX/XXXX".
+- "Betrag" is ALWAYS numeric (positive or negative) and at the very end of the main line.
+- "Ihre Rechnungs-Nr." should appear BETWEEN the "Rechnungs-Nr. DZR" and "Betrag". If there is NO clear separate field between "Rechnungs-Nr. DZR" and "Betrag", this explicitly means "Ihre Rechnungs-Nr." is missing.
+Important clarifications:
+- If a field is explicitly represented as empty parentheses "()", explicitly set the field as "" (empty string).
+- If a field is entirely missing or unclear (not explicitly represented), do NOT guess the field; instead, STOP extraction immediately and return only this JSON:{{
+  "error": "This file could not be processed automatically. Please handle it manually."
+}}
+
+Examples to illustrate this clearly:
+
+Example Input:
+Thomas Müller 341342/02/2024 -44,55
+Extra notes line here
+
+Correct Output (because "Ihre Rechnungs-Nr." is clearly missing):
+{{
+  "error": "This file could not be processed automatically. Please handle it manually."
+}}
+
+Another Example Input:
+Emine Sarihan 506432/03/2024 () -179,26
+Extra notes here
+
+Correct Output (because parentheses explicitly show "Ihre Rechnungs-Nr." is empty but clearly indicated):
+[
+  {{
+    "Name": "Emine Sarihan",
+    "Rechnungsempfängers": "Extra notes here",
+    "Rechnungs-Nr. DZR": "506432/03/2024",
+    "Ihre Rechnungs-Nr.": "",
+    "Betrag": "-179,26"
+  }}
+]
+
+Text block to extract:
+{block}
+"""
+
+    return _cached_ask('ai', block, prompt, deadline, lambda answer: isinstance(answer, list))
+
+
+def parse_fragments_with_ai(fragments, deadline: Optional[float] = None, context=None):
+    """Ask the AI to parse only the lines the regex parser could not.
+
+    fragments is a list of line lists. context, if given, holds a (line
+    before, line after) pair per fragment: the neighbouring lines the regex
+    parser did read, sent along so the model can place the fragment ('' for
+    none). Returns {fragment number: [entries]} (numbers start at 1) or
+    AI_ERROR.
+    """
+    context = context or [('', '')] * len(fragments)
+    numbered = "\n\n".join(
+        f"Fragment {number}:\n" + "\n".join(
+            ([f"Context: {before}"] if before else []) + list(lines) + ([f"Context: {after}"] if after else []))
+        for number, (lines, (before, after)) in enumerate(zip(fragments, context), start=1)
+    )
+    prompt = f"""
+The following fragments come from the 'Ab- und Zusetzungen' table of a German dental billing statement.
+Our parser could not read them. Each fragment holds one or more table entries.
+
+A main line is: Name, then Rechnungs-Nr. DZR (format 'XXXXXX/XX/XXXX'), then Ihre Rechnungs-Nr. (e.g. '1029 (GOZ)'),
+then Betrag at the very end (e.g. '-61,14'). The lines after a main line, until the next main line, are its
+Rechnungsempfängers; join them with a single space. Ignore table headers and column names.
+
+Lines starting with 'Context:' are the table lines just before and after a fragment. They were already read;
+they only show where the fragment sits. Never return an entry for a Context line.
+
+Do NOT guess. If a field is missing or unclear, leave the whole entry out.
+
+Return only JSON: an object whose keys are the fragment numbers and whose values are arrays of entries with the keys
+Name, Rechnungsempfängers, Rechnungs-Nr. DZR, Ihre Rechnungs-Nr., Betrag. Use an empty array for a fragment without
+readable entries. Example: {{"1": [{{"Name": "Emine Sarihan", "Rechnungsempfängers": "Telefonat", "Rechnungs-Nr. DZR": "506432/03/2024", "Ihre Rechnungs-Nr.": "459 (EA)", "Betrag": "-179,26"}}], "2": []}}
+
+{numbered}
+"""
+    parsed = _cached_ask('ai-lines', numbered, prompt, deadline, lambda answer: isinstance(answer, dict))
+    if not isinstance(parsed, dict):
+        return AI_ERROR
+    result = {}
+    for key, entries in parsed.items():
+        try:
+            number = int(key)
+        except (TypeError, ValueError):
+            continue
+        if 1 <= number <= len(fragments) and isinstance(entries, list):
+            result[number] = entries
+    return result
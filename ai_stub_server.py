@@ -0,0 +1,108 @@
+"""A local stand-in for the OpenRouter chat completions API.
+
+    python ai_stub_server.py [--port 8765] [--latency 0.5] [--fail-every 0]
+
+Run the backend with AI_API_URL=http://127.0.0.1:8765/api/v1/chat/completions
+to exercise the AI path without an API key or network. Full-block prompts are
+answered with the regex parser's rows for the block, fragment prompts (hybrid
+mode) with no entries. Every request sleeps --latency seconds; with
+--fail-every n, every n-th request gets a 429 first.
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from extract_entries_from_ab_block import parse_entries
+
+BLOCK_MARKER = 'Text block to extract:\n'
+FRAGMENT_PATTERN = re.compile(r'^Fragment (\d+):$', re.MULTILINE)
+
+
+def answer_for(prompt: str):
+    # What a well-behaved model would return for one of ai_parser's prompts
+    if BLOCK_MARKER in prompt:
+        rows, _ = parse_entries(prompt.split(BLOCK_MARKER, 1)[1])
+        return rows
+    return {number: [] for number in FRAGMENT_PATTERN.findall(prompt)}
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, fail_every=0):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def handle_error(self, request, client_address):
+        # Clients that gave up (timeouts, deadlines) are expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/api/v1/chat/completions"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=()):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        server = self.server
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with server.lock:
+            server.requests += 1
+            number = server.requests
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            if server.fail_every and number % server.fail_every == 0:
+                self._send(429, {'error': {'message': 'Rate limit exceeded'}}, [('Retry-After', '0')])
+                return
+            prompt = data['messages'][-1]['content']
+            content = json.dumps(answer_for(prompt), ensure_ascii=False)
+            self._send(200, {'choices': [{'message': {'role': 'assistant', 'content': content}}]})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+def start_stub_server(latency=0.0, fail_every=0, port=0) -> StubServer:
+    # Serve on a background thread; call .shutdown() when done
+    server = StubServer(('127.0.0.1', port), latency, fail_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve fake OpenRouter chat completions locally.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per request')
+    parser.add_argument('--fail-every', type=int, default=0, help='answer every n-th request with 429')
+    args = parser.parse_args()
+    stub = StubServer(('127.0.0.1', args.port), args.latency, args.fail_every)
+    print(f"AI stub listening on {stub.url}")
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,20 +1,24 @@
 import os
-import tempfile
-from flask import Flask, request, jsonify
+import logging
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
-import pdfplumber
-import requests
-import pandas as pd
-import re
-import firebase_admin
-from firebase_admin import credentials, firestore
 from dotenv import load_dotenv
-import json
 
+from ai_parser import AI_ERROR, ai_map, parse_block_with_ai
+from dedup_index import dedup_key
+from hybrid_parser import hybrid_parse, needs_ai
+from metrics import configure_logging, count_upload, render as render_metrics
+from ingest import MAX_UPLOAD_BYTES, normalized_rows, read_uploads, remove_files
+from parse_pool import parse_files
+import profiling
+from rows_query import query_fields
+from storage import open_storage
 # AI and extraction config
 load_dotenv()
-API_KEY = os.getenv('API_KEY')
-API_URL = 'https://openrouter.ai/api/v1/chat/completions'
+configure_logging()
+logger = logging.getLogger(__name__)
+# 'full' sends every block to the AI; 'hybrid' parses with the regex parser and only sends the lines it skipped
+AI_PARSE_MODE = os.getenv('AI_PARSE_MODE', 'full')
 CSV_COLUMNS = [
     'Name',
     'Rechnungsempfängers',
@@ -30,211 +34,81 @@ CSV_COLUMNS = [
 ]
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 CORS(app)
-
-# Initialize Firebase Admin
-print("FIREBASE_SERVICE_ACCOUNT:", os.getenv('FIREBASE_SERVICE_ACCOUNT'))
-cred = credentials.Certificate('/etc/secrets/d3z-pdf-firebase-adminsdk-fbsvc-613ac76010.json')
-#cred = credentials.Certificate('d3z-pdf-firebase-adminsdk-fbsvc-613ac76010.json')
-firebase_admin.initialize_app(cred)
-db = firestore.client()
-
-def normalize_nr(nr):
-    return nr.replace(" ", "").lower() if nr else ""
-
-def extract_relevant_block(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        text = ''
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + '\n'
-    # Extract block between the two markers
-    start = text.find('Ab- und Zusetzungen')
-    end = text.find('Summe Ab- und Zusetzungen')
-    if start == -1 or end == -1 or end <= start:
-        return None
-    block = text[start:end]
-    return block.strip()
-
-def parse_block_with_ai(block):
-#     prompt = f"""
-# Extract all data rows (ignore any table headers or column names) from the following text block (between 'Ab- und Zusetzungen' and 'Summe Ab- und Zusetzungen').
-# For each row, extract:
-# - Name (the first part of the main entry line, before the invoice numbers)
-# - Rechnungs-Nr. DZR (the invoice number, on the main entry line)
-# - Ihre Rechnungs-Nr. (your invoice number, on the main entry line)
-# - Betrag (the amount, on the main entry line)
-# - Rechnungsempfängers (the line(s) that come after the Betrag for each entry, until the next entry starts; join all such lines as one field. If there is no such line, leave this field blank.)
-
-# Return the result as a JSON array, where each element is an object with these keys: Name, Rechnungsempfängers, Rechnungs-Nr. DZR, Ihre Rechnungs-Nr., Betrag. Do not include any header or column name rows in the output.
-
-# Important:
-# If, for any entry, one or more of the five required fields (Name, Rechnungsempfängers, Rechnungs-Nr. DZR, Ihre Rechnungs-Nr., Betrag) is missing or empty, do not return any data. Instead, return only this JSON:
-# {{
-#   "error": "This file could not be processed automatically. Please handle it manually."
-# }}
-
-# Example input block:
-# Lisa Anne Sibbing 297426/12/2023 130 (GOZ) -123,64
-# Telefonisch: Direktzahlung vom 19.02.2024
-# Emine Sarihan 506432/03/2024 459 (EA) -179,26
-# Telefonat - Hakam El Daghma - Absetzung auf Wunsch der Praxis
-
-# Example output:
-# [
-#   {{
-#     "Name": "Lisa Anne Sibbing",
-#     "Rechnungsempfängers": "Telefonisch: Direktzahlung vom 19.02.2024",
-#     "Rechnungs-Nr. DZR": "297426/12/2023",
-#     "Ihre Rechnungs-Nr.": "130 (GOZ)",
-#     "Betrag": "-123,64"
-#   }},
-#   {{
-#     "Name": "Emine Sarihan",
-#     "Rechnungsempfängers": "Telefonat - Hakam El Daghma - Absetzung auf Wunsch der Praxis",
-#     "Rechnungs-Nr. DZR": "506432/03/2024",
-#     "Ihre Rechnungs-Nr.": "459 (EA)",
-#     "Betrag": "-179,26"
-#   }},
-# ]
-
-# Text block:
-# {block}
-# """
-
-
-
-    prompt = f"""
-# Extract all data rows (ignore any table headers or column names) from the following text block (between 'Ab- und Zusetzungen' and 'Summe Ab- und Zusetzungen').
-
-Each row must explicitly have these fields:
-1. Name: Text at the start of the line before the first invoice number.
-2. Rechnungs-Nr. DZR: Invoice number in the exact format 'XXXXXX/XX/XXXX'.
-3. Ihre Rechnungs-Nr.: Invoice identifier (e.g. '1029 (GOZ)'). 
-4. Betrag: Numeric amount at the end of the line (e.g. '-61,14').
-5. Rechnungsempfängers: Any lines following the main line until the next main entry.
-
-Critical instructions to detect missing fields clearly:
-- A valid main line always has at least three clear elements in sequence after the Name: "Rechnungs-Nr. DZR", "Ihre Rechnungs-Nr.", "Betrag".
-- "Rechnungs-Nr. DZR" is ALWAYS a number in the explicit format "XXXXXX/XX/XXXX".
-- "Betrag" is ALWAYS numeric (positive or negative) and at the very end of the main line.
-- "Ihre Rechnungs-Nr." should appear BETWEEN the "Rechnungs-Nr. DZR" and "Betrag". If there is NO clear separate field between "Rechnungs-Nr. DZR" and "Betrag", this explicitly means "Ihre Rechnungs-Nr." is missing.
-Important clarifications:
-- If a field is explicitly represented as empty parentheses "()", explicitly set the field as "" (empty string).
-- If a field is entirely missing or unclear (not explicitly represented), do NOT guess the field; instead, STOP extraction immediately and return only this JSON:{{
-  "error": "This file could not be processed automatically. Please handle it manually."
-}}
-
-Examples to illustrate this clearly:
-
-Example Input:
-Thomas Müller 341342/02/2024 -44,55
-Extra notes line here
-
-Correct Output (because "Ihre Rechnungs-Nr." is clearly missing):
-{{
-  "error": "This file could not be processed automatically. Please handle it manually."
-}}
-
-Another Example Input:
-Emine Sarihan 506432/03/2024 () -179,26
-Extra notes here
-
-Correct Output (because parentheses explicitly show "Ihre Rechnungs-Nr." is empty but clearly indicated):
-[
-  {{
-    "Name": "Emine Sarihan",
-    "Rechnungsempfängers": "Extra notes here",
-    "Rechnungs-Nr. DZR": "506432/03/2024",
-    "Ihre Rechnungs-Nr.": "",
-    "Betrag": "-179,26"
-  }}
-]
-
-Text block to extract:
-{block}
-"""
-
-
-
-
-    headers = {
-        'Authorization': f'Bearer {API_KEY}',
-        'Content-Type': 'application/json',
-    }
-    data = {
-        "model": "openai/gpt-3.5-turbo",
-        "messages": [
-            {"role": "user", "content": prompt}
-        ]
-    }
-    response = requests.post(API_URL, headers=headers, json=data)
-    try:
-        response.raise_for_status()
-        result = response.json()
-        import json as pyjson
-        content = result['choices'][0]['message']['content']
-        # Remove code block markers if present
-        if content.strip().startswith('```'):
-            content = content.strip().split('\n', 1)[1].rsplit('```', 1)[0]
-        parsed = pyjson.loads(content)
-        return parsed
-    except Exception as e:
-        print('Failed to parse AI response:', e)
-        print('AI response:', getattr(response, 'text', None))
-        # Special marker for AI exhaustion or error
-        return '__AI_ERROR__'
-
-def extract_billing_date(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        first_page_text = pdf.pages[0].extract_text()
-    # Look for 'Abrechnungsdatum' followed by a date
-    match = re.search(r'Abrechnungsdatum\s+(\d{2}[.\/]\d{2}[.\/]\d{4})', first_page_text)
-    if match:
-        return match.group(1)
-    return ''
+profiling.init_app(app)
+
+# Initialize storage: Firestore unless STORAGE_BACKEND=sqlite
+logger.debug("FIREBASE_SERVICE_ACCOUNT: %s", os.getenv('FIREBASE_SERVICE_ACCOUNT'))
+storage = open_storage('/etc/secrets/d3z-pdf-firebase-adminsdk-fbsvc-613ac76010.json')
+#storage = open_storage('d3z-pdf-firebase-adminsdk-fbsvc-613ac76010.json')
+
+def ai_parse_file(parsed_file, deadline):
+    # (entries or AI_ERROR, unresolved lines) for one parsed file; files without a block skip the AI
+    block = parsed_file['block']
+    if not block:
+        return [], []
+    if AI_PARSE_MODE == 'hybrid':
+        if not needs_ai(parsed_file['skipped_lines']):
+            # Nothing skipped, or only separators and repeated page headers
+            return parsed_file['entries'], []
+        parsed_list, unresolved, failed = hybrid_parse(block, deadline)
+        return (AI_ERROR, []) if failed else (parsed_list, unresolved)
+    # Re-uploads of the same block reuse the earlier AI answer instead of paying again
+    return parse_block_with_ai(block, deadline), []
 
 @app.route('/api/upload', methods=['POST'])
 def upload_invoices():
     if 'files' not in request.files:
         return jsonify({'error': 'No files part in the request'}), 400
     files = request.files.getlist('files')
-    all_rows = []
+    pending_rows = []  # Committed in WriteBatch chunks once every file is parsed
+    upload_rows = []
+    parsed_filenames = {}
     invalid_files = []
     ai_error = False
-    # Gather all existing (Ihre Rechnungs-Nr., Betrag) pairs from Firestore (active and archived)
-    existing_nr_betrag = set()
-    docs = db.collection('invoices').stream()
-    for doc in docs:
-        doc_data = doc.to_dict()
-        doc_nr = normalize_nr(doc_data.get("Ihre Rechnungs-Nr."))
-        doc_betrag = doc_data.get("Betrag", "")
-        if doc_nr:
-            existing_nr_betrag.add((doc_nr, doc_betrag))
-    for file in files:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-            file.save(tmp.name)
-            block = extract_relevant_block(tmp.name)
-            billing_date = extract_billing_date(tmp.name)
-        os.unlink(tmp.name)
-        print(f"\n--- Debug: BLOCK SENT TO AI for {file.filename} ---\n{block}\n--- END BLOCK ---\n")
+    parsed_rows = 0
+    # Keys inserted by this request, so one upload cannot duplicate itself
+    seen_nr_betrag = set()
+    # Small files are parsed from memory; only large ones spill to a temp file
+    sources, spilled_paths = read_uploads(files)
+    try:
+        # PDF extraction runs in the process pool; the AI calls run on threads here
+        hybrid = AI_PARSE_MODE == 'hybrid'
+        parsed_files = parse_files(
+            [(source, file.filename) for source, file in zip(sources, files)],
+            raw_block=not hybrid, parse_entries=hybrid
+        )
+    finally:
+        remove_files(spilled_paths)
+    # All AI calls of this upload run side by side, under one deadline
+    answers = ai_map(ai_parse_file, parsed_files, default=(AI_ERROR, []))
+    for file, parsed_file, (parsed_list, unresolved) in zip(files, parsed_files, answers):
+        block = parsed_file['block']
+        billing_date = parsed_file['billing_date']
+        logger.debug("BLOCK SENT TO AI for %s:\n%s", file.filename, block)
         if not block:
             invalid_files.append({"filename": file.filename, "reason": "no_data"})
             continue
-        parsed_list = parse_block_with_ai(block)
-        print(f"\n--- Debug: AI RESPONSE for {file.filename} ---\n{parsed_list}\n--- END AI RESPONSE ---\n")
-        if parsed_list == '__AI_ERROR__':
+        logger.debug("AI RESPONSE for %s: %s", file.filename, parsed_list)
+        if parsed_list == AI_ERROR:
+            # Retries are used up or the deadline passed; the other files still go in
             ai_error = True
-            break
+            invalid_files.append({"filename": file.filename, "reason": "ai_error"})
+            continue
+        if unresolved:
+            # Lines neither parser could read: skip the whole file, as in full mode
+            logger.info("Unresolved lines in %s: %s", file.filename, [line['text'] for line in unresolved])
+            invalid_files.append({"filename": file.filename, "reason": "incomplete_entry"})
+            continue
         if (isinstance(parsed_list, dict) and parsed_list.get("error")) or (
             isinstance(parsed_list, list) and any(isinstance(entry, dict) and entry.get("error") for entry in parsed_list)
         ):
-            print(f"\n--- Debug: AI ERROR for {file.filename} ---\n")
+            logger.info("AI reported an error for %s", file.filename)
             invalid_files.append({"filename": file.filename, "reason": "incomplete_entry"})
             continue
         if not parsed_list or not isinstance(parsed_list, list) or len(parsed_list) == 0:
-            print(f"\n--- Debug: AI returned empty or invalid list for {file.filename} ---\n")
+            logger.info("AI returned empty or invalid list for %s", file.filename)
             invalid_files.append({"filename": file.filename, "reason": "no_data"})
             continue
         # DO NOT FORGET: If any entry is missing/empty, skip the whole file!
@@ -243,48 +117,85 @@ def upload_invoices():
             isinstance(entry, dict) and all(entry.get(field, '').strip() for field in required_fields)
             for entry in parsed_list
         ):
-            print(f"AI returned incomplete entry for {file.filename}")
+            logger.info("AI returned incomplete entry for %s", file.filename)
             invalid_files.append({"filename": file.filename, "reason": "incomplete_entry"})
             continue  # Skip this file, do not add any rows
+        file_rows = []
+        parsed_rows += len(parsed_list)
         for parsed in parsed_list:
             row = {col: parsed.get(col, '') for col in CSV_COLUMNS}
-            print(f"\n--- Debug: ROW TO BE ADDED for {file.filename} ---\n{row}\n--- END ROW ---\n")
+            logger.debug("ROW TO BE ADDED for %s: %s", file.filename, row)
             row['Billing Date'] = billing_date
             row['notes'] = ""
             row['starred'] = False
             row['assigned_to'] = ""
-            # Ensure Betrag is always negative
-            betrag = row.get("Betrag", "")
-            betrag_clean = betrag.replace('.', '').replace(',', '.').replace(' ', '')
-            try:
-                value = float(betrag_clean)
-                if value > 0:
-                    value = -value
-                # Format back to German style (e.g., -49,33)
-                row["Betrag"] = f"{value:,.2f}".replace('.', 'X').replace(',', '.').replace('X', ',')
-            except Exception:
-                pass  # If conversion fails, leave as is
-            nr = normalize_nr(row.get("Ihre Rechnungs-Nr."))
-            betrag = row.get("Betrag", "")
-            if not nr or (nr, betrag) in existing_nr_betrag:
-                continue  # Skip duplicate or empty
-            # Add to Firestore
-            doc_ref = db.collection('invoices').add(row)
-            row['id'] = doc_ref[1].id
-            all_rows.append(row)
-            existing_nr_betrag.add((nr, betrag))  # Prevent duplicates within this batch
-    if ai_error:
-        return jsonify({'ai_error': True}), 200
-    return jsonify({'data': all_rows, 'invalid_files': invalid_files})
+            row.update(query_fields(row))
+            file_rows.append(row)
+        profiling.note_file(parsed_file, rows=len(file_rows))
+        for row in file_rows:
+            parsed_filenames[id(row)] = file.filename
+        upload_rows.extend(file_rows)
+    # Betrag, invoice numbers and dates of the whole upload are normalized in one batch
+    upload_rows, invalid_rows = normalized_rows(upload_rows, parsed_filenames)
+    # Only look up the keys this upload is about to insert
+    existing_nr_betrag = storage.existing_keys(dedup_key(row) for row in upload_rows)
+    for row in upload_rows:
+        key = dedup_key(row)
+        if not key[0] or key in existing_nr_betrag or key in seen_nr_betrag:
+            continue  # Skip duplicate or empty
+        pending_rows.append(row)
+        seen_nr_betrag.add(key)  # Prevent duplicates within this batch
+    # Add to storage: one round trip per batch instead of one per row
+    all_rows, failed = storage.add_rows(pending_rows)
+    count_upload('backend', files=len(files), rows=parsed_rows, duplicates=len(upload_rows) - len(pending_rows),
+                 written=len(all_rows), failed=len(failed), invalid_files=invalid_files)
+    failed_rows = [{
+        'filename': parsed_filenames[id(f['row'])],
+        'Name': f['row'].get('Name', ''),
+        'Ihre Rechnungs-Nr.': f['row'].get('Ihre Rechnungs-Nr.', ''),
+        'error': f['error']
+    } for f in failed]
+    # ai_error: at least one file could not be parsed by the AI (listed with reason 'ai_error')
+    return jsonify({'data': all_rows, 'invalid_files': invalid_files, 'failed_rows': failed_rows,
+                    'invalid_rows': invalid_rows, 'ai_error': ai_error})
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f'Upload too large: the limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB per request'}), 413
+
+@app.route('/api/profiles', methods=['GET'])
+def list_request_profiles():
+    # Stored request profiles, newest first (needs X-Profile-Token)
+    if not profiling.is_admin():
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'profiles': profiling.list_profiles()})
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def download_request_profile(profile_id):
+    # The cProfile dump, for pstats / snakeviz
+    if not profiling.is_admin():
+        return jsonify({'error': 'Not found'}), 404
+    path = profiling.profile_path(profile_id)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{profile_id}.prof')
+
+@app.route('/api/summary', methods=['GET'])
+def get_summary():
+    # Totals kept up to date by every write; one document read
+    return jsonify(storage.summary())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/rows', methods=['GET'])
 def get_rows():
-    docs = db.collection('invoices').stream()
+    rows = (row for page in storage.iter_pages(by_billing_date=False, page_size=None) for row in page)
     active_rows = []
     archived_rows = []
-    for doc in docs:
-        row = doc.to_dict()
-        row['id'] = doc.id
+    for row in rows:
         if row.get('archived'):
             archived_rows.append(row)
         else:
@@ -295,41 +206,40 @@ def get_rows():
 def archive_row(row_id):
     data = request.json or {}
     archive_result = data.get('archive_result', '')
-    doc_ref = db.collection('invoices').document(row_id)
-    doc = doc_ref.get()
+    doc_data = storage.get(row_id)
     handled_by = ""
-    if doc.exists:
-        doc_data = doc.to_dict()
+    if doc_data is not None:
         handled_by = doc_data.get('assigned_to', '')
-    doc_ref.update({'archived': True, 'handled_by': handled_by, 'archive_result': archive_result})
+    storage.update(row_id, {'archived': True, 'handled_by': handled_by, 'archive_result': archive_result})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>', methods=['DELETE'])
 def delete_row(row_id):
-    db.collection('invoices').document(row_id).delete()
+    # Leaves a tombstone for /api/rows/changes and frees the dedup key
+    storage.delete(row_id)
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/unarchive', methods=['POST'])
 def unarchive_row(row_id):
-    db.collection('invoices').document(row_id).update({'archived': False})
+    storage.update(row_id, {'archived': False})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/notes', methods=['POST'])
 def update_notes(row_id):
     notes = request.json.get('notes', '')
-    db.collection('invoices').document(row_id).update({'notes': notes})
+    storage.update(row_id, {'notes': notes})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/starred', methods=['POST'])
 def update_starred(row_id):
     starred = request.json.get('starred', False)
-    db.collection('invoices').document(row_id).update({'starred': starred})
+    storage.update(row_id, {'starred': starred})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/assigned_to', methods=['POST'])
 def update_assigned_to(row_id):
     assigned_to = request.json.get('assigned_to', '')
-    db.collection('invoices').document(row_id).update({'assigned_to': assigned_to})
+    storage.update(row_id, {'assigned_to': assigned_to})
     return jsonify({'success': True})
 
 if __name__ == '__main__':
@@ -1,148 +1,161 @@
-import os
-import tempfile
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, send_file, stream_with_context
 from flask_cors import CORS
-import pdfplumber
-import re
-import firebase_admin
-from firebase_admin import credentials, firestore
 from dotenv import load_dotenv
 import json
 
 # --- Imports from your helpers ---
-from extract_ab_block_from_pdf import extract_relevant_block_from_pdf
-from extract_entries_from_ab_block import extract_ab_und_zusetzungen
+from bulk_ops import MAX_BULK_ITEMS
+from change_log import DEFAULT_CHANGES_LIMIT
+from export_rows import EXPORT_FORMATS, export_chunks, export_filename
+from ingest import CSV_COLUMNS, MAX_UPLOAD_BYTES, ingest_parsed_files, read_uploads, remove_files
+from ingest_jobs import IngestWorkers, JobStore
+from metrics import configure_logging, render as render_metrics
+from normalize import normalize_rows
+from parse_pool import iter_parse_files, parse_files
+import profiling
+from rows_cache import ROWS_CACHE_ENABLED, RowsCache
+from rows_query import MAX_IN_VALUES, parse_rows_args, query_fields
+from search_index import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT, MIN_QUERY_LENGTH, SearchIndex
+from storage import FirestoreStorage, StorageError, open_storage
 
 
 # --- Configuration ---
 load_dotenv()
-CSV_COLUMNS = [
-    'Name',
-    'Rechnungsempfängers',
-    'Rechnungs-Nr. DZR',
-    'Ihre Rechnungs-Nr.',
-    'Betrag',
-    'Billing Date',
-    'notes',
-    'starred',
-    'assigned_to',
-    'handled_by',
-    'archive_result'
-]
+configure_logging()
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 CORS(app)
+profiling.init_app(app)
 
-# --- Firebase Init ---
-#cred = credentials.Certificate('fire-base.json')
-cred = credentials.Certificate('/etc/secrets/fire-base.json')
-firebase_admin.initialize_app(cred)
-db = firestore.client()
-
-def normalize_nr(nr):
-    return nr.replace(" ", "").lower() if nr else ""
-
-def extract_billing_date(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        first_page_text = pdf.pages[0].extract_text()
-    # Look for 'Abrechnungsdatum' followed by a date
-    match = re.search(r'Abrechnungsdatum\s+(\d{2}[.\/]\d{2}[.\/]\d{4})', first_page_text)
-    if match:
-        return match.group(1)
-    return ''
+# --- Storage Init ---
+# Firestore by default; STORAGE_BACKEND=sqlite runs on a local file without credentials
+#storage = open_storage('fire-base.json')
+storage = open_storage('/etc/secrets/fire-base.json')
+ingest_workers = IngestWorkers(storage, JobStore())
+# The snapshot listener needs Firestore; SQLite answers /api/rows from its indexes
+rows_cache = RowsCache(storage.db) if ROWS_CACHE_ENABLED and isinstance(storage, FirestoreStorage) else None
+search_index = SearchIndex(storage)
+# Built in the background as soon as this worker serves its first request
+app.before_request(search_index.start)
 
 @app.route('/api/upload', methods=['POST'])
 def upload_invoices():
     if 'files' not in request.files:
         return jsonify({'error': 'No files part in the request'}), 400
     files = request.files.getlist('files')
-    all_rows = []
-    invalid_files = []
-    incomplete_entries_with_names = []  # <--- new
-    existing_nr_betrag = set()
-    docs = db.collection('invoices').stream()
-    for doc in docs:
-        doc_data = doc.to_dict()
-        doc_nr = normalize_nr(doc_data.get("Ihre Rechnungs-Nr."))
-        doc_betrag = doc_data.get("Betrag", "")
-        if doc_nr:
-            existing_nr_betrag.add((doc_nr, doc_betrag))
-    for file in files:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-            file.save(tmp.name)
-            block = extract_relevant_block_from_pdf(tmp.name)
-            billing_date = extract_billing_date(tmp.name)
-        os.unlink(tmp.name)
-        print(f"\n--- Debug: BLOCK EXTRACTED for {file.filename} ---\n{block}\n--- END BLOCK ---\n")
-        if not block:
-            invalid_files.append({"filename": file.filename, "reason": "no_data"})
-            continue
-        # Updated: get both parsed_list and skipped_any from the parser
-        parsed_list, skipped_any = extract_ab_und_zusetzungen(block)
-        print(f"\n--- Debug: REGEX RESPONSE for {file.filename} ---\n{parsed_list}\n--- END RESPONSE ---\n")
-        if not parsed_list or not isinstance(parsed_list, list) or len(parsed_list) == 0:
-            print(f"\n--- Debug: Regex returned empty or invalid list for {file.filename} ---\n")
-            invalid_files.append({"filename": file.filename, "reason": "no_data"})
-            continue
-        # If any required entry is missing/empty, skip file
-        required_fields = ["Name", "Rechnungsempfängers", "Rechnungs-Nr. DZR", "Ihre Rechnungs-Nr.", "Betrag"]
-        if not all(
-            isinstance(entry, dict) and all(entry.get(field, '').strip() for field in required_fields)
-            for entry in parsed_list
-        ):
-            print(f"Regex returned incomplete entry for {file.filename}")
-            invalid_files.append({"filename": file.filename, "reason": "incomplete_entry"})
-            continue
-        # If any lines were skipped, mark for manual review and provide added names
-        if skipped_any:
-            names_found = [row['Name'] for row in parsed_list]
-            incomplete_entries_with_names.append({
-                "filename": file.filename,
-                "added_names": names_found
-            })
-            invalid_files.append({"filename": file.filename, "reason": "incomplete_entry"})
-        for parsed in parsed_list:
-            row = {col: parsed.get(col, '') for col in CSV_COLUMNS}
-            print(f"\n--- Debug: ROW TO BE ADDED for {file.filename} ---\n{row}\n--- END ROW ---\n")
-            row['Billing Date'] = billing_date
-            row['notes'] = ""
-            row['starred'] = False
-            row['assigned_to'] = ""
-            # Ensure Betrag is always negative
-            betrag = row.get("Betrag", "")
-            betrag_clean = betrag.replace('.', '').replace(',', '.').replace(' ', '')
-            try:
-                value = float(betrag_clean)
-                if value > 0:
-                    value = -value
-                row["Betrag"] = f"{value:,.2f}".replace('.', 'X').replace(',', '.').replace('X', ',')
-            except Exception:
-                pass  # If conversion fails, leave as is
-            nr = normalize_nr(row.get("Ihre Rechnungs-Nr."))
-            betrag = row.get("Betrag", "")
-            if not nr or (nr, betrag) in existing_nr_betrag:
-                continue  # Skip duplicate or empty
-            doc_ref = db.collection('invoices').add(row)
-            row['id'] = doc_ref[1].id
-            all_rows.append(row)
-            existing_nr_betrag.add((nr, betrag))  # Prevent duplicates within this batch
+    # Small files are parsed from memory; only large ones spill to a temp file
+    sources, spilled_paths = read_uploads(files)
+    # Extraction and regex parsing run in the process pool; results keep upload order
+    pairs = [(source, file.filename) for source, file in zip(sources, files)]
+    if wants_stream():
+        return Response(stream_with_context(stream_upload(pairs, spilled_paths)), mimetype='application/x-ndjson')
+    try:
+        # Dedup and storage writes stay serialized in this process
+        *_, summary = ingest_parsed_files(storage, parse_files(pairs))
+    finally:
+        remove_files(spilled_paths)
+    search_index.note_rows(summary['data'])
     return jsonify({
-        'data': all_rows,
-        'invalid_files': invalid_files,
-        'incomplete_entries_with_names': incomplete_entries_with_names
+        'data': summary['data'],
+        'invalid_files': summary['invalid_files'],
+        'incomplete_entries_with_names': summary['incomplete_entries_with_names'],
+        'failed_rows': summary['failed_rows'],
+        'invalid_rows': summary['invalid_rows'],
+        'ai_error': summary['ai_error']
     })
 
+def wants_stream():
+    # ?stream=1 or "Accept: application/x-ndjson" switches /api/upload to NDJSON progress
+    if request.args.get('stream', '').lower() in ('1', 'true', 'ndjson'):
+        return True
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+def stream_upload(pairs, spilled_paths):
+    # One JSON line per file as soon as it is parsed and written, then the summary line
+    try:
+        events = ingest_parsed_files(storage, iter_parse_files(pairs), commit_each_file=True)
+        for event in events:
+            if event['type'] == 'file':
+                search_index.note_rows(event['data'])
+            yield json.dumps(event) + '\n'
+    finally:
+        remove_files(spilled_paths)
+
+@app.route('/api/profiles', methods=['GET'])
+def list_request_profiles():
+    # Stored request profiles, newest first (needs X-Profile-Token)
+    if not profiling.is_admin():
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'profiles': profiling.list_profiles()})
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def download_request_profile(profile_id):
+    # The cProfile dump, for pstats / snakeviz
+    if not profiling.is_admin():
+        return jsonify({'error': 'Not found'}), 404
+    path = profiling.profile_path(profile_id)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{profile_id}.prof')
+
+@app.route('/api/summary', methods=['GET'])
+def get_summary():
+    # Totals kept up to date by every write (one document read), or counted by SQLite
+    return jsonify(storage.summary())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f'Upload too large: the limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB per request'}), 413
+
+@app.route('/api/jobs', methods=['POST'])
+def create_ingest_job():
+    # Same pipeline as /api/upload, but the request returns as soon as the files are spooled
+    if 'files' not in request.files:
+        return jsonify({'error': 'No files part in the request'}), 400
+    job_id = ingest_workers.submit(request.files.getlist('files'))
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_ingest_job(job_id):
+    job = ingest_workers.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+# Any of these switches /api/rows from the legacy {active, archived} dump to paged mode
+PAGED_ROWS_ARGS = {
+    'page_size', 'page_token', 'archived', 'starred', 'billing_date_from',
+    'billing_date_to', 'order_by', 'direction', 'fields'
+}
+
 @app.route('/api/rows', methods=['GET'])
 def get_rows():
     assigned_to_param = request.args.get('assigned_to', 'all')
     assigned_to_list = [x.strip() for x in assigned_to_param.split(',')] if assigned_to_param != 'all' else None
 
-    docs = db.collection('invoices').stream()
+    if PAGED_ROWS_ARGS & set(request.args):
+        # Paged mode: storage filters, orders and projects; one page per request
+        try:
+            rows, next_page_token = storage.query(**parse_rows_args(request.args))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'rows': rows, 'next_page_token': next_page_token})
+
+    if rows_cache is not None and rows_cache.wait_ready():
+        return cached_rows_response(assigned_to_list)
+
+    in_filter = assigned_to_list if assigned_to_list and len(assigned_to_list) <= MAX_IN_VALUES else None
     active_rows = []
     archived_rows = []
-    for doc in docs:
-        row = doc.to_dict()
-        row['id'] = doc.id
+    rows = (row for page in storage.iter_pages(assigned_to=in_filter, by_billing_date=False, page_size=None)
+            for row in page)
+    for row in rows:
         # Filter by assigned_to if specified
         if assigned_to_list and row.get('assigned_to', '') not in assigned_to_list:
             continue
@@ -152,45 +165,127 @@ def get_rows():
             active_rows.append(row)
     return jsonify({'active': active_rows, 'archived': archived_rows})
 
+@app.route('/api/search', methods=['GET'])
+def search_rows():
+    # ?q=<name, recipient or invoice number>&limit=20; answered from the in-process index
+    query = request.args.get('q', '').strip()
+    if len(query) < MIN_QUERY_LENGTH:
+        return jsonify({'error': f'q must be at least {MIN_QUERY_LENGTH} characters'}), 400
+    try:
+        limit = int(request.args.get('limit', DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {MAX_SEARCH_LIMIT}'}), 400
+    if not search_index.wait_ready():
+        if search_index.error:
+            return jsonify({'error': f'Search index could not be built: {search_index.error}'}), 500
+        return jsonify({'error': 'Search index is still loading, try again shortly'}), 503
+    search_index.refresh()
+    return jsonify({'results': search_index.search(query, limit)})
+
+@app.route('/api/export', methods=['GET'])
+def export_invoices():
+    # ?format=csv|xlsx plus the /api/rows filters; streamed page by page
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        chunks = export_chunks(storage, export_format, parse_rows_args(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(stream_with_context(chunks), content_type=EXPORT_FORMATS[export_format], headers={
+        'Content-Disposition': f'attachment; filename="{export_filename(export_format)}"'
+    })
+
+def cached_rows_response(assigned_to_list):
+    # Served from the snapshot-listener cache; unchanged polls get 304 Not Modified
+    etag = rows_cache.etag(assigned_to_list)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    body = rows_cache.cached_response(etag)
+    if body is None:
+        etag, active_rows, archived_rows = rows_cache.split_rows(assigned_to_list)
+        body = jsonify({'active': active_rows, 'archived': archived_rows}).get_data()
+        rows_cache.store_response(etag, body)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/rows/changes', methods=['GET'])
+def get_row_changes():
+    # Delta sync: rows changed and ids deleted after ?since=<version>
+    try:
+        since = int(request.args.get('since', '0'))
+        limit = int(request.args.get('limit', DEFAULT_CHANGES_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'since and limit must be numbers'}), 400
+    if not 1 <= limit <= DEFAULT_CHANGES_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {DEFAULT_CHANGES_LIMIT}'}), 400
+    return jsonify(storage.changes_since(since, limit))
+
+@app.route('/api/rows/bulk', methods=['POST'])
+def bulk_update_rows():
+    # Body: {"items": [{"id": ..., "op": "archive" | "unarchive" | "notes" | "starred" | "assigned_to" | "delete", "args": {...}}]}
+    items = (request.json or {}).get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(items) > MAX_BULK_ITEMS:
+        return jsonify({'error': f'at most {MAX_BULK_ITEMS} items per request'}), 400
+    results = storage.apply_bulk(items)
+    for result in results:
+        if result['status'] != 'ok':
+            continue
+        if result['op'] == 'delete':
+            search_index.note_delete(result['id'])
+        elif result['op'] in ('archive', 'unarchive'):
+            search_index.note_update(result['id'], {'archived': result['op'] == 'archive'})
+    failed = sum(1 for r in results if r['status'] != 'ok')
+    return jsonify({'success': failed == 0, 'results': results, 'failed': failed})
+
 @app.route('/api/row/<row_id>/archive', methods=['POST'])
 def archive_row(row_id):
     data = request.json or {}
     archive_result = data.get('archive_result', '')
-    doc_ref = db.collection('invoices').document(row_id)
-    doc = doc_ref.get()
+    doc_data = storage.get(row_id)
     handled_by = ""
-    if doc.exists:
-        doc_data = doc.to_dict()
+    if doc_data is not None:
         handled_by = doc_data.get('assigned_to', '')
-    doc_ref.update({'archived': True, 'handled_by': handled_by, 'archive_result': archive_result})
+    storage.update(row_id, {'archived': True, 'handled_by': handled_by, 'archive_result': archive_result})
+    search_index.note_update(row_id, {'archived': True})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>', methods=['DELETE'])
 def delete_row(row_id):
-    db.collection('invoices').document(row_id).delete()
+    # Leaves a tombstone for /api/rows/changes and frees the dedup key
+    if storage.delete(row_id):
+        search_index.note_delete(row_id)
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/unarchive', methods=['POST'])
 def unarchive_row(row_id):
-    db.collection('invoices').document(row_id).update({'archived': False})
+    storage.update(row_id, {'archived': False})
+    search_index.note_update(row_id, {'archived': False})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/notes', methods=['POST'])
 def update_notes(row_id):
     notes = request.json.get('notes', '')
-    db.collection('invoices').document(row_id).update({'notes': notes})
+    storage.update(row_id, {'notes': notes})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/starred', methods=['POST'])
 def update_starred(row_id):
     starred = request.json.get('starred', False)
-    db.collection('invoices').document(row_id).update({'starred': starred})
+    storage.update(row_id, {'starred': starred})
     return jsonify({'success': True})
 
 @app.route('/api/row/<row_id>/assigned_to', methods=['POST'])
 def update_assigned_to(row_id):
     assigned_to = request.json.get('assigned_to', '')
-    db.collection('invoices').document(row_id).update({'assigned_to': assigned_to})
+    storage.update(row_id, {'assigned_to': assigned_to})
     return jsonify({'success': True})
 
 @app.route('/api/manual_entry', methods=['POST'])
@@ -208,20 +303,18 @@ def manual_entry():
     row['handled_by'] = row.get('handled_by', '')
     row['archive_result'] = row.get('archive_result', '')
     row['Billing Date'] = row.get('Billing Date', '')
+    row.update(query_fields(row))
+
+    (row,), errors = normalize_rows([row])
+    if errors:
+        return jsonify({'error': errors[0]['error']}), 400
 
-    # Ensure Betrag is always negative
-    betrag = row.get("Betrag", "")
-    betrag_clean = betrag.replace('.', '').replace(',', '.').replace(' ', '')
+    # Invoice and dedup key are written atomically in one batch
     try:
-        value = float(betrag_clean)
-        if value > 0:
-            value = -value
-        row["Betrag"] = f"{value:,.2f}".replace('.', 'X').replace(',', '.').replace('X', ',')
-    except Exception:
-        pass  # If conversion fails, leave as is
-
-    doc_ref = db.collection('invoices').add(row)
-    row['id'] = doc_ref[1].id
+        storage.add(row)
+    except StorageError as e:
+        return jsonify({'error': str(e)}), 500
+    search_index.note_rows([row])
     return jsonify({'success': True, 'row': row})
 
 @app.route('/api/row/<row_id>/edit', methods=['POST'])
@@ -231,22 +324,13 @@ def edit_row(row_id):
     if not all(data.get(field, '').strip() for field in required_fields):
         return jsonify({'error': 'Missing required fields'}), 400
 
-    # Restriction: Betrag must be a number
-    betrag = data.get("Betrag", "")
-    betrag_clean = betrag.replace('.', '').replace(',', '.').replace(' ', '')
-    try:
-        value = float(betrag_clean)
-        if value > 0:
-            value = -value
-        data["Betrag"] = f"{value:,.2f}".replace('.', 'X').replace(',', '.').replace('X', ',')
-    except Exception:
-        return jsonify({'error': 'Betrag must be a valid number'}), 400
-
-    # Restriction: Rechnungs-Nr. DZR must only contain numbers and /
-    if not re.fullmatch(r'[0-9/]+', data.get("Rechnungs-Nr. DZR", "")):
-        return jsonify({'error': 'Rechnungs-Nr. DZR must only contain numbers and /'}), 400
-
-    db.collection('invoices').document(row_id).update(data)
+    # Betrag must be a number, Rechnungs-Nr. DZR only numbers and /, Billing Date a real date
+    (data,), errors = normalize_rows([data])
+    if errors:
+        return jsonify({'error': errors[0]['error']}), 400
+
+    storage.update(row_id, data, before=storage.get(row_id))
+    search_index.note_update(row_id, data)
     return jsonify({'success': True})
 
 if __name__ == '__main__':
@@ -0,0 +1,272 @@
+"""Benchmarks for the PDF parsing stages and the /api/upload path.
+
+    python benchmark.py [--sizes 50,500,2000] [--repeat 3] [--files 3]
+                        [--output benchmark_results.json]
+                        [--thresholds benchmark_thresholds.json]
+                        [--baseline previous_results.json]
+                        [--ai-files 30] [--ai-latency 0.2]
+                        [--storage firestore|sqlite]
+
+Inputs are synthetic DZR statements (see synthetic_statements.py) and the
+upload runs against MemoryFirestore (or, with --storage sqlite, a fresh
+SQLite file), so no credentials or network are needed.
+The AI upload path (backend.py) talks to ai_stub_server.py on localhost.
+Results are written as JSON. The exit code is 1 when a benchmark's median is
+over its limit in the thresholds file, or more than the allowed tolerance
+slower than the same benchmark in --baseline.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = tempfile.mkdtemp(prefix='dzr-bench-')
+# The parse cache would turn every repeat into a cache hit; keep it off
+os.environ['PARSE_CACHE_MEMORY_ITEMS'] = '0'
+os.environ['PARSE_CACHE_DISK_BYTES'] = '0'
+os.environ['ROWS_CACHE'] = '0'
+os.environ.setdefault('PDF_WORKERS', '1')
+os.environ.setdefault('AI_BACKOFF_S', '0.05')
+os.environ.setdefault('INGEST_SPOOL_DIR', os.path.join(BENCH_DIR, 'spool'))
+os.environ.setdefault('INGEST_JOBS_DB', os.path.join(BENCH_DIR, 'jobs.sqlite3'))
+
+from ai_stub_server import start_stub_server  # noqa: E402
+from memory_firestore import install_memory_firestore  # noqa: E402
+
+db = install_memory_firestore()
+
+from extract_ab_block_from_pdf import extract_relevant_block_from_pdf  # noqa: E402
+from extract_entries_from_ab_block import extract_ab_und_zusetzungen  # noqa: E402
+from parse_pool import parse_pdf  # noqa: E402
+from pdf_session import extract_billing_date  # noqa: E402
+from synthetic_statements import synthetic_block, synthetic_entries, synthetic_pdf  # noqa: E402
+
+DEFAULT_SIZES = [50, 500, 2000]
+# Block parsing is cheap, so it runs on blocks this many times bigger than the PDFs
+BLOCK_SCALE = 10
+# Seeds for uploaded PDFs; every upload gets fresh invoice numbers, so none is a duplicate
+_upload_seeds = itertools.count(1)
+
+
+def timed(fn, repeat):
+    # Run fn() repeat times; each call returns (rows handled, extra info)
+    seconds = []
+    rows = 0
+    extra = {}
+    for run in range(repeat):
+        start = time.perf_counter()
+        rows, extra = fn(run)
+        seconds.append(time.perf_counter() - start)
+    median = statistics.median(seconds)
+    result = {
+        'runs': repeat,
+        'min_s': round(min(seconds), 6),
+        'median_s': round(median, 6),
+        'mean_s': round(statistics.mean(seconds), 6),
+        'rows': rows,
+        'rows_per_s': round(rows / median, 1) if median else None,
+    }
+    result.update(extra)
+    return result
+
+
+def bench_block(size, repeat):
+    pdf = synthetic_pdf(size, seed=size)
+
+    def run(_):
+        block = extract_relevant_block_from_pdf(pdf)
+        if not block:
+            raise AssertionError('no block found in synthetic PDF')
+        return size, {}
+    return timed(run, repeat)
+
+
+def bench_billing_date(size, repeat):
+    pdf = synthetic_pdf(size, seed=size)
+
+    def run(_):
+        if extract_billing_date(pdf) != '15.03.2024':
+            raise AssertionError('billing date not found in synthetic PDF')
+        return size, {}
+    return timed(run, repeat)
+
+
+def bench_entries(size, repeat):
+    rows = size * BLOCK_SCALE
+    block = synthetic_block(rows, continuation_lines=2, malformed_every=50, seed=size)
+    expected = synthetic_entries(rows, continuation_lines=2, malformed_every=50, seed=size)[1]
+
+    def run(_):
+        parsed, skipped_any = extract_ab_und_zusetzungen(block)
+        if parsed != expected or not skipped_any:
+            raise AssertionError('extract_ab_und_zusetzungen returned unexpected rows')
+        return rows, {}
+    return timed(run, repeat)
+
+
+def bench_table(size, repeat):
+    # Coordinate-based extraction on a statement laid out in columns
+    pdf = synthetic_pdf(size, seed=size, columns=True)
+    expected = synthetic_entries(size, seed=size)[1]
+
+    def run(_):
+        result = parse_pdf(pdf, 'statement.pdf', mode='table')
+        if result['extraction'] != 'table' or result['entries'] != expected or result['skipped_any']:
+            raise AssertionError('table extraction returned unexpected rows')
+        return size, {}
+    return timed(run, repeat)
+
+
+def bench_upload(size, repeat, files):
+    import backend2
+
+    client = backend2.app.test_client()
+    uploads = [[synthetic_pdf(size, seed=next(_upload_seeds)) for _ in range(files)] for _ in range(repeat)]
+
+    def run(index):
+        before = (db.reads, db.writes, db.commits)
+        data = {'files': [(io.BytesIO(pdf), f'statement-{i}.pdf') for i, pdf in enumerate(uploads[index])]}
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.post('/api/upload', data=data, content_type='multipart/form-data')
+        body = response.get_json()
+        if response.status_code != 200 or len(body['data']) != size * files:
+            raise AssertionError(f'upload returned {response.status_code} with {len(body.get("data", []))} rows')
+        if backend2.storage.backend != 'firestore':
+            return size * files, {'files': files}
+        return size * files, {
+            'files': files,
+            'firestore_reads': db.reads - before[0],
+            'firestore_writes': db.writes - before[1],
+            'firestore_commits': db.commits - before[2],
+        }
+    return timed(run, repeat)
+
+
+def bench_ai_upload(size, repeat, files, latency):
+    # Every file costs one AI call of `latency` seconds; calls overlap, so a run should
+    # take about one call's time (times ceil(files / AI_CONCURRENCY)), not files x latency
+    import ai_parser
+    import backend
+
+    stub = start_stub_server(latency=latency, fail_every=7)
+    ai_parser.API_URL = stub.url
+    client = backend.app.test_client()
+    uploads = [[synthetic_pdf(size, seed=next(_upload_seeds)) for _ in range(files)] for _ in range(repeat)]
+
+    def run(index):
+        requests_before = stub.requests
+        data = {'files': [(io.BytesIO(pdf), f'statement-{i}.pdf') for i, pdf in enumerate(uploads[index])]}
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.post('/api/upload', data=data, content_type='multipart/form-data')
+        body = response.get_json()
+        if response.status_code != 200 or body.get('ai_error') or len(body['data']) != size * files:
+            raise AssertionError(f'AI upload returned {response.status_code}: {body.get("invalid_files")}')
+        return size * files, {
+            'files': files,
+            'ai_latency_s': latency,
+            'ai_requests': stub.requests - requests_before,
+            'ai_max_in_flight': stub.max_in_flight,
+        }
+    try:
+        return timed(run, repeat)
+    finally:
+        stub.shutdown()
+
+
+def run_benchmarks(sizes, repeat, files, ai_files=30, ai_latency=0.2):
+    results = {}
+    for size in sizes:
+        print(f"Benchmarking {size} rows ...", file=sys.stderr)
+        results[f'extract_relevant_block_from_pdf[{size}]'] = bench_block(size, repeat)
+        results[f'extract_billing_date[{size}]'] = bench_billing_date(size, repeat)
+        results[f'extract_ab_und_zusetzungen[{size * BLOCK_SCALE}]'] = bench_entries(size, repeat)
+        results[f'extract_table_entries[{size}]'] = bench_table(size, repeat)
+        results[f'upload_invoices[{files}x{size}]'] = bench_upload(size, repeat, files)
+    if ai_files:
+        size = min(sizes)
+        print(f"Benchmarking AI upload of {ai_files} files ...", file=sys.stderr)
+        results[f'ai_upload_invoices[{ai_files}x{size}]'] = bench_ai_upload(size, repeat, ai_files, ai_latency)
+    return results
+
+
+def find_regressions(results, thresholds, baseline):
+    regressions = []
+    for name, limit in thresholds.get('max_median_s', {}).items():
+        if name in results and results[name]['median_s'] > limit:
+            regressions.append({'benchmark': name, 'median_s': results[name]['median_s'],
+                                'limit_s': limit, 'source': 'threshold'})
+    if baseline:
+        tolerance = thresholds.get('baseline_tolerance', 0.25)
+        for name, previous in baseline.get('benchmarks', {}).items():
+            if name not in results:
+                continue
+            limit = round(previous['median_s'] * (1 + tolerance), 6)
+            if results[name]['median_s'] > limit:
+                regressions.append({'benchmark': name, 'median_s': results[name]['median_s'],
+                                    'limit_s': limit, 'source': 'baseline'})
+    return regressions
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Benchmark PDF parsing and uploads on synthetic statements.')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated rows per PDF')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--files', type=int, default=3, help='PDFs per upload request')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--thresholds', default=os.path.join(here, 'benchmark_thresholds.json'))
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--ai-files', type=int, default=30, help='PDFs in the AI upload benchmark (0 skips it)')
+    parser.add_argument('--ai-latency', type=float, default=0.2, help='seconds the AI stub takes per call')
+    parser.add_argument('--storage', choices=('firestore', 'sqlite'), default='firestore',
+                        help='where uploads are stored (firestore means MemoryFirestore)')
+    args = parser.parse_args(argv)
+    # Read when the backends are imported, which happens in the upload benchmarks
+    os.environ['STORAGE_BACKEND'] = args.storage
+    os.environ['SQLITE_PATH'] = os.path.join(BENCH_DIR, 'invoices.sqlite3')
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    thresholds = {}
+    if args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds, 'r', encoding='utf-8') as f:
+            thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(sizes, max(1, args.repeat), max(1, args.files), max(0, args.ai_files), args.ai_latency)
+    regressions = find_regressions(results, thresholds, baseline)
+    report = {
+        'generated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'sizes': sizes, 'repeat': args.repeat, 'files': args.files,
+                     'ai_files': args.ai_files, 'ai_latency_s': args.ai_latency,
+                     'pdf_workers': os.environ['PDF_WORKERS'], 'storage': args.storage},
+        'benchmarks': results,
+        'regressions': regressions,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        print(f"{name:45} median {result['median_s'] * 1000:10.1f} ms  {result['rows_per_s'] or 0:12.1f} rows/s")
+    for regression in regressions:
+        print(f"REGRESSION {regression['benchmark']}: {regression['median_s']}s > {regression['limit_s']}s "
+              f"({regression['source']})")
+    print(f"Results written to {args.output}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
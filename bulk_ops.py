@@ -0,0 +1,157 @@
+from typing import Dict, List, Optional, Tuple
+
+from change_log import TOMBSTONES_COLLECTION, stamp, versioned_write
+from summary_totals import add_to_summary, summary_delta
+
+# Largest number of items accepted by one /api/rows/bulk request
+MAX_BULK_ITEMS = 1000
+# Firestore rejects a transaction with more than 500 writes
+MAX_BATCH_OPS = 500
+OPS = ('archive', 'unarchive', 'notes', 'starred', 'assigned_to', 'delete')
+
+
+def _update_fields(op: str, args: Dict, row: Dict) -> Dict:
+    # Same fields the single-row endpoints write
+    if op == 'archive':
+        return {'archived': True, 'handled_by': row.get('assigned_to', ''),
+                'archive_result': args.get('archive_result', '')}
+    if op == 'unarchive':
+        return {'archived': False}
+    if op == 'notes':
+        return {'notes': args.get('notes', '')}
+    if op == 'starred':
+        return {'starred': args.get('starred', False)}
+    return {'assigned_to': args.get('assigned_to', '')}
+
+
+def _check_item(item) -> Optional[str]:
+    if not isinstance(item, dict):
+        return 'item must be an object'
+    if not isinstance(item.get('id'), str) or not item['id'] or '/' in item['id']:
+        return 'id must be a row id'
+    if item.get('op') not in OPS:
+        return f"op must be one of {', '.join(OPS)}"
+    if not isinstance(item.get('args', {}), dict):
+        return 'args must be an object'
+    return None
+
+
+def check_items(items: List) -> List[Dict]:
+    # One {id, op, status} result per item; status is 'error' for malformed items
+    results = []
+    for item in items:
+        error = _check_item(item)
+        if error:
+            results.append({'id': item.get('id') if isinstance(item, dict) else None,
+                            'op': item.get('op') if isinstance(item, dict) else None,
+                            'status': 'error', 'error': error})
+        else:
+            results.append({'id': item['id'], 'op': item['op'], 'status': 'ok'})
+    return results
+
+
+def plan_bulk(items: List, results: List[Dict], rows: Dict[str, Dict]) -> List[Tuple[int, str, str, Dict, Dict]]:
+    """Every write of a bulk request, in item order: (result index, 'update' or 'delete', row id, data, row before).
+
+    rows are the stored rows by id, as read up front; they are updated in
+    place as the plan goes, so a later item sees what an earlier one did.
+    Items whose row does not exist are marked 'not_found' in results.
+    """
+    planned = []
+    for index, (item, result) in enumerate(zip(items, results)):
+        if result['status'] != 'ok':
+            continue
+        row = rows.get(item['id'])
+        if row is None:
+            result['status'] = 'not_found'
+            continue
+        if item['op'] == 'delete':
+            planned.append((index, 'delete', item['id'], dict(row), dict(row)))
+            del rows[item['id']]
+        else:
+            data = _update_fields(item['op'], item.get('args', {}), row)
+            planned.append((index, 'update', item['id'], data, dict(row)))
+            row.update(data)
+    return planned
+
+
+def _read_rows(db, row_ids: List[str], transaction=None) -> Dict[str, Dict]:
+    # One get_all per 500 ids instead of one get() per row
+    rows = {}
+    for start in range(0, len(row_ids), MAX_BATCH_OPS):
+        refs = [db.collection('invoices').document(i) for i in row_ids[start:start + MAX_BATCH_OPS]]
+        for snapshot in db.get_all(refs, transaction=transaction):
+            if snapshot.exists:
+                rows[snapshot.id] = snapshot.to_dict()
+    return rows
+
+
+def apply_bulk(db, items: List, dedup_index=None, max_ops=MAX_BATCH_OPS) -> List[Dict]:
+    """Apply a list of {id, op, args} row mutations with as few commits as possible.
+
+    All rows are read up front in bulk to size the change sets of up to
+    max_ops writes. Each change set then reads its rows again inside its
+    transaction and writes what those rows say (this is where archive takes
+    its handled_by from, and what the summary totals move by), so rows
+    changed or deleted in between are never written or counted from a stale
+    copy. Items run in order, so a later item sees what an earlier one did
+    to the same row. Returns one {id, op, status} result per item, in
+    request order; status is 'ok', 'not_found' or 'error'.
+    """
+    results = check_items(items)
+    rows = _read_rows(db, sorted({r['id'] for r in results if r['status'] == 'ok'}))
+    planned = plan_bulk(items, results, rows)
+
+    # Writes per item: update is 1, delete is row + tombstone (+ dedup key)
+    delete_cost = 3 if dedup_index is not None else 2
+
+    chunks = []
+    chunk, used = [], 0
+    for index, kind, *_ in planned:
+        # One write per chunk goes to the change version counter and one to the summary totals
+        cost = delete_cost if kind == 'delete' else 1
+        if chunk and used + cost > max_ops - 2:
+            chunks.append(chunk)
+            chunk, used = [], 0
+        chunk.append(index)
+        used += cost
+    if chunk:
+        chunks.append(chunk)
+
+    for chunk in chunks:
+        chunk_items = [items[index] for index in chunk]
+        chunk_results = []
+
+        def write(transaction, version):
+            # Planned again from the rows as they are in this transaction; a retry starts over
+            current = _read_rows(db, sorted({item['id'] for item in chunk_items}), transaction=transaction)
+            chunk_results[:] = [{'id': item['id'], 'op': item['op'], 'status': 'ok'} for item in chunk_items]
+            writes = plan_bulk(chunk_items, chunk_results, current)
+            for _, kind, row_id, data, before in writes:
+                doc_ref = db.collection('invoices').document(row_id)
+                if kind == 'update':
+                    transaction.update(doc_ref, stamp(dict(data), version))
+                    continue
+                transaction.delete(doc_ref)
+                tombstone_ref = db.collection(TOMBSTONES_COLLECTION).document(row_id)
+                transaction.set(tombstone_ref, stamp({'id': row_id}, version))
+                if dedup_index is not None:
+                    dedup_index.remove(before, row_id, batch=transaction)
+            # Totals move from the rows as read in this transaction to the rows as written
+            add_to_summary(db, transaction, summary_delta(
+                removed=[before for *_, before in writes],
+                added=[dict(before, **data) for _, kind, _, data, before in writes if kind == 'update'],
+            ))
+
+        try:
+            version = versioned_write(db, write)
+        except Exception as e:
+            for index in chunk:
+                results[index]['status'] = 'error'
+                results[index]['error'] = str(e)
+            continue
+        for index, result in zip(chunk, chunk_results):
+            results[index] = result
+            if result['status'] == 'ok':
+                result['change_version'] = version
+    return results
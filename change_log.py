@@ -0,0 +1,145 @@
+from typing import Callable, Dict, List, Optional
+
+from firebase_admin import firestore
+
+from summary_totals import add_to_summary, summary_delta, touches_summary
+
+# Single counter document; every committed change set takes the next value
+VERSION_COLLECTION = 'meta'
+VERSION_DOC_ID = 'change_version'
+TOMBSTONES_COLLECTION = 'invoice_tombstones'
+DEFAULT_CHANGES_LIMIT = 1000
+
+
+def _version_ref(db):
+    return db.collection(VERSION_COLLECTION).document(VERSION_DOC_ID)
+
+
+def stamp(data: Dict, version: int) -> Dict:
+    # Every invoice write carries when it happened and in which change set
+    data['updated_at'] = firestore.SERVER_TIMESTAMP
+    data['change_version'] = version
+    return data
+
+
+def versioned_write(db, write: Callable) -> int:
+    """Run write(transaction, version) in a transaction that takes the next change version.
+
+    The counter is read and bumped in the same transaction as the writes, so
+    change sets become visible in version order and /api/rows/changes never
+    skips one. Returns the version used.
+    """
+    version_ref = _version_ref(db)
+
+    @firestore.transactional
+    def run(transaction):
+        snapshot = version_ref.get(transaction=transaction)
+        version = (snapshot.get('value') if snapshot.exists else 0) + 1
+        write(transaction, version)
+        transaction.set(version_ref, {'value': version})
+        return version
+
+    return run(db.transaction())
+
+
+def update_invoice(db, row_id: str, data: Dict, dedup_index=None, before: Optional[Dict] = None) -> int:
+    """Versioned update of one invoice; re-keys the dedup index if before is given.
+
+    If data can move the row between summary totals, the row is read in the
+    transaction and the totals are updated with it.
+    """
+    doc_ref = db.collection('invoices').document(row_id)
+
+    def write(transaction, version):
+        delta = None
+        if touches_summary(data):
+            snapshot = doc_ref.get(transaction=transaction)
+            if snapshot.exists:
+                current = snapshot.to_dict()
+                delta = summary_delta(removed=[current], added=[dict(current, **data)])
+        transaction.update(doc_ref, stamp(dict(data), version))
+        add_to_summary(db, transaction, delta)
+        if dedup_index is not None and before is not None:
+            dedup_index.replace(before, dict(before, **data), row_id, batch=transaction)
+
+    return versioned_write(db, write)
+
+
+def delete_invoice(db, row_id: str, dedup_index=None, before: Optional[Dict] = None) -> int:
+    """Delete one invoice and leave a tombstone so delta clients drop it too."""
+    doc_ref = db.collection('invoices').document(row_id)
+    tombstone_ref = db.collection(TOMBSTONES_COLLECTION).document(row_id)
+
+    def write(transaction, version):
+        snapshot = doc_ref.get(transaction=transaction)
+        transaction.delete(doc_ref)
+        transaction.set(tombstone_ref, stamp({'id': row_id}, version))
+        if snapshot.exists:
+            add_to_summary(db, transaction, summary_delta(removed=[snapshot.to_dict()]))
+        if dedup_index is not None and before is not None:
+            dedup_index.remove(before, row_id, batch=transaction)
+
+    return versioned_write(db, write)
+
+
+def current_version(db) -> int:
+    snapshot = _version_ref(db).get()
+    return snapshot.get('value') if snapshot.exists else 0
+
+
+def changes_since(db, since: int, limit=DEFAULT_CHANGES_LIMIT) -> Dict:
+    """Rows changed and rows deleted after version `since`.
+
+    At most `limit` rows and `limit` tombstones are read. If that cuts a change
+    set in half, the answer stops before it and 'has_more' is set; if a single
+    change set is bigger than the limit, 'reset' tells the client to reload
+    /api/rows instead.
+    """
+    # Read first: anything committed after this shows up in the queries below
+    latest = current_version(db)
+    FieldFilter = firestore.FieldFilter
+    rows_query = (
+        db.collection('invoices')
+        .where(filter=FieldFilter('change_version', '>', since))
+        .order_by('change_version')
+        .limit(limit + 1)
+    )
+    tombstones_query = (
+        db.collection(TOMBSTONES_COLLECTION)
+        .where(filter=FieldFilter('change_version', '>', since))
+        .order_by('change_version')
+        .limit(limit + 1)
+    )
+    rows = []
+    for doc in rows_query.stream():
+        row = doc.to_dict()
+        row['id'] = doc.id
+        rows.append(row)
+    tombstones = [doc.to_dict() for doc in tombstones_query.stream()]
+    return complete_change_sets(since, latest, rows, tombstones, limit)
+
+
+def complete_change_sets(since: int, latest: int, rows: List[Dict], tombstones: List[Dict], limit: int) -> Dict:
+    """The changes_since() answer for up to limit + 1 rows and tombstones read in version order."""
+    cutoffs = [items[limit]['change_version'] for items in (rows, tombstones) if len(items) > limit]
+    if cutoffs:
+        # Only hand out complete change sets
+        cutoff = min(cutoffs)
+        rows = [r for r in rows if r['change_version'] < cutoff]
+        tombstones = [t for t in tombstones if t['change_version'] < cutoff]
+        if not rows and not tombstones:
+            return {'reset': True, 'version': latest, 'rows': [], 'deleted': [], 'has_more': False}
+        version = max(item['change_version'] for item in rows + tombstones)
+        has_more = True
+    else:
+        versions = [item['change_version'] for item in rows + tombstones]
+        version = max(versions + [since, latest])
+        has_more = False
+    return {
+        'reset': False,
+        'version': version,
+        'rows': rows,
+        'deleted': [t['id'] for t in tombstones],
+        'has_more': has_more,
+    }
+
@@ -0,0 +1,16 @@
+import pytest
+
+import ai_parser
+from ai_stub_server import start_stub_server
+from parse_cache import ParseCache
+
+
+@pytest.fixture
+def ai_stub(monkeypatch, tmp_path):
+    # A local stand-in for the AI API and an empty parse cache, so every answer comes from the stub
+    stub = start_stub_server()
+    monkeypatch.setattr(ai_parser, 'API_URL', stub.url)
+    monkeypatch.setattr(ai_parser, 'parse_cache', ParseCache(directory=str(tmp_path)))
+    yield stub
+    stub.shutdown()
+    stub.server_close()
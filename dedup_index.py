@@ -0,0 +1,193 @@
+import hashlib
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Set, Tuple
+
+from firebase_admin import firestore
+
+from change_log import current_version
+from metrics import timed_stage
+
+INDEX_COLLECTION = 'invoice_keys'
+META_DOC_ID = '_meta'
+# How long a key that is known to exist is trusted without re-reading Firestore,
+# as long as no change set has been committed since (see DedupIndex.existing)
+DEFAULT_CACHE_TTL = 300
+
+
+def normalize_nr(nr):
+    return nr.replace(" ", "").lower() if nr else ""
+
+
+def dedup_key(row: Dict) -> Tuple[str, str]:
+    # (normalized Ihre Rechnungs-Nr., Betrag) - the pair uploads are deduplicated on
+    return normalize_nr(row.get("Ihre Rechnungs-Nr.")), row.get("Betrag", "")
+
+
+def key_doc_id(key: Tuple[str, str]) -> str:
+    # Invoice numbers contain '/', which Firestore does not allow in document IDs
+    nr, betrag = key
+    return hashlib.sha1(f"{nr}\x1f{betrag}".encode('utf-8')).hexdigest()
+
+
+class DedupIndex:
+    """Persistent (nr, Betrag) index with a warm in-process cache in front of it.
+
+    Every key has one document in INDEX_COLLECTION, named by key_doc_id(), that
+    lists the invoice IDs currently holding that key. Uploads look up only the
+    keys they are about to insert instead of streaming the whole invoices
+    collection.
+    """
+
+    def __init__(self, db, collection=INDEX_COLLECTION, cache_ttl=DEFAULT_CACHE_TTL):
+        self._db = db
+        self._collection = collection
+        self._cache_ttl = cache_ttl
+        self._known = {}  # key -> time after which it must be re-read
+        self._version = None  # change version the cached keys were read at
+        self._lock = threading.Lock()
+        self._built = False
+
+    def _ref(self, key):
+        return self._db.collection(self._collection).document(key_doc_id(key))
+
+    def _remember(self, key):
+        with self._lock:
+            self._known[key] = time.monotonic() + self._cache_ttl
+
+    def _forget(self, key):
+        with self._lock:
+            self._known.pop(key, None)
+
+    def _sync_version(self):
+        # Rows deleted or re-keyed by another worker bump the change version, so a
+        # new version drops every cached key instead of trusting it for the TTL
+        version = current_version(self._db)
+        with self._lock:
+            if version != self._version:
+                self._known = {}
+                self._version = version
+
+    def _cached(self, key):
+        with self._lock:
+            expires = self._known.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._known[key]
+                return False
+            return True
+
+    def ensure_built(self):
+        # The first deploy has no index yet: build it once from the invoices collection
+        if self._built:
+            return
+        meta = self._db.collection(self._collection).document(META_DOC_ID).get()
+        if not (meta.exists and meta.to_dict().get('built')):
+            self.rebuild()
+        self._built = True
+
+    def existing(self, keys: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+        """Return the subset of keys that already belong to an invoice."""
+        with timed_stage('dedup_load') as sample:
+            self.ensure_built()
+            found = set()
+            missing = []
+            keys = set(keys)
+            sample['size'] = len(keys)
+            if keys:
+                self._sync_version()
+            for key in keys:
+                if not key[0]:
+                    continue
+                if self._cached(key):
+                    found.add(key)
+                else:
+                    missing.append(key)
+            if missing:
+                refs = [self._ref(key) for key in missing]
+                by_id = {key_doc_id(key): key for key in missing}
+                for snapshot in self._db.get_all(refs):
+                    if snapshot.exists and snapshot.to_dict().get('invoice_ids'):
+                        key = by_id[snapshot.id]
+                        found.add(key)
+                        self._remember(key)
+            return found
+
+    def add(self, row: Dict, invoice_id: str, batch=None):
+        key = dedup_key(row)
+        if not key[0]:
+            return
+        data = {'nr': key[0], 'betrag': key[1], 'invoice_ids': firestore.ArrayUnion([invoice_id])}
+        if batch is not None:
+            # Cached by remember() once the caller has committed the batch
+            batch.set(self._ref(key), data, merge=True)
+        else:
+            self._ref(key).set(data, merge=True)
+            self._remember(key)
+
+    def remember(self, row: Dict):
+        key = dedup_key(row)
+        if key[0]:
+            self._remember(key)
+
+    def remove(self, row: Dict, invoice_id: str, batch=None):
+        key = dedup_key(row)
+        if not key[0]:
+            return
+        data = {'invoice_ids': firestore.ArrayRemove([invoice_id])}
+        if batch is not None:
+            batch.set(self._ref(key), data, merge=True)
+        else:
+            self._ref(key).set(data, merge=True)
+        # Another invoice may still hold the key; the next lookup re-reads it
+        self._forget(key)
+
+    def replace(self, old_row: Dict, new_row: Dict, invoice_id: str, batch=None):
+        if dedup_key(old_row) == dedup_key(new_row):
+            return
+        self.remove(old_row, invoice_id, batch=batch)
+        self.add(new_row, invoice_id, batch=batch)
+
+    def rebuild(self):
+        """Reconcile the index with the invoices collection (full scan)."""
+        holders = {}
+        for doc in self._db.collection('invoices').stream():
+            key = dedup_key(doc.to_dict())
+            if key[0]:
+                holders.setdefault(key, []).append(doc.id)
+        live_ids = {key_doc_id(key) for key in holders}
+        stale = [
+            doc.reference for doc in self._db.collection(self._collection).stream()
+            if doc.id != META_DOC_ID and doc.id not in live_ids
+        ]
+        ops = [('delete', ref, None) for ref in stale]
+        ops += [
+            ('set', self._ref(key), {'nr': key[0], 'betrag': key[1], 'invoice_ids': ids})
+            for key, ids in holders.items()
+        ]
+        ops.append(('set', self._db.collection(self._collection).document(META_DOC_ID), {'built': True}))
+        for start in range(0, len(ops), 500):
+            batch = self._db.batch()
+            for op, ref, data in ops[start:start + 500]:
+                if op == 'delete':
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data)
+            batch.commit()
+        with self._lock:
+            self._known = {}
+        self._built = True
+        return len(holders)
+
+
+if __name__ == '__main__':
+    # python dedup_index.py [path/to/service-account.json]
+    import firebase_admin
+    from firebase_admin import credentials
+
+    cred_path = sys.argv[1] if len(sys.argv) > 1 else '/etc/secrets/fire-base.json'
+    firebase_admin.initialize_app(credentials.Certificate(cred_path))
+    count = DedupIndex(firestore.client()).rebuild()
+    print(f"Rebuilt dedup index with {count} keys")
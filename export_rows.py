@@ -0,0 +1,161 @@
+import csv
+import datetime
+import io
+import os
+import re
+import zipfile
+from typing import Dict, Iterable, Iterator, List
+from xml.sax.saxutils import escape
+
+from ingest import CSV_COLUMNS
+from rows_query import MAX_IN_VALUES
+
+# Rows read from storage per round trip; one page is in memory at a time
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '500'))
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+# Characters XML 1.0 does not allow, even escaped
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+# The parse_rows_args() filters an export honours
+EXPORT_FILTERS = ('archived', 'assigned_to', 'starred', 'billing_date_from', 'billing_date_to')
+
+
+def _text(value) -> str:
+    return '' if value is None else str(value)
+
+
+def csv_chunks(pages: Iterable[List[Dict]]) -> Iterator[bytes]:
+    # UTF-8 with BOM so Excel shows the umlauts; one chunk per page
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    yield ('\ufeff' + buffer.getvalue()).encode('utf-8')
+    for rows in pages:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_text(row.get(column)) for column in CSV_COLUMNS] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink:
+    # Write-only stream for zipfile: without seek/tell it writes data descriptors
+    # instead of going back to patch headers, so finished bytes can be sent right away
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _column_letter(index: int) -> str:
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return letters
+
+
+def _xlsx_row(number: int, values: List) -> str:
+    cells = []
+    for index, value in enumerate(values):
+        ref = f'{_column_letter(index)}{number}'
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+        else:
+            text = escape(XML_ILLEGAL.sub('', _text(value)))
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row r="{number}">' + ''.join(cells) + '</row>'
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Invoices" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'),
+}
+
+
+def xlsx_chunks(pages: Iterable[List[Dict]]) -> Iterator[bytes]:
+    """A one-sheet workbook written as the pages arrive, without openpyxl.
+
+    Cells are inline strings, except Betrag, which is a number in euros
+    (from betrag_cents) so it can be summed; rows without betrag_cents keep
+    the Betrag text.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetData>')
+            sheet.write(_xlsx_row(1, CSV_COLUMNS).encode('utf-8'))
+            yield sink.take()
+            number = 1
+            for rows in pages:
+                lines = []
+                for row in rows:
+                    number += 1
+                    values = [row.get(column) for column in CSV_COLUMNS]
+                    if isinstance(row.get('betrag_cents'), int):
+                        values[CSV_COLUMNS.index('Betrag')] = row['betrag_cents'] / 100
+                    lines.append(_xlsx_row(number, values))
+                sheet.write(''.join(lines).encode('utf-8'))
+                yield sink.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.take()
+
+
+def export_chunks(storage, export_format: str, rows_args: Dict) -> Iterator[bytes]:
+    """The export file as a stream of chunks; rows_args as returned by parse_rows_args().
+
+    Raises ValueError before anything is read, so the caller can still answer 400.
+    """
+    filters = {name: rows_args.get(name) for name in EXPORT_FILTERS}
+    if filters['assigned_to'] and len(filters['assigned_to']) > MAX_IN_VALUES:
+        raise ValueError(f'at most {MAX_IN_VALUES} assigned_to values per request')
+    # In billing date order; each page continues after the last row of the previous one
+    pages = storage.iter_pages(fields=CSV_COLUMNS + ['betrag_cents'], page_size=EXPORT_PAGE_SIZE, **filters)
+    return csv_chunks(pages) if export_format == 'csv' else xlsx_chunks(pages)
+
+
+def export_filename(export_format: str) -> str:
+    return f"invoices-{datetime.date.today().isoformat()}.{export_format}"
@@ -1,46 +1,143 @@
+import io
+import os
 import pdfplumber
 import re
+from typing import List, Optional
+
+START_MARKER = "Ab- und Zusetzungen"
+END_MARKER = "Summe Ab- und Zusetzungen"
+# By default reading stops after the page that closes the first Ab-/Zusetzungen section, so
+# the pages after the Summe line are never opened. PDF_ALL_SECTIONS=1 collects every section
+# instead, which means reading to the last page; use it for statements with several sections.
+PDF_ALL_SECTIONS = os.getenv('PDF_ALL_SECTIONS', '0') not in ('0', 'false', 'no', '')
+
+HEADER_PHRASES = [
+    "Ab- und Zusetzungen",
+    "Name des Patienten/ Rechnungs-Nr. Ihre Rechnungs-Nr. Betrag",
+    "Rechnungsempfängers DZR"
+]
+
+
+class SectionScanner:
+    """Finds Ab-/Zusetzungen sections in page texts fed one page at a time.
+
+    Only text from the last start marker onwards is kept, so memory depends on
+    the section, not on the document. A section runs from the last start
+    marker before a 'Summe Ab- und Zusetzungen' line up to that line (the same
+    rule find_relevant_block uses). With raw=True a section runs from the
+    first start marker to the next end marker, headers kept (the block
+    backend.py sends to the AI parser). Without all_sections (default:
+    PDF_ALL_SECTIONS) only the first section is collected. 'done' turns True
+    once nothing more is wanted from later pages.
+    """
+
+    def __init__(self, raw=False, all_sections=None):
+        self.raw = raw
+        self.all_sections = PDF_ALL_SECTIONS if all_sections is None else all_sections
+        self.sections: List[str] = []
+        self.done = False
+        self._buffer = None  # text from the relevant start marker on, None before any
+
+    def feed(self, page_text: str):
+        if self.done or not page_text:
+            return
+        # Same layout as the old whole-document string: every non-empty page followed by '\n'
+        text = page_text + '\n'
+        if self._buffer is None:
+            start = text.find(START_MARKER)
+            if start == -1:
+                return
+            if self.raw and not self.sections and 0 <= text.find(END_MARKER) < start:
+                # An end marker before any start marker: no raw block at all
+                self.done = True
+                return
+            self._buffer = text[start:]
+        else:
+            self._buffer += text
+        if self.raw:
+            while self._buffer is not None:
+                end = self._buffer.find(END_MARKER)
+                if end == -1:
+                    return
+                self.sections.append(self._buffer[:end].strip())
+                rest = self._buffer[end + len(END_MARKER):]
+                self._buffer = None
+                if not self.all_sections:
+                    self.done = True
+                    return
+                start = rest.find(START_MARKER)
+                if start != -1:
+                    self._buffer = rest[start:]
+            return
+        while True:
+            end = self._buffer.find(END_MARKER)
+            if end == -1:
+                # Nothing before the last start marker can belong to a section any more
+                self._buffer = self._buffer[self._buffer.rfind(START_MARKER):]
+                return
+            start = self._buffer.rfind(START_MARKER, 0, end)
+            self.sections.append(self._buffer[start:end])
+            # 'Summe Ab- und Zusetzungen' contains the start marker; like the whole-text
+            # search, it can open the next section if no other start marker follows
+            self._buffer = self._buffer[end + END_MARKER.index(START_MARKER):]
+            if not self.all_sections:
+                self.done = True
+                return
+
+    def blocks(self) -> List[str]:
+        # Sections with their leading header lines removed (raw sections as they are)
+        if self.raw:
+            return list(self.sections)
+        return [clean_block(s) for s in self.sections]
 
-def extract_relevant_block_from_pdf(pdf_path: str) -> str:
-    # Extract all text from all pages
-    text = ''
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + '\n'
-    # Find all positions of 'Ab- und Zusetzungen' and 'Summe Ab- und Zusetzungen'
-    starts = [m.start() for m in re.finditer(r"Ab- und Zusetzungen", text)]
-    ends = [m.start() for m in re.finditer(r"Summe Ab- und Zusetzungen", text)]
-    if not starts or not ends:
-        return None
-    # Pick the last 'Ab- und Zusetzungen' that is BEFORE any end marker
-    start = None
-    for s in reversed(starts):
-        if any(e > s for e in ends):
-            start = s
-            break
-    if start is None:
-        return None
-    end = min(e for e in ends if e > start)
-    block = text[start:end]
 
+def clean_block(block: str) -> str:
     # --- NEW: Remove header lines automatically ---
     lines = block.splitlines()
     # Remove empty lines
     lines = [line for line in lines if line.strip()]
-    # Remove the first 2 or 3 lines if they match the known header pattern
-    # Adjust this number if your header is sometimes longer/shorter
-    header_phrases = [
-        "Ab- und Zusetzungen",
-        "Name des Patienten/ Rechnungs-Nr. Ihre Rechnungs-Nr. Betrag",
-        "Rechnungsempfängers DZR"
-    ]
     # Remove lines that match any header phrase at the start of the block
-    while lines and any(h in lines[0] for h in header_phrases):
+    while lines and any(h in lines[0] for h in HEADER_PHRASES):
         lines.pop(0)
-    while lines and any(h in lines[0] for h in header_phrases):  # In case header repeats
-        lines.pop(0)
-    # You can also remove 2-3 lines blindly if the above doesn't work for some PDFs
     block_cleaned = "\n".join(lines)
     return block_cleaned.strip()
+
+
+def find_sections(text: str, raw=False) -> List[str]:
+    # Every Ab-/Zusetzungen section of an already extracted text
+    scanner = SectionScanner(raw=raw, all_sections=True)
+    scanner.feed(text[:-1] if text.endswith('\n') else text)
+    return scanner.blocks()
+
+
+def join_blocks(blocks: List[str]) -> Optional[str]:
+    return "\n".join(blocks) if blocks else None
+
+
+def extract_relevant_block_from_pdf(pdf_path) -> str:
+    # pdf_path may also be a binary file-like object or the PDF's bytes
+    if isinstance(pdf_path, (bytes, bytearray, memoryview)):
+        pdf_path = io.BytesIO(pdf_path)
+    # Read page by page and stop once the section is complete (unless PDF_ALL_SECTIONS)
+    scanner = SectionScanner()
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text()
+            page.close()  # Drop the page's cached layout objects
+            scanner.feed(page_text)
+            if scanner.done:
+                break
+    return join_blocks(scanner.blocks())
+
+def find_relevant_block(text: str) -> str:
+    # The last section of a whole-document text
+    sections = find_sections(text)
+    if not sections:
+        return None
+    return sections[-1]
+
+def find_raw_block(text: str) -> str:
+    # Text between the first start marker and the first end marker, headers kept
+    # (this is the block backend.py sends to the AI parser)
+    sections = find_sections(text, raw=True)
+    return sections[0] if sections else None
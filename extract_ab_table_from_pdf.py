@@ -0,0 +1,153 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from extract_ab_block_from_pdf import END_MARKER, START_MARKER
+
+# Words whose tops differ by at most this many points are on the same line
+LINE_TOLERANCE = 3
+# Words may start this many points left of their column's header word
+COLUMN_TOLERANCE = 2
+RECHNUNGS_NR_PATTERN = re.compile(r"\d{4,10}/\d{2}/\d{4}")
+AMOUNT_PATTERN = re.compile(r"-?\d{1,3}(?:\.\d{3})*(?:,\d+)")
+# Second header line, under 'Name des Patienten/' and 'Rechnungs-Nr.'
+SUBHEADER_TEXT = "Rechnungsempfängers DZR"
+
+
+def group_lines(words: List[Dict]) -> List[List[Dict]]:
+    # pdfplumber words -> lines of words, top to bottom, each line left to right
+    lines = []
+    for word in sorted(words, key=lambda w: (w['top'], w['x0'])):
+        if lines and abs(word['top'] - lines[-1][0]['top']) <= LINE_TOLERANCE:
+            lines[-1].append(word)
+        else:
+            lines.append([word])
+    return [sorted(line, key=lambda w: w['x0']) for line in lines]
+
+
+def line_text(line: List[Dict]) -> str:
+    return ' '.join(word['text'] for word in line)
+
+
+def column_anchors(line: List[Dict]) -> Optional[Tuple[float, float, float, float]]:
+    """x positions of the four columns if line is the 'Name des Patienten/ ... Betrag' header.
+
+    Returns (name x0, Rechnungs-Nr. x0, Ihre x0, Betrag x0), or None.
+    """
+    texts = [word['text'] for word in line]
+    if 'Name' not in texts or 'Ihre' not in texts or 'Betrag' not in texts:
+        return None
+    name = line[texts.index('Name')]
+    ihre = line[texts.index('Ihre')]
+    betrag = line[len(texts) - 1 - texts[::-1].index('Betrag')]
+    # The DZR Rechnungs-Nr. header is the first 'Rechnungs-Nr.' left of 'Ihre'
+    nr = next((w for w in line if w['text'].startswith('Rechnungs-Nr') and w['x0'] < ihre['x0']), None)
+    if nr is None or not name['x0'] < nr['x0'] < ihre['x0'] < betrag['x0']:
+        return None
+    return name['x0'], nr['x0'], ihre['x0'], betrag['x0']
+
+
+def split_columns(line: List[Dict], anchors) -> List[str]:
+    # Name, Rechnungs-Nr. DZR, Ihre Rechnungs-Nr., Betrag; amounts may be right aligned,
+    # so anything reaching past the left edge of 'Betrag' counts as Betrag
+    _, nr_x, ihre_x, betrag_x = anchors
+    cells = [[], [], [], []]
+    for word in line:
+        if word['x1'] > betrag_x:
+            cells[3].append(word['text'])
+        elif word['x0'] >= ihre_x - COLUMN_TOLERANCE:
+            cells[2].append(word['text'])
+        elif word['x0'] >= nr_x - COLUMN_TOLERANCE:
+            cells[1].append(word['text'])
+        else:
+            cells[0].append(word['text'])
+    return [' '.join(cell) for cell in cells]
+
+
+class TableScanner:
+    """Builds entries from the Ab-/Zusetzungen table one page of words at a time.
+
+    Words are assigned to columns by x position, using the header row as
+    anchors; no regex has to guess where the name ends and the numbers begin.
+    A line with a Rechnungs-Nr. or a Betrag starts an entry, a line with only
+    text adds to the current entry's Rechnungsempfängers. Repeated headers
+    after page breaks are recognized as such. 'done' turns True at the
+    'Summe Ab- und Zusetzungen' line; a table without one is not used.
+    Skipped lines are recorded like extract_entries_from_ab_block.iter_entries
+    does: {'line', 'text', 'reason'}.
+    """
+
+    def __init__(self):
+        self.rows: List[Dict[str, str]] = []
+        self.skipped: List[Dict] = []
+        self.block_lines: List[str] = []  # the table lines, as text, for logs and the 'block'
+        self.anchors = None
+        self.started = False
+        self.done = False
+        self._row = None
+        self._recipient = []
+        self._line_number = 0
+
+    def usable(self) -> bool:
+        # Found header and Summe line, and most lines made sense as columns
+        # (a statement that is not laid out as a table fails this)
+        return (self.done and self.anchors is not None and bool(self.rows)
+                and len(self.skipped) * 2 <= len(self.block_lines))
+
+    def feed(self, words: List[Dict]):
+        if self.anchors is not None:
+            # Crop to the table: drop anything left of its first column (margin notes etc.).
+            # Filtering words is much cheaper than page.crop(), which re-tests every char.
+            left = self.anchors[0] - COLUMN_TOLERANCE * 2
+            words = [word for word in words if word['x0'] >= left]
+        for line in group_lines(words):
+            if self.done:
+                return
+            self._feed_line(line)
+
+    def _skip(self, text, reason):
+        self.skipped.append({'line': self._line_number, 'text': text, 'reason': reason})
+
+    def _finish_row(self):
+        if self._row is not None:
+            self._row["Rechnungsempfängers"] = " ".join(self._recipient).strip()
+            self.rows.append(self._row)
+            self._row = None
+
+    def _feed_line(self, line: List[Dict]):
+        text = line_text(line)
+        if END_MARKER in text:
+            if self.started:
+                self._finish_row()
+                self.done = True
+            return
+        if not self.started:
+            self.started = START_MARKER in text
+            return
+        anchors = column_anchors(line)
+        if anchors is not None:
+            # Header, at the top of the table or repeated after a page break;
+            # an entry's Rechnungsempfängers may continue below it
+            self.anchors = anchors
+            return
+        if self.anchors is None or text == SUBHEADER_TEXT or text == START_MARKER:
+            return
+        self._line_number += 1
+        self.block_lines.append(text)
+        name, nr, ihre, betrag = split_columns(line, self.anchors)
+        if not nr and not betrag:
+            if self._row is not None:
+                self._recipient.append(text)
+            else:
+                self._skip(text, 'orphan')
+            return
+        self._finish_row()
+        if name and ihre and RECHNUNGS_NR_PATTERN.fullmatch(nr) and AMOUNT_PATTERN.fullmatch(betrag):
+            self._row = {
+                "Name": name,
+                "Rechnungs-Nr. DZR": nr,
+                "Ihre Rechnungs-Nr.": ihre,
+                "Betrag": betrag,
+            }
+            self._recipient = []
+        else:
+            self._skip(text, 'malformed')
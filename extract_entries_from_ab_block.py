@@ -104,49 +104,104 @@
 
 
 import re
-from typing import List, Dict, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
+
+_AMOUNT = r"-?\d{1,3}(?:\.\d{3})*(?:,\d+)"
+
+# One pattern per line: a main row, or else a main row whose Rechnungs-Nr. came out as "()".
+# The alternatives are tried in that order, just like the separate patterns were.
+LINE_PATTERN = re.compile(
+    r"^(?:"
+    r"(?P<name>.+?)\s+(?P<rechnungs_nr>\d{4,10}/\d{2}/\d{4})\s+(?P<ihre_nr>[\d\s\(\)A-Za-z]+?)\s+(?P<betrag>" + _AMOUNT + r")"
+    r"|(?P<malformed>.+?\s+\(\)\s+[\d\s\(\)A-Za-z]*\s*|.*\(\)\s*)" + _AMOUNT +
+    r")$"
+)
+
+MAIN = 'main'
+MALFORMED = 'malformed'
+SEPARATOR = 'separator'
+HEADER = 'header'
+CONTINUATION = 'continuation'
+
+
+def _lines(text: str) -> Iterator[Tuple[int, str]]:
+    # (1-based line number, stripped line) for non-empty lines, without splitting the whole text up front
+    start = 0
+    number = 0
+    while start <= len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        number += 1
+        line = text[start:end].strip()
+        if line:
+            yield number, line
+        start = end + 1
+
+
+def classify_line(line: str) -> Tuple[str, Optional[re.Match]]:
+    """Tag a stripped line with at most one regex evaluation: MAIN, MALFORMED, SEPARATOR, HEADER or CONTINUATION."""
+    # Both row shapes end in an amount like "12,50"; anything else needs no regex at all
+    match = LINE_PATTERN.match(line) if line[-1].isdigit() and ',' in line else None
+    if match:
+        return (MAIN if match.group('malformed') is None else MALFORMED), match
+    if line.startswith("---"):
+        return SEPARATOR, None
+    if "Betrag" in line or "Rechnungsempfängers" in line:
+        return HEADER, None
+    return CONTINUATION, None
+
+
+def iter_numbered_entries(text: str, skipped: Optional[List[Dict]] = None) -> Iterator[Tuple[int, int, Dict[str, str]]]:
+    """Yield (first line, last line, row) for every main line and its continuation lines.
+
+    Lines that are not part of a row are appended to `skipped` (if given) as
+    {'line', 'text', 'reason'}; reason is the line's tag, or 'orphan' for a
+    continuation line with no main line before it.
+    """
+    row = None
+    first = last = 0
+    recipient = []
+    for number, line in _lines(text):
+        tag, match = classify_line(line)
+        if tag == CONTINUATION and row is not None:
+            recipient.append(line)
+            last = number
+            continue
+        if row is not None:
+            row["Rechnungsempfängers"] = " ".join(recipient).strip()
+            yield first, last, row
+            row = None
+        if tag == MAIN:
+            row = {
+                "Name": match.group('name').strip(),
+                "Rechnungs-Nr. DZR": match.group('rechnungs_nr').strip(),
+                "Ihre Rechnungs-Nr.": match.group('ihre_nr').strip(),
+                "Betrag": match.group('betrag').strip(),
+            }
+            first = last = number
+            recipient = []
+        elif skipped is not None:
+            skipped.append({'line': number, 'text': line, 'reason': 'orphan' if tag == CONTINUATION else tag})
+    if row is not None:
+        row["Rechnungsempfängers"] = " ".join(recipient).strip()
+        yield first, last, row
+
+
+def iter_entries(text: str, skipped: Optional[List[Dict]] = None) -> Iterator[Dict[str, str]]:
+    # One row per main line, with the continuation lines after it as Rechnungsempfängers
+    for _, _, row in iter_numbered_entries(text, skipped):
+        yield row
+
+
+def parse_entries(text: str) -> Tuple[List[Dict[str, str]], List[Dict]]:
+    # (rows, skipped lines)
+    skipped = []
+    rows = list(iter_entries(text, skipped))
+    return rows, skipped
+
 
 def extract_ab_und_zusetzungen(text: str) -> Tuple[List[Dict[str, str]], bool]:
-    main_row_pattern = re.compile(
-        r"^(.+?)\s+(\d{4,10}/\d{2}/\d{4})\s+([\d\s\(\)A-Za-z]+?)\s+(-?\d{1,3}(?:\.\d{3})*(?:,\d+))$"
-    )
-    malformed_main_row_pattern = re.compile(
-        r"^(.+?)\s+\(\)\s+[\d\s\(\)A-Za-z]*\s*-?\d{1,3}(?:\.\d{3})*(?:,\d+)$"
-    )
-
-    rows = []
-    skipped_any = False
-    lines = [line.strip() for line in text.split('\n') if line.strip()]
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        if main_row_pattern.match(line):
-            name, rechnungs_nr, ihre_nr, betrag = main_row_pattern.match(line).groups()
-            rechnungsempf = []
-            j = i + 1
-            while j < len(lines):
-                next_line = lines[j]
-                if (
-                    main_row_pattern.match(next_line) or
-                    malformed_main_row_pattern.match(next_line) or
-                    next_line.startswith("---") or
-                    "Betrag" in next_line or
-                    "Rechnungsempfängers" in next_line or
-                    re.match(r".*\(\)\s*-?\d{1,3}(?:\.\d{3})*(?:,\d+)$", next_line)
-                ):
-                    break
-                rechnungsempf.append(next_line)
-                j += 1
-            rows.append({
-                "Name": name.strip(),
-                "Rechnungs-Nr. DZR": rechnungs_nr.strip(),
-                "Ihre Rechnungs-Nr.": ihre_nr.strip(),
-                "Betrag": betrag.strip(),
-                "Rechnungsempfängers": " ".join(rechnungsempf).strip()
-            })
-            i = j
-        else:
-            # More generic: flag if we skip ANY line that isn't matched as a main row
-            skipped_any = True
-            i += 1
-    return rows, skipped_any
+    rows, skipped = parse_entries(text)
+    # Flag if we skip ANY line that isn't part of a row
+    return rows, bool(skipped)
@@ -0,0 +1,104 @@
+import logging
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from ai_parser import AI_ERROR, parse_fragments_with_ai
+from extract_entries_from_ab_block import HEADER, MALFORMED, SEPARATOR, iter_numbered_entries
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ["Name", "Rechnungsempfängers", "Rechnungs-Nr. DZR", "Ihre Rechnungs-Nr.", "Betrag"]
+RECHNUNGS_NR_PATTERN = re.compile(r"\d{4,10}/\d{2}/\d{4}")
+AMOUNT_PATTERN = re.compile(r"-?\d{1,3}(?:\.\d{3})*(?:,\d+)")
+# Skips that are layout, not entries: '---' separators and the column headers
+# repeated at the top of every continued page
+LAYOUT_REASONS = (SEPARATOR, HEADER)
+
+
+def needs_ai(skipped: List[Dict]) -> bool:
+    # True if the regex parser skipped anything besides layout lines
+    return any(line['reason'] not in LAYOUT_REASONS for line in skipped)
+
+
+def fragments_of(skipped: List[Dict]) -> List[List[Dict]]:
+    # Runs of skipped lines with consecutive line numbers; layout lines are never sent
+    fragments = []
+    previous = None
+    for line in skipped:
+        if line['reason'] in LAYOUT_REASONS:
+            continue
+        if fragments and previous is not None and line['line'] == previous + 1:
+            fragments[-1].append(line)
+        else:
+            fragments.append([line])
+        previous = line['line']
+    return fragments
+
+
+def expected_entries(fragment: List[Dict]) -> int:
+    # Every malformed line is a main line (it ends in an amount), so one entry each
+    return sum(1 for line in fragment if line['reason'] == MALFORMED)
+
+
+def context_of(lines: List[str], fragment: List[Dict], skipped_numbers: Set[int]) -> Tuple[str, str]:
+    # The nearest lines before and after the fragment that the regex parser did read ('' if none);
+    # lines is the block split on '\n', so line numbers index it directly
+    def parsed_line(number, step):
+        number += step
+        while 1 <= number <= len(lines):
+            if number not in skipped_numbers and lines[number - 1].strip():
+                return lines[number - 1].strip()
+            number += step
+        return ''
+
+    return parsed_line(fragment[0]['line'], -1), parsed_line(fragment[-1]['line'], 1)
+
+
+def valid_ai_entry(entry) -> bool:
+    # The AI may only add entries the regex parser would have accepted, field for field
+    if not isinstance(entry, dict):
+        return False
+    if not all(isinstance(entry.get(field), str) and entry[field].strip() for field in REQUIRED_FIELDS):
+        return False
+    return bool(RECHNUNGS_NR_PATTERN.fullmatch(entry["Rechnungs-Nr. DZR"].strip())
+                and AMOUNT_PATTERN.fullmatch(entry["Betrag"].strip()))
+
+
+def hybrid_parse(block: str, deadline: Optional[float] = None) -> Tuple[List[Dict[str, str]], List[Dict], bool]:
+    """Parse a block with the regex parser and send only the lines it skipped to the AI.
+
+    Skipped lines are grouped into fragments of neighbouring lines and all
+    fragments of a file go out in one request, each with the parsed line
+    before and after it as context. A fragment counts as resolved when the
+    AI returns exactly one valid entry per main line in it; its entries are
+    merged in where the fragment stood. Fewer (or more) leave the whole
+    fragment unresolved, so the file is flagged instead of losing entries.
+    deadline is passed on to ai_parser.ask_ai. Returns (rows, unresolved skipped lines, ai_error); a
+    file whose only skipped lines are separators and repeated headers never
+    calls the AI, and those lines are never reported as unresolved.
+    """
+    skipped = []
+    numbered = [(first, row) for first, _, row in iter_numbered_entries(block, skipped)]
+    fragments = fragments_of(skipped)
+    if not fragments:
+        return [row for _, row in numbered], [], False
+
+    logger.info('AI fallback: sending %d of %d lines', sum(len(f) for f in fragments), block.count('\n') + 1)
+    lines = block.split('\n')
+    skipped_numbers = {line['line'] for line in skipped}
+    answers = parse_fragments_with_ai([[line['text'] for line in fragment] for fragment in fragments], deadline,
+                                      [context_of(lines, fragment, skipped_numbers) for fragment in fragments])
+    if answers == AI_ERROR:
+        return [row for _, row in numbered], [line for fragment in fragments for line in fragment], True
+
+    unresolved = []
+    for number, fragment in enumerate(fragments, start=1):
+        entries = [{field: entry[field].strip() for field in REQUIRED_FIELDS}
+                   for entry in answers.get(number, []) if valid_ai_entry(entry)]
+        if entries and len(entries) == expected_entries(fragment):
+            numbered.extend((fragment[0]['line'], entry) for entry in entries)
+        else:
+            unresolved.extend(fragment)
+    # Stable sort keeps the AI's order within a fragment
+    numbered.sort(key=lambda item: item[0])
+    return [row for _, row in numbered], unresolved, False
@@ -0,0 +1,306 @@
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from ai_parser import AI_UPLOAD_DEADLINE_S, ai_map
+from dedup_index import dedup_key
+from hybrid_parser import LAYOUT_REASONS, hybrid_parse, needs_ai
+from metrics import count_upload
+from normalize import normalize_rows
+from profiling import note_file
+from rows_query import query_fields
+
+CSV_COLUMNS = [
+    'Name',
+    'Rechnungsempfängers',
+    'Rechnungs-Nr. DZR',
+    'Ihre Rechnungs-Nr.',
+    'Betrag',
+    'Billing Date',
+    'notes',
+    'starred',
+    'assigned_to',
+    'handled_by',
+    'archive_result'
+]
+REQUIRED_FIELDS = ["Name", "Rechnungsempfängers", "Rechnungs-Nr. DZR", "Ihre Rechnungs-Nr.", "Betrag"]
+
+# Uploads up to this size are parsed straight from memory; larger ones spill to a temp file
+UPLOAD_SPOOL_BYTES = int(os.getenv('UPLOAD_SPOOL_BYTES', str(8 * 1024 * 1024)))
+# Whole requests above this size are rejected with 413 before any parsing
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(200 * 1024 * 1024)))
+READ_CHUNK_BYTES = 64 * 1024
+# Send the lines the regex parser skipped to the AI instead of flagging the file right away
+AI_FALLBACK = os.getenv('AI_FALLBACK', '0').lower() in ('1', 'true', 'yes')
+# Fallback answer of a file the upload's AI deadline cut off; it is flagged for review instead
+AI_TIMED_OUT = '__AI_TIMED_OUT__'
+
+logger = logging.getLogger(__name__)
+# Label of this pipeline's upload counters on /metrics
+METRICS_APP = 'backend2'
+
+# Dedup lookups and the writes they guard must not interleave between
+# concurrent uploads and jobs in the same process
+_write_lock = threading.Lock()
+
+
+def read_uploads(files):
+    """Read Werkzeug uploads into parser sources without touching disk for small files.
+
+    Each source is the file's bytes, or, once a file grows past
+    UPLOAD_SPOOL_BYTES, the path of a temp file it was spilled to. Returns
+    (sources, spilled_paths); the caller removes spilled_paths when done.
+    """
+    sources = []
+    spilled_paths = []
+    try:
+        for file in files:
+            buffer = io.BytesIO()
+            spill = None
+            for chunk in iter(lambda: file.stream.read(READ_CHUNK_BYTES), b''):
+                if spill is None and buffer.tell() + len(chunk) > UPLOAD_SPOOL_BYTES:
+                    spill = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+                    spilled_paths.append(spill.name)
+                    spill.write(buffer.getvalue())
+                    buffer = None
+                (spill or buffer).write(chunk)
+            if spill is not None:
+                spill.close()
+                sources.append(spill.name)
+            else:
+                sources.append(buffer.getvalue())
+    except Exception:
+        remove_files(spilled_paths)
+        raise
+    return sources, spilled_paths
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def wants_ai_fallback(parsed_file: Dict) -> bool:
+    # Line numbers of table-mode skips do not refer to the text block, so only text mode falls back;
+    # separators and headers repeated on continued pages are not missing entries
+    return (AI_FALLBACK and bool(parsed_file['block']) and parsed_file['skipped_any']
+            and parsed_file.get('extraction', 'text') == 'text' and needs_ai(parsed_file.get('skipped_lines', [])))
+
+
+def ai_fallback(parsed_file: Dict, deadline: float):
+    """hybrid_parse's (rows, unresolved lines, ai_error) for one file, within the upload's deadline.
+
+    None if the file needs no AI; AI_TIMED_OUT if the deadline passed before
+    or while asking.
+    """
+    if not wants_ai_fallback(parsed_file):
+        return None
+    if time.monotonic() >= deadline:
+        return AI_TIMED_OUT
+    answer = hybrid_parse(parsed_file['block'], deadline)
+    if answer[2] and time.monotonic() >= deadline:
+        return AI_TIMED_OUT
+    return answer
+
+
+def rows_for_file(parsed_file: Dict, fallback=None):
+    """Validate one parsed file and turn its entries into invoice rows.
+
+    fallback is ai_fallback()'s answer for the file (None if it was not
+    asked). Returns (rows, invalid_files, incomplete_entries_with_names)
+    for the file.
+    """
+    filename = parsed_file['filename']
+    block = parsed_file['block']
+    billing_date = parsed_file['billing_date']
+    invalid_files = []
+    incomplete_entries_with_names = []
+    logger.debug("BLOCK EXTRACTED for %s:\n%s", filename, block)
+    if not block:
+        invalid_files.append({"filename": filename, "reason": "no_data"})
+        return [], invalid_files, incomplete_entries_with_names
+    parsed_list, skipped_any = parsed_file['entries'], parsed_file['skipped_any']
+    skipped_lines = parsed_file.get('skipped_lines', [])
+    if AI_FALLBACK and skipped_any and parsed_file.get('extraction', 'text') == 'text':
+        if fallback == AI_TIMED_OUT or (fallback is None and needs_ai(skipped_lines)):
+            # No answer in time: keep the regex rows and flag the file for review
+            skipped_lines = [line for line in skipped_lines if line['reason'] not in LAYOUT_REASONS]
+        elif fallback is None:
+            # Only separators and repeated page headers were skipped
+            skipped_lines = []
+        else:
+            parsed_list, skipped_lines, ai_failed = fallback
+            if ai_failed:
+                # Retries are used up; the other files still go in
+                invalid_files.append({"filename": filename, "reason": "ai_error"})
+                return [], invalid_files, incomplete_entries_with_names
+        skipped_any = bool(skipped_lines)
+    logger.debug("REGEX RESPONSE for %s: %s", filename, parsed_list)
+    if not parsed_list or not isinstance(parsed_list, list) or len(parsed_list) == 0:
+        logger.info("Regex returned empty or invalid list for %s", filename)
+        invalid_files.append({"filename": filename, "reason": "no_data"})
+        return [], invalid_files, incomplete_entries_with_names
+    # If any required entry is missing/empty, skip file
+    if not all(
+        isinstance(entry, dict) and all(entry.get(field, '').strip() for field in REQUIRED_FIELDS)
+        for entry in parsed_list
+    ):
+        logger.info("Regex returned incomplete entry for %s", filename)
+        invalid_files.append({"filename": filename, "reason": "incomplete_entry"})
+        return [], invalid_files, incomplete_entries_with_names
+    # If any lines were skipped, mark for manual review and provide added names
+    if skipped_any:
+        for skipped in skipped_lines:
+            logger.info("Skipped line %s (%s) in %s: %s", skipped['line'], skipped['reason'], filename, skipped['text'])
+        names_found = [row['Name'] for row in parsed_list]
+        incomplete_entries_with_names.append({
+            "filename": filename,
+            "added_names": names_found
+        })
+        invalid_files.append({"filename": filename, "reason": "incomplete_entry"})
+    rows = []
+    for parsed in parsed_list:
+        row = {col: parsed.get(col, '') for col in CSV_COLUMNS}
+        logger.debug("ROW TO BE ADDED for %s: %s", filename, row)
+        row['Billing Date'] = billing_date
+        row['notes'] = ""
+        row['starred'] = False
+        row['assigned_to'] = ""
+        row.update(query_fields(row))
+        # Betrag, invoice numbers and dates are normalized per batch in normalized_rows
+        rows.append(row)
+    return rows, invalid_files, incomplete_entries_with_names
+
+
+def normalized_rows(rows, filename_of):
+    """Normalize a batch of rows in one pass; returns (storable rows, invalid_rows report).
+
+    Betrag becomes the display string plus integer 'betrag_cents'; rows with
+    a field that cannot be normalized are reported instead of stored.
+    """
+    normalized, errors = normalize_rows(rows)
+    bad = {error['index'] for error in errors}
+    for row, original in zip(normalized, rows):
+        filename_of[id(row)] = filename_of.get(id(original))
+    report = [{
+        'filename': filename_of.get(id(rows[error['index']])),
+        'Name': rows[error['index']].get('Name', ''),
+        'Ihre Rechnungs-Nr.': rows[error['index']].get('Ihre Rechnungs-Nr.', ''),
+        'field': error['field'],
+        'value': error['value'],
+        'error': error['error'],
+    } for error in errors]
+    for entry in report:
+        logger.info("Invalid %s in %s: %r", entry['field'], entry['filename'], entry['value'])
+    return [row for index, row in enumerate(normalized) if index not in bad], report
+
+
+def _failed_rows_report(failed, filename_of):
+    return [{
+        'filename': filename_of[id(f['row'])],
+        'Name': f['row'].get('Name', ''),
+        'Ihre Rechnungs-Nr.': f['row'].get('Ihre Rechnungs-Nr.', ''),
+        'error': f['error']
+    } for f in failed]
+
+
+def _new_rows(storage, rows, seen_nr_betrag):
+    # Only look up the keys these rows are about to insert
+    existing_nr_betrag = storage.existing_keys(dedup_key(row) for row in rows)
+    new_rows = []
+    for row in rows:
+        key = dedup_key(row)
+        if not key[0] or key in existing_nr_betrag or key in seen_nr_betrag:
+            continue  # Skip duplicate or empty
+        new_rows.append(row)
+        seen_nr_betrag.add(key)  # Prevent duplicates within this batch
+    return new_rows
+
+
+def ingest_parsed_files(storage, parsed_files: Iterable[Dict], commit_each_file=False):
+    """Dedup and store parsed files; yields one event per file, then a summary.
+
+    With commit_each_file=False all rows are committed together after the last
+    file (fewest batches) and only the summary is yielded. With
+    commit_each_file=True each file is committed and reported as soon as it
+    is parsed, which is what the streaming and job endpoints need.
+    With AI_FALLBACK, all AI calls of the upload share AI_UPLOAD_DEADLINE_S;
+    files it cuts off keep their regex rows and are flagged incomplete_entry.
+    """
+    summary = {
+        'type': 'summary',
+        'data': [],
+        'invalid_files': [],
+        'incomplete_entries_with_names': [],
+        'failed_rows': [],
+        'invalid_rows': [],
+        # At least one file could not be parsed by the AI fallback (listed with reason 'ai_error')
+        'ai_error': False,
+    }
+    pending_rows = []
+    filename_of = {}
+    # Keys inserted by this request, so one upload cannot duplicate itself
+    seen_nr_betrag = set()
+    # All AI fallback calls of this upload share one deadline, like backend.py's
+    deadline = time.monotonic() + AI_UPLOAD_DEADLINE_S
+    answers = None
+    if AI_FALLBACK and not commit_each_file:
+        # Every file is parsed already: ask for all of them side by side
+        parsed_files = list(parsed_files)
+        answers = iter(ai_map(ai_fallback, parsed_files, default=AI_TIMED_OUT,
+                              deadline_s=deadline - time.monotonic()))
+    for parsed_file in parsed_files:
+        filename = parsed_file['filename']
+        # Streamed files are asked about as they arrive, still within the upload's deadline
+        fallback = next(answers) if answers is not None else ai_fallback(parsed_file, deadline)
+        file_rows, invalid_files, incomplete = rows_for_file(parsed_file, fallback)
+        summary['invalid_files'].extend(invalid_files)
+        summary['incomplete_entries_with_names'].extend(incomplete)
+        summary['ai_error'] = summary['ai_error'] or any(f['reason'] == 'ai_error' for f in invalid_files)
+        count_upload(METRICS_APP, files=1, rows=len(file_rows), invalid_files=invalid_files)
+        note_file(parsed_file, rows=len(file_rows), skipped_lines=len(parsed_file.get('skipped_lines') or []),
+                  invalid=[f['reason'] for f in invalid_files])
+        for row in file_rows:
+            filename_of[id(row)] = filename
+        if not commit_each_file:
+            pending_rows.extend(file_rows)
+            continue
+        file_rows, invalid_rows = normalized_rows(file_rows, filename_of)
+        with _write_lock:
+            new_rows = _new_rows(storage, file_rows, seen_nr_betrag)
+            written, failed = storage.add_rows(new_rows)
+        count_upload(METRICS_APP, duplicates=len(file_rows) - len(new_rows), written=len(written), failed=len(failed))
+        failed_rows = _failed_rows_report(failed, filename_of)
+        summary['data'].extend(written)
+        summary['failed_rows'].extend(failed_rows)
+        summary['invalid_rows'].extend(invalid_rows)
+        yield {
+            'type': 'file',
+            'filename': filename,
+            'data': written,
+            'duplicates': len(file_rows) - len(new_rows),
+            'invalid_files': invalid_files,
+            'incomplete_entries_with_names': incomplete,
+            'failed_rows': failed_rows,
+            'invalid_rows': invalid_rows,
+        }
+    if pending_rows:
+        # The whole upload is normalized in one batch
+        pending_rows, invalid_rows = normalized_rows(pending_rows, filename_of)
+        summary['invalid_rows'].extend(invalid_rows)
+        with _write_lock:
+            new_rows = _new_rows(storage, pending_rows, seen_nr_betrag)
+            # One round trip per batch instead of one per row
+            written, failed = storage.add_rows(new_rows)
+        count_upload(METRICS_APP, duplicates=len(pending_rows) - len(new_rows), written=len(written),
+                     failed=len(failed))
+        summary['data'].extend(written)
+        summary['failed_rows'].extend(_failed_rows_report(failed, filename_of))
+    yield summary
@@ -0,0 +1,254 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from ingest import ingest_parsed_files
+from parse_pool import iter_parse_files
+
+logger = logging.getLogger(__name__)
+
+# Uploaded files wait here until a worker picks the job up
+SPOOL_DIR = os.getenv('INGEST_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'dzr-spool'))
+JOBS_DB_PATH = os.getenv('INGEST_JOBS_DB', os.path.join(SPOOL_DIR, 'jobs.sqlite3'))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '2'))
+# Every process stamps the jobs it runs this often, however long a single file takes
+HEARTBEAT_SECONDS = float(os.getenv('INGEST_HEARTBEAT_SECONDS', '15'))
+# A running job whose owner has not stamped it for this long belongs to a dead process and is re-queued
+STALE_JOB_SECONDS = int(os.getenv('INGEST_STALE_JOB_SECONDS', '120'))
+POLL_SECONDS = 2.0
+
+
+class JobStore:
+    """SQLite-backed job queue, shared by every gunicorn worker on the host."""
+
+    def __init__(self, path=JOBS_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY,'
+                ' status TEXT NOT NULL,'
+                ' files TEXT NOT NULL,'
+                ' total_files INTEGER NOT NULL,'
+                ' processed_files INTEGER NOT NULL DEFAULT 0,'
+                ' file_results TEXT NOT NULL DEFAULT \'[]\','
+                ' result TEXT,'
+                ' error TEXT,'
+                ' created_at REAL NOT NULL,'
+                ' updated_at REAL NOT NULL,'
+                ' owner TEXT,'
+                ' heartbeat_at REAL)'
+            )
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            # Queues created before jobs had owners
+            for column, kind in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {kind}')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def create(self, job_id: str, files: List[Dict]):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, status, files, total_files, created_at, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(files), len(files), now, now)
+            )
+
+    def claim(self, owner: str) -> Optional[Dict]:
+        # Atomically move the oldest queued job to running, owned by this run
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT id, files FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, heartbeat_at = ?, updated_at = ? WHERE id = ?",
+                (owner, now, now, row['id'])
+            )
+            conn.execute('COMMIT')
+        return {'id': row['id'], 'files': json.loads(row['files']), 'owner': owner}
+
+    def add_file_result(self, job_id: str, owner: str, file_result: Dict) -> bool:
+        # False if the job no longer belongs to owner; nothing is recorded then
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT file_results FROM jobs WHERE id = ? AND owner = ? AND status = 'running'", (job_id, owner)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return False
+            results = json.loads(row['file_results'])
+            results.append(file_result)
+            conn.execute(
+                'UPDATE jobs SET file_results = ?, processed_files = ?, updated_at = ? WHERE id = ?',
+                (json.dumps(results), len(results), time.time(), job_id)
+            )
+            conn.execute('COMMIT')
+        return True
+
+    def finish(self, job_id: str, owner: str, result: Dict = None, error: str = None) -> bool:
+        # False if the job no longer belongs to owner (it was re-queued); it is left alone then
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?"
+                " WHERE id = ? AND owner = ? AND status = 'running'",
+                ('failed' if error else 'done', json.dumps(result) if result is not None else None,
+                 error, time.time(), job_id, owner)
+            )
+            return cursor.rowcount == 1
+
+    def heartbeat(self, owners: List[str]):
+        # Running jobs of a live process stay its own, however slow their files are
+        if not owners:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET heartbeat_at = ? WHERE status = 'running'"
+                f" AND owner IN ({', '.join('?' * len(owners))})",
+                (time.time(), *owners)
+            )
+
+    def requeue_stale(self, max_age=STALE_JOB_SECONDS):
+        # Only jobs whose owner stopped sending heartbeats, i.e. whose process is gone
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, processed_files = 0, file_results = '[]'"
+                " WHERE status = 'running' AND IFNULL(heartbeat_at, updated_at) < ?",
+                (time.time() - max_age,)
+            )
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'status': row['status'],
+            'total_files': row['total_files'],
+            'processed_files': row['processed_files'],
+            'files': [f['filename'] for f in json.loads(row['files'])],
+            'file_results': json.loads(row['file_results']),
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+        }
+
+
+class IngestWorkers:
+    """Background threads that run queued jobs through the regular upload pipeline.
+
+    PDF parsing still happens in the parse_pool processes; these threads only
+    drive the pipeline and record progress, so a small pool is enough.
+    """
+
+    def __init__(self, storage, store: JobStore, workers=INGEST_WORKERS):
+        self._storage = storage
+        self.store = store
+        self._workers = workers
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        # Owner tokens of the jobs this process is running, stamped by the heartbeat thread
+        self._running = set()
+
+    def submit(self, files) -> str:
+        """Spool Werkzeug uploads to disk, queue a job and return its ID."""
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(SPOOL_DIR, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        spooled = []
+        try:
+            for n, file in enumerate(files):
+                path = os.path.join(job_dir, f'{n}.pdf')
+                file.save(path)
+                spooled.append({'path': path, 'filename': file.filename})
+            self.store.create(job_id, spooled)
+        except Exception:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def start(self):
+        # Started on first use so the threads live in the gunicorn worker, not the master
+        with self._lock:
+            if self._threads:
+                return
+            self.store.requeue_stale()
+            threads = [threading.Thread(target=self._heartbeat, name='ingest-heartbeat', daemon=True)]
+            threads += [threading.Thread(target=self._run, name=f'ingest-worker-{n}', daemon=True)
+                        for n in range(self._workers)]
+            for thread in threads:
+                thread.start()
+                self._threads.append(thread)
+
+    def _heartbeat(self):
+        while True:
+            try:
+                self.store.heartbeat(list(self._running))
+                # Jobs of processes that died are picked up by whoever is still alive
+                self.store.requeue_stale()
+            except Exception:
+                logger.exception('Ingest job heartbeat failed')
+            time.sleep(HEARTBEAT_SECONDS)
+
+    def _run(self):
+        while True:
+            job = self.store.claim(f'{os.getpid()}-{uuid.uuid4().hex}')
+            if job is None:
+                self._wakeup.wait(POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+            self.run_job(job)
+
+    def run_job(self, job: Dict):
+        job_id, owner = job['id'], job['owner']
+        pairs = [(f['path'], f['filename']) for f in job['files']]
+        self._running.add(owner)
+        owned = True
+        try:
+            events = ingest_parsed_files(self._storage, iter_parse_files(pairs), commit_each_file=True)
+            for event in events:
+                if event['type'] == 'file':
+                    owned = self.store.add_file_result(job_id, owner, event)
+                else:
+                    owned = self.store.finish(job_id, owner, result=event)
+                if not owned:
+                    # Re-queued and taken by another run: stop writing, its spool files are not ours
+                    logger.warning("Ingest job %s is no longer owned by this run; stopping", job_id)
+                    break
+        except Exception as e:
+            logger.exception("Ingest job %s failed", job_id)
+            owned = self.store.finish(job_id, owner, error=str(e))
+        finally:
+            self._running.discard(owner)
+            # Only the run that owns the job may remove its files
+            if owned:
+                shutil.rmtree(os.path.join(SPOOL_DIR, job_id), ignore_errors=True)
@@ -0,0 +1,358 @@
+import copy
+import datetime
+import threading
+import uuid
+from typing import Dict, List, Optional
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.field_path import FieldPath, split_field_path
+
+# Firestore rejects a WriteBatch or transaction with more than 500 operations
+MAX_WRITES = 500
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array_contains': lambda a, b: b in (a or []),
+    'array_contains_any': lambda a, b: any(x in (a or []) for x in b),
+}
+
+
+def _field_name(field_path: str) -> str:
+    # Parsed like the SDK's select() and order_by(): names with spaces, dots or dashes
+    # must come quoted (FieldPath(name).to_api_repr()), or this raises ValueError.
+    # Only top-level fields are supported.
+    split_field_path(field_path)
+    return '.'.join(FieldPath.from_api_repr(field_path).parts)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _apply(current: Optional[Dict], data: Dict, merge: bool, deep: bool = False) -> Dict:
+    # Resolve SERVER_TIMESTAMP, DELETE_FIELD, ArrayUnion/ArrayRemove and Increment like the server does.
+    # deep: set(merge=True) merges nested maps field by field, update() replaces them.
+    result = copy.deepcopy(current) if (merge and current is not None) else {}
+    for key, value in data.items():
+        old = result.get(key)
+        if deep and isinstance(value, dict):
+            result[key] = _apply(old if isinstance(old, dict) else None, value, True, deep=True)
+        elif value is firestore.SERVER_TIMESTAMP:
+            result[key] = _now()
+        elif value is firestore.DELETE_FIELD:
+            result.pop(key, None)
+        elif isinstance(value, firestore.ArrayUnion):
+            items = list(old) if isinstance(old, list) else []
+            items.extend(v for v in value.values if v not in items)
+            result[key] = items
+        elif isinstance(value, firestore.ArrayRemove):
+            result[key] = [v for v in (old if isinstance(old, list) else []) if v not in value.values]
+        elif isinstance(value, firestore.Increment):
+            result[key] = (old if isinstance(old, (int, float)) else 0) + value.value
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+
+class MemorySnapshot:
+    def __init__(self, reference, data: Optional[Dict], update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+        self.create_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class MemoryDocument:
+    def __init__(self, db, collection: str, doc_id: str):
+        self._db = db
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection}/{self.id}"
+
+    def get(self, field_paths=None, transaction=None) -> MemorySnapshot:
+        return self._db._read(self._collection, self.id)
+
+    def set(self, data: Dict, merge=False):
+        batch = self._db.batch()
+        batch.set(self, data, merge=merge)
+        batch.commit()
+
+    def update(self, data: Dict):
+        batch = self._db.batch()
+        batch.update(self, data)
+        batch.commit()
+
+    def delete(self):
+        batch = self._db.batch()
+        batch.delete(self)
+        batch.commit()
+
+
+class MemoryQuery:
+    def __init__(self, db, collection: str, filters=(), orders=(), limit=None, start_after=None, fields=None):
+        self._db = db
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._fields = fields
+
+    def _copy(self, **changes) -> 'MemoryQuery':
+        state = {'filters': self._filters, 'orders': self._orders, 'limit': self._limit,
+                 'start_after': self._start_after, 'fields': self._fields}
+        state.update(changes)
+        return MemoryQuery(self._db, self._collection, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None) -> 'MemoryQuery':
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=firestore.Query.ASCENDING) -> 'MemoryQuery':
+        return self._copy(orders=self._orders + ((_field_name(field_path), direction),))
+
+    def limit(self, count: int) -> 'MemoryQuery':
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot) -> 'MemoryQuery':
+        return self._copy(start_after=snapshot)
+
+    def select(self, field_paths) -> 'MemoryQuery':
+        return self._copy(fields=[_field_name(field_path) for field_path in field_paths])
+
+    def _sort_key(self, doc_id: str, data: Dict):
+        key = []
+        for field, direction in self._orders:
+            value = doc_id if field == '__name__' else data.get(field)
+            key.append(_Ordered(value, direction == firestore.Query.DESCENDING))
+        key.append(_Ordered(doc_id, False))
+        return key
+
+    def stream(self, transaction=None):
+        with self._db._lock:
+            self._db.reads += 1
+            docs = [(doc_id, copy.deepcopy(data), self._db._times.get((self._collection, doc_id)))
+                    for doc_id, data in self._db._data.get(self._collection, {}).items()]
+        matches = []
+        for doc_id, data, update_time in docs:
+            if not all(_OPERATORS[op](data.get(field), value) for field, op, value in self._filters):
+                continue
+            # Like Firestore, ordering on a field drops documents that lack it
+            if any(field != '__name__' and field not in data for field, _ in self._orders):
+                continue
+            matches.append((doc_id, data, update_time))
+        matches.sort(key=lambda doc: self._sort_key(doc[0], doc[1]))
+        if self._start_after is not None:
+            cursor = self._sort_key(self._start_after.id, self._start_after.to_dict() or {})
+            matches = [doc for doc in matches if self._sort_key(doc[0], doc[1]) > cursor]
+        if self._limit is not None:
+            matches = matches[:self._limit]
+        for doc_id, data, update_time in matches:
+            if self._fields is not None:
+                data = {k: v for k, v in data.items() if k in self._fields}
+            yield MemorySnapshot(MemoryDocument(self._db, self._collection, doc_id), data, update_time)
+
+    def get(self, transaction=None) -> List[MemorySnapshot]:
+        return list(self.stream(transaction=transaction))
+
+
+class _Ordered:
+    # Sort wrapper: None first, then by type name, then by value; optionally reversed
+    def __init__(self, value, descending: bool):
+        self.key = (value is not None, type(value).__name__, value) if value is not None else (False, '', 0)
+        self.descending = descending
+
+    def __lt__(self, other):
+        return self.key > other.key if self.descending else self.key < other.key
+
+    def __gt__(self, other):
+        return other < self
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class MemoryCollection(MemoryQuery):
+    def __init__(self, db, name: str):
+        super().__init__(db, name)
+        self.id = name
+
+    def document(self, document_id: Optional[str] = None) -> MemoryDocument:
+        return MemoryDocument(self._db, self._collection, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, data: Dict):
+        ref = self.document()
+        ref.set(data)
+        return _now(), ref
+
+
+class MemoryWriteBatch:
+    """Collects writes and applies them all or none, like a Firestore WriteBatch."""
+
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data: Dict, merge=False):
+        self._writes.append(('set', reference, data, merge))
+
+    def create(self, reference, data: Dict):
+        self._writes.append(('create', reference, data, False))
+
+    def update(self, reference, data: Dict):
+        self._writes.append(('update', reference, data, True))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, False))
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._db._commit(writes)
+        return []
+
+
+class MemoryTransaction(MemoryWriteBatch):
+    """Enough of google.cloud.firestore.Transaction for the @firestore.transactional decorator.
+
+    Transactions are serialized with a lock, so reads inside one never see a
+    concurrent write and there is nothing to retry.
+    """
+
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db._transaction_lock.acquire()
+        self._id = uuid.uuid4().hex.encode('ascii')
+
+    def _commit(self):
+        try:
+            self.commit()
+        finally:
+            self._release()
+
+    def _rollback(self):
+        self._writes = []
+        self._release()
+
+    def _release(self):
+        if self._id is not None:
+            self._id = None
+            self._db._transaction_lock.release()
+
+
+class MemoryFirestore:
+    """In-memory stand-in for a firestore.client(), for benchmarks and local runs without credentials.
+
+    Supports what this backend uses: documents, queries with FieldFilter,
+    order_by/limit/start_after/select, get_all, write batches, transactions
+    and the SERVER_TIMESTAMP / ArrayUnion / ArrayRemove / Increment values.
+    Counts reads, writes and commits so callers can report round trips.
+    """
+
+    def __init__(self):
+        self._data = {}  # collection -> {doc id: dict}
+        self._times = {}  # (collection, doc id) -> update time
+        self._lock = threading.Lock()
+        self._transaction_lock = threading.RLock()
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+
+    def collection(self, name: str) -> MemoryCollection:
+        return MemoryCollection(self, name)
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    def transaction(self, **kwargs) -> MemoryTransaction:
+        return MemoryTransaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for reference in references:
+            yield reference.get()
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+            self._times.clear()
+            self.reads = self.writes = self.commits = 0
+
+    def _read(self, collection: str, doc_id: str) -> MemorySnapshot:
+        with self._lock:
+            self.reads += 1
+            data = copy.deepcopy(self._data.get(collection, {}).get(doc_id))
+            update_time = self._times.get((collection, doc_id))
+        return MemorySnapshot(MemoryDocument(self, collection, doc_id), data, update_time)
+
+    def _commit(self, writes):
+        if len(writes) > MAX_WRITES:
+            raise ValueError(f'maximum {MAX_WRITES} writes allowed per request')
+        with self._lock:
+            # Work out every new state first, so a failing write leaves nothing behind
+            staged = {}
+            for kind, reference, data, merge in writes:
+                key = (reference._collection, reference.id)
+                current = staged[key] if key in staged else self._data.get(key[0], {}).get(key[1])
+                if kind == 'update' and current is None:
+                    raise KeyError(f'No document to update: {reference.path}')
+                if kind == 'create' and current is not None:
+                    raise KeyError(f'Document already exists: {reference.path}')
+                staged[key] = None if kind == 'delete' else _apply(current, data, merge, deep=kind == 'set' and merge)
+            now = _now()
+            for (collection, doc_id), data in staged.items():
+                if data is None:
+                    self._data.get(collection, {}).pop(doc_id, None)
+                    self._times.pop((collection, doc_id), None)
+                else:
+                    self._data.setdefault(collection, {})[doc_id] = data
+                    self._times[(collection, doc_id)] = now
+            self.writes += len(writes)
+            self.commits += 1
+
+
+def install_memory_firestore() -> MemoryFirestore:
+    """Make firebase_admin hand out one shared MemoryFirestore instead of a real client.
+
+    Call before importing backend.py / backend2.py; their credential loading
+    and initialize_app become no-ops.
+    """
+    db = MemoryFirestore()
+    credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: db
+    return db
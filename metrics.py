@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Tuple
+
+# Debug dumps of blocks, AI answers and rows are only written at LOG_LEVEL=DEBUG
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+# Libraries that log every parsed PDF object or connection at DEBUG
+QUIET_LOGGERS = ('pdfminer', 'pdfplumber', 'urllib3', 'PIL')
+
+# Stages of an upload, in order. Sizes are bytes for pdf_open, characters for
+# text_extraction (words in table mode), block_location and ai_call, rows for
+# row_parsing and firestore_write, and keys for dedup_load.
+STAGES = ('pdf_open', 'text_extraction', 'block_location', 'row_parsing', 'ai_call', 'dedup_load',
+          'firestore_write')
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+INF_LABEL = 'le="+Inf"'
+
+
+def configure_logging():
+    # Plain stderr logging for the app's own loggers; gunicorn collects stderr
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    logging.getLogger().setLevel(LOG_LEVEL)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def _label_text(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_label_text(self.labelnames, key)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float], labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], list] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in values:
+            for bound, count in zip(self.buckets, state):
+                le = _label_text(self.labelnames, key, f'le="{_number(bound)}"')
+                yield f"{self.name}_bucket{le} {count}"
+            yield f"{self.name}_bucket{_label_text(self.labelnames, key, INF_LABEL)} {state[-1]}"
+            yield f"{self.name}_sum{_label_text(self.labelnames, key)} {_number(state[-2])}"
+            yield f"{self.name}_count{_label_text(self.labelnames, key)} {state[-1]}"
+
+
+STAGE_SECONDS = Histogram('dzr_stage_duration_seconds', 'Time spent per upload stage.', DURATION_BUCKETS, ['stage'])
+STAGE_SIZE = Histogram('dzr_stage_size', 'Input size per upload stage (bytes, characters, rows or keys).',
+                       SIZE_BUCKETS, ['stage'])
+FILES = Counter('dzr_files_total', 'Uploaded PDF files processed.', ['app'])
+ROWS = Counter('dzr_rows_total', 'Rows parsed from uploaded files.', ['app'])
+DUPLICATES = Counter('dzr_duplicate_rows_total', 'Parsed rows skipped as duplicates.', ['app'])
+ROWS_WRITTEN = Counter('dzr_rows_written_total', 'Rows written to Firestore.', ['app'])
+ROWS_FAILED = Counter('dzr_rows_failed_total', 'Rows whose Firestore write failed.', ['app'])
+INVALID_FILES = Counter('dzr_invalid_files_total', 'Files rejected or flagged, by reason.', ['app', 'reason'])
+PARSE_CACHE_HITS = Counter('dzr_parse_cache_hits_total', 'Files served from the parse cache.')
+AI_ATTEMPTS = Counter('dzr_ai_attempts_total', 'HTTP attempts to the AI API, by outcome.', ['outcome'])
+REGISTRY = [STAGE_SECONDS, STAGE_SIZE, FILES, ROWS, DUPLICATES, ROWS_WRITTEN, ROWS_FAILED, INVALID_FILES,
+            PARSE_CACHE_HITS, AI_ATTEMPTS]
+
+
+def observe_stage(stage: str, seconds: float, size: Optional[float] = None):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if size is not None:
+        STAGE_SIZE.observe(size, stage=stage)
+
+
+def observe_stages(timings: Optional[Dict]):
+    # timings as collected by PdfSession / parse_pdf in a worker process: {stage: [seconds, size]}
+    for stage, (seconds, size) in (timings or {}).items():
+        observe_stage(stage, seconds, size)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """Time the with-block as one run of stage; set sample['size'] inside to record its size."""
+    sample = {'size': None}
+    start = time.perf_counter()
+    try:
+        yield sample
+    finally:
+        observe_stage(stage, time.perf_counter() - start, sample['size'])
+
+
+def add_timing(timings: Dict, stage: str, seconds: float, size: float = 0):
+    # Accumulate a stage that runs several times per file (e.g. once per page)
+    total = timings.setdefault(stage, [0.0, 0])
+    total[0] += seconds
+    total[1] += size
+
+
+def count_upload(app: str, files=0, rows=0, duplicates=0, written=0, failed=0, invalid_files=()):
+    # Upload counters; callers pass whatever part of an upload they just finished
+    FILES.inc(files, app=app)
+    ROWS.inc(rows, app=app)
+    DUPLICATES.inc(duplicates, app=app)
+    ROWS_WRITTEN.inc(written, app=app)
+    ROWS_FAILED.inc(failed, app=app)
+    for invalid in invalid_files:
+        INVALID_FILES.inc(app=app, reason=invalid.get('reason', ''))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format (per process; each gunicorn worker has its own)."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,175 @@
+import datetime
+import re
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+# '-1.234,56', '61,14', '49': dots group thousands, a comma starts the cents
+BETRAG_PATTERN = r'^[-+]?(?P<euros>\d{1,3}(?:\.\d{3})+|\d+)(?:,(?P<cents>\d{1,2}))?$'
+DZR_PATTERN = r'^[0-9/]+$'
+# '15.03.2024' / '15/03/2024' -> '2024-03-15'; ISO dates pass through
+GERMAN_DATE_PATTERN = r'^(\d{2})[./](\d{2})[./](\d{4})$'
+
+BETRAG_ERROR = 'Betrag must be a valid number'
+DZR_ERROR = 'Rechnungs-Nr. DZR must only contain numbers and /'
+BILLING_DATE_ERROR = 'Billing Date must be DD.MM.YYYY or YYYY-MM-DD'
+
+
+def format_betrag(cents: int) -> str:
+    # -123456 -> '-1.234,56', the display format rows have always been stored with
+    sign = '-' if cents < 0 else ''
+    euros, rest = divmod(abs(cents), 100)
+    return f"{sign}{euros:,}".replace(',', '.') + f",{rest:02d}"
+
+
+def parse_betrag_cents(betrag) -> Optional[int]:
+    # Scalar twin of the Betrag column in normalize_frame, for single stored rows
+    match = re.match(BETRAG_PATTERN, re.sub(r'\s+', '', str(betrag or '')))
+    if not match:
+        return None
+    cents = int(match['euros'].replace('.', '')) * 100 + int((match['cents'] or '').ljust(2, '0'))
+    return -cents
+
+
+def billing_date_iso(billing_date) -> str:
+    # Scalar twin of the billing_date_iso column in normalize_frame; '' unless a real date
+    iso = re.sub(GERMAN_DATE_PATTERN, r'\3-\2-\1', str(billing_date or '').strip())
+    try:
+        datetime.datetime.strptime(iso, '%Y-%m-%d')
+    except ValueError:
+        return ''
+    return iso
+
+
+def _text(frame: pd.DataFrame, column: str) -> pd.Series:
+    return frame[column].fillna('').astype(str).str.strip()
+
+
+def normalize_frame(frame: pd.DataFrame) -> pd.DataFrame:
+    """Vectorized normalization of the Betrag, invoice number and Billing Date columns.
+
+    Returns a frame with the normalized 'Betrag', 'betrag_cents' (always
+    negative, like the amounts on a statement's Ab-/Zusetzungen page),
+    'Rechnungs-Nr. DZR', 'Ihre Rechnungs-Nr.' and 'billing_date_iso', plus
+    one boolean '<field>_invalid' column per checked field.
+    """
+    out = pd.DataFrame(index=frame.index)
+
+    betrag = _text(frame, 'Betrag').str.replace(r'\s+', '', regex=True)
+    parts = betrag.str.extract(BETRAG_PATTERN)
+    out['Betrag_invalid'] = parts['euros'].isna()
+    euros = parts['euros'].fillna('0').str.replace('.', '', regex=False).astype('int64')
+    cents = parts['cents'].fillna('').str.ljust(2, '0').astype('int64')
+    out['betrag_cents'] = -(euros * 100 + cents)
+    out['Betrag'] = out['betrag_cents'].map(format_betrag)
+
+    for column in ('Rechnungs-Nr. DZR', 'Ihre Rechnungs-Nr.'):
+        out[column] = _text(frame, column).str.replace(r'\s+', ' ', regex=True)
+    out['Rechnungs-Nr. DZR_invalid'] = ~out['Rechnungs-Nr. DZR'].str.match(DZR_PATTERN)
+
+    billing_date = _text(frame, 'Billing Date')
+    iso = billing_date.str.replace(GERMAN_DATE_PATTERN, r'\3-\2-\1', regex=True)
+    # Real calendar dates only; an empty Billing Date (none found in the PDF) stays empty
+    parsed = pd.to_datetime(iso, format='%Y-%m-%d', errors='coerce')
+    out['Billing Date_invalid'] = parsed.isna() & (billing_date != '')
+    out['billing_date_iso'] = iso.where(parsed.notna(), '')
+    return out
+
+
+def normalize_rows(rows: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """Normalize a whole batch of rows at once; returns (normalized rows, errors).
+
+    Rows come back in order as copies with the normalized fields set. Each
+    error is {'index', 'field', 'value', 'error'} for a row whose field could
+    not be normalized; such rows keep their original values and should not
+    be stored.
+    """
+    if not rows:
+        return [], []
+    frame = pd.DataFrame.from_records(
+        [{column: row.get(column) for column in ('Betrag', 'Rechnungs-Nr. DZR', 'Ihre Rechnungs-Nr.', 'Billing Date')}
+         for row in rows]
+    )
+    out = normalize_frame(frame)
+    messages = {'Betrag': BETRAG_ERROR, 'Rechnungs-Nr. DZR': DZR_ERROR, 'Billing Date': BILLING_DATE_ERROR}
+    invalid = {field: out[f'{field}_invalid'].tolist() for field in messages}
+    columns = {column: out[column].tolist()
+               for column in ('Betrag', 'betrag_cents', 'Rechnungs-Nr. DZR', 'Ihre Rechnungs-Nr.', 'billing_date_iso')}
+
+    normalized = []
+    errors = []
+    for index, row in enumerate(rows):
+        row_errors = [{'index': index, 'field': field, 'value': row.get(field, ''), 'error': message}
+                      for field, message in messages.items() if invalid[field][index]]
+        row = dict(row)
+        if row_errors:
+            errors.extend(row_errors)
+        else:
+            row.update({column: values[index] for column, values in columns.items()})
+        normalized.append(row)
+    return normalized, errors
+
+
+def backfill_betrag_cents(db, chunk_size=498) -> int:
+    """Give rows stored before betrag_cents existed their numeric amount, chunk_size rows per change set.
+
+    Rows whose Betrag is not a valid amount are left alone. Each chunk is a
+    versioned write (see change_log.versioned_write), so delta clients pick
+    the new amounts up; chunk_size leaves room for the version counter and
+    the summary totals in one transaction.
+    """
+    # change_log imports summary_totals, which imports this module
+    from change_log import stamp, versioned_write
+    from summary_totals import add_to_summary, summary_delta
+
+    updated = 0
+    chunk = []
+
+    def amounts(docs):
+        frame = pd.DataFrame({'Betrag': [doc.to_dict().get('Betrag') for doc in docs],
+                              'Rechnungs-Nr. DZR': '', 'Ihre Rechnungs-Nr.': '', 'Billing Date': ''})
+        out = normalize_frame(frame)
+        return [(doc, cents) for doc, cents, invalid in
+                zip(docs, out['betrag_cents'].tolist(), out['Betrag_invalid'].tolist())
+                if not invalid and doc.to_dict().get('betrag_cents') != cents]
+
+    def flush():
+        nonlocal updated
+        refs = [doc.reference for doc, _ in amounts(chunk)]
+        chunk.clear()
+        if not refs:
+            return
+        changed = []
+
+        def write(transaction, version):
+            # Read again in the transaction, so rows edited or deleted since the scan are not overwritten
+            changed[:] = amounts([doc for doc in db.get_all(refs, transaction=transaction) if doc.exists])
+            for doc, cents in changed:
+                transaction.update(doc.reference, stamp({'betrag_cents': cents}, version))
+            add_to_summary(db, transaction, summary_delta(
+                removed=[doc.to_dict() for doc, _ in changed],
+                added=[dict(doc.to_dict(), betrag_cents=cents) for doc, cents in changed],
+            ))
+
+        versioned_write(db, write)
+        updated += len(changed)
+
+    for doc in db.collection('invoices').stream():
+        chunk.append(doc)
+        if len(chunk) == chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return updated
+
+
+if __name__ == '__main__':
+    # python normalize.py [path/to/service-account.json]
+    import sys
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    cred_path = sys.argv[1] if len(sys.argv) > 1 else '/etc/secrets/fire-base.json'
+    firebase_admin.initialize_app(credentials.Certificate(cred_path))
+    print(f"Backfilled betrag_cents on {backfill_betrag_cents(firestore.client())} rows")
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever block extraction or entry parsing changes, so old cache entries stop matching
+PARSER_VERSION = '4'
+
+PARSE_CACHE_DIR = os.getenv('PARSE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dzr-parse-cache'))
+# In-memory tier: number of entries kept per process
+PARSE_CACHE_MEMORY_ITEMS = int(os.getenv('PARSE_CACHE_MEMORY_ITEMS', '256'))
+# On-disk tier: size limit in bytes, shared by all processes on the host (0 disables it)
+PARSE_CACHE_DISK_BYTES = int(os.getenv('PARSE_CACHE_DISK_BYTES', str(200 * 1024 * 1024)))
+
+
+def source_sha256(source) -> str:
+    # source: the PDF's bytes or a path to it
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Two-tier cache of parse results, keyed by the SHA-256 of the uploaded bytes.
+
+    Keys also contain PARSER_VERSION and a 'kind' naming the pipeline that
+    produced the value (regex parse, AI parse, ...). Values must be JSON
+    serializable. Both tiers evict least recently used entries first.
+    """
+
+    def __init__(self, directory=PARSE_CACHE_DIR, memory_items=PARSE_CACHE_MEMORY_ITEMS,
+                 disk_bytes=PARSE_CACHE_DISK_BYTES, version=PARSER_VERSION):
+        self.directory = directory
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.version = version
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_used = None  # computed on first disk write
+
+    def _key(self, digest, kind):
+        return f"{self.version}-{kind}-{digest}"
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[-2:], key + '.json')
+
+    def get(self, digest: str, kind: str) -> Optional[object]:
+        key = self._key(digest, kind)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if not self.disk_bytes:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path)  # Mark as recently used for disk eviction
+        except (OSError, ValueError):
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, digest: str, kind: str, value):
+        key = self._key(digest, kind)
+        self._remember(key, value)
+        if self.disk_bytes:
+            try:
+                self._write_disk(key, value)
+            except OSError as e:
+                logger.warning("Parse cache: could not write %s: %s", key, e)
+
+    def _remember(self, key, value):
+        if self.memory_items <= 0:
+            return
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _write_disk(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(value).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = sum(size for _, size, _ in self._disk_entries())
+            else:
+                self._disk_used += len(data)
+            if self._disk_used > self.disk_bytes:
+                self._evict_disk()
+
+    def _disk_entries(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict_disk(self):
+        # Drop the least recently used files until we are back under 90% of the limit
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        used = sum(size for _, size, _ in entries)
+        target = self.disk_bytes * 0.9
+        for path, size, _ in entries:
+            if used <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            used -= size
+        self._disk_used = used
+
+
+parse_cache = ParseCache()
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+from extract_entries_from_ab_block import parse_entries as parse_entry_lines
+from metrics import PARSE_CACHE_HITS, add_timing, observe_stages
+from parse_cache import parse_cache, source_sha256
+from pdf_session import PdfSession
+from profiling import note_file
+
+# Number of worker processes for PDF parsing. 0 = one per CPU, 1 = parse inline.
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '0')) or (os.cpu_count() or 1)
+# 'text': flatten the section to text and parse lines with regexes.
+# 'table': assign words to columns by position (extract_ab_table_from_pdf); PDFs that are
+# not laid out as a table fall back to 'text'.
+PDF_EXTRACTION_MODE = os.getenv('PDF_EXTRACTION_MODE', 'text')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def parse_pdf(source, filename, raw_block=False, parse_entries=True, mode=PDF_EXTRACTION_MODE) -> Dict:
+    """All CPU-bound per-file stages: open, text extraction, block location, entry parsing.
+
+    Runs in a worker process, so it only takes and returns picklable values.
+    'extraction' in the result says which mode produced the entries; 'timings'
+    holds the stage timings for the parent process to record.
+    """
+    with PdfSession(source) as session:
+        table = session.extract_table() if mode == 'table' and parse_entries and not raw_block else None
+        extracted = table or session.extract(raw_block=raw_block)
+    timings = session.timings
+    result = {
+        'filename': filename,
+        'block': extracted['block'],
+        'billing_date': extracted['billing_date'],
+        'pages': extracted['pages'],
+        'entries': None,
+        'skipped_any': False,
+        'skipped_lines': [],
+        'extraction': 'table' if table else 'text',
+        'timings': timings,
+    }
+    if table:
+        result['entries'] = table['entries']
+        result['skipped_lines'] = table['skipped_lines']
+        result['skipped_any'] = bool(table['skipped_lines'])
+    elif parse_entries and extracted['block']:
+        start = time.perf_counter()
+        result['entries'], result['skipped_lines'] = parse_entry_lines(extracted['block'])
+        add_timing(timings, 'row_parsing', time.perf_counter() - start, len(result['entries']))
+        result['skipped_any'] = bool(result['skipped_lines'])
+    return result
+
+
+def get_executor():
+    # Created lazily so every gunicorn worker gets its own pool after the fork
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+        return _executor
+
+
+def iter_parse_files(files: List[Tuple[object, str]], raw_block=False, parse_entries=True) -> Iterator[Dict]:
+    """Parse (source, filename) pairs, yielding each result in upload order as soon as it is ready.
+
+    A source is the PDF's bytes or a path to it. Files whose bytes were parsed
+    before are served from the parse cache and never reach the pool. Every
+    result carries the file's 'sha256'.
+    """
+    kind = f"pdf-{'raw' if raw_block else 'clean'}-{'entries' if parse_entries else 'text'}"
+    if parse_entries and not raw_block and PDF_EXTRACTION_MODE != 'text':
+        kind += f"-{PDF_EXTRACTION_MODE}"
+    digests = [source_sha256(source) for source, _ in files]
+    cached = [parse_cache.get(digest, kind) for digest in digests]
+    misses = [i for i, hit in enumerate(cached) if hit is None]
+    futures = {}
+    if PDF_WORKERS > 1 and len(misses) > 1:
+        executor = get_executor()
+        for i in misses:
+            source, name = files[i]
+            futures[i] = executor.submit(parse_pdf, source, name, raw_block, parse_entries)
+    try:
+        for i, (source, name) in enumerate(files):
+            if cached[i] is not None:
+                PARSE_CACHE_HITS.inc()
+                result = dict(cached[i], filename=name)
+                timings = None
+            else:
+                if i in futures:
+                    result = futures[i].result()
+                else:
+                    result = parse_pdf(source, name, raw_block, parse_entries)
+                # Timings belong to this parse, not to later cache hits
+                timings = result.pop('timings', None)
+                observe_stages(timings)
+                result['sha256'] = digests[i]
+                parse_cache.put(digests[i], kind, result)
+            result['sha256'] = digests[i]
+            note_file(result, cached=timings is None, stage_seconds={
+                stage: round(seconds, 6) for stage, (seconds, _) in (timings or {}).items()
+            })
+            yield result
+    finally:
+        # The consumer went away (e.g. a streaming client disconnected)
+        for future in futures.values():
+            future.cancel()
+
+
+def parse_files(files: List[Tuple[object, str]], raw_block=False, parse_entries=True) -> List[Dict]:
+    """Parse (source, filename) pairs; results come back in upload order."""
+    return list(iter_parse_files(files, raw_block, parse_entries))
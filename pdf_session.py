@@ -0,0 +1,184 @@
+import io
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+import pdfplumber
+
+from extract_ab_block_from_pdf import SectionScanner, join_blocks
+from extract_ab_table_from_pdf import TableScanner, group_lines, line_text
+from metrics import add_timing
+
+# 'Abrechnungsdatum' followed by a date on the first page
+BILLING_DATE_PATTERN = re.compile(r'Abrechnungsdatum\s+(\d{2}[.\/]\d{2}[.\/]\d{4})')
+
+
+def billing_date_from_text(first_page_text: Optional[str]) -> str:
+    match = BILLING_DATE_PATTERN.search(first_page_text or '')
+    if match:
+        return match.group(1)
+    return ''
+
+
+def as_pdf_input(source):
+    # pdfplumber takes paths and streams; wrap raw bytes so uploads never hit the disk
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+class PdfSession:
+    """Opens a PDF once and reads its pages in order, each page's text once.
+
+    Each page's layout objects are released as soon as its text is taken and
+    only the text from the last open Ab-/Zusetzungen section is kept, so memory
+    does not grow with the document. Reading stops after the page that
+    completes the first section, unless PDF_ALL_SECTIONS asks for every
+    section. The billing date comes from the first page.
+    'timings' collects {stage: [seconds, size]} for metrics.observe_stages.
+    """
+
+    def __init__(self, source):
+        # source: a path, a binary file-like object or the PDF's bytes
+        self.source = source
+        self._pdf = None
+        self._first_page_text = None
+        self._text_lengths = {}  # page index -> length of its text, for pages read so far
+        self._scanners = {}  # raw flag -> finished SectionScanner
+        self._table = None
+        self.timings = {}
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._pdf = pdfplumber.open(as_pdf_input(self.source))
+        size = len(self.source) if isinstance(self.source, (bytes, bytearray, memoryview)) else 0
+        if isinstance(self.source, str):
+            size = os.path.getsize(self.source)
+        add_timing(self.timings, 'pdf_open', time.perf_counter() - start, size)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self._pdf is not None:
+            self._pdf.close()
+            self._pdf = None
+
+    @property
+    def pages(self):
+        if self._pdf is None:
+            raise RuntimeError('PdfSession must be used as a context manager')
+        return self._pdf.pages
+
+    def _read_page(self, index: int) -> str:
+        start = time.perf_counter()
+        page = self.pages[index]
+        text = page.extract_text() or ''
+        page.close()  # Drop the page's cached chars and layout objects
+        add_timing(self.timings, 'text_extraction', time.perf_counter() - start, len(text))
+        self._text_lengths[index] = len(text)
+        if index == 0:
+            self._first_page_text = text
+        return text
+
+    def _read_words(self, index: int) -> List[Dict]:
+        start = time.perf_counter()
+        page = self.pages[index]
+        words = page.extract_words()
+        page.close()
+        add_timing(self.timings, 'text_extraction', time.perf_counter() - start, len(words))
+        if index == 0:
+            self._first_page_text = '\n'.join(line_text(line) for line in group_lines(words))
+        self._text_lengths[index] = sum(len(word['text']) + 1 for word in words)
+        return words
+
+    def _scan(self, raw: bool) -> SectionScanner:
+        if raw not in self._scanners:
+            scanner = SectionScanner(raw=raw)
+            for index in range(len(self.pages)):
+                text = self._read_page(index)
+                start = time.perf_counter()
+                scanner.feed(text)
+                add_timing(self.timings, 'block_location', time.perf_counter() - start, len(text))
+                if scanner.done:
+                    break
+            self._scanners[raw] = scanner
+        return self._scanners[raw]
+
+    def sections(self, raw=False) -> List[str]:
+        # Every Ab-/Zusetzungen section read (headers stripped unless raw)
+        return self._scan(raw).blocks()
+
+    def relevant_block(self, raw=False) -> Optional[str]:
+        # raw=True keeps the header lines (the block backend.py sends to the AI)
+        return join_blocks(self.sections(raw=raw))
+
+    def billing_date(self) -> str:
+        if self._first_page_text is None and len(self.pages):
+            self._read_page(0)
+        return billing_date_from_text(self._first_page_text)
+
+    def page_metadata(self) -> Dict[str, int]:
+        # pages_with_text and text_length only count the pages that were read
+        return {
+            'page_count': len(self.pages),
+            'pages_read': len(self._text_lengths),
+            'pages_with_text': sum(1 for n in self._text_lengths.values() if n),
+            'text_length': sum(self._text_lengths.values()),
+        }
+
+    def table(self) -> Optional[TableScanner]:
+        # The Ab-/Zusetzungen table read by word positions, or None if the page is not laid out as one
+        if self._table is None:
+            scanner = TableScanner()
+            for index in range(len(self.pages)):
+                words = self._read_words(index)
+                start = time.perf_counter()
+                # Column assignment locates the table and parses its rows in one go
+                scanner.feed(words)
+                add_timing(self.timings, 'row_parsing', time.perf_counter() - start)
+                if scanner.done:
+                    break
+            add_timing(self.timings, 'row_parsing', 0, len(scanner.rows))
+            self._table = scanner
+        if not self._table.usable():
+            return None
+        return self._table
+
+    def extract_table(self) -> Optional[Dict]:
+        # Like extract(), plus the entries; None if the table could not be located
+        table = self.table()
+        if table is None:
+            return None
+        block = '\n'.join(table.block_lines) or None
+        return {
+            'block': block,
+            'sections': [block] if block else [],
+            'billing_date': self.billing_date(),
+            'pages': self.page_metadata(),
+            'entries': table.rows,
+            'skipped_lines': table.skipped,
+        }
+
+    def extract(self, raw_block=False) -> Dict:
+        sections = self.sections(raw=raw_block)
+        return {
+            'block': join_blocks(sections),
+            'sections': sections,
+            'billing_date': self.billing_date(),
+            'pages': self.page_metadata(),
+        }
+
+
+def extract_pdf(source, raw_block=False) -> Dict:
+    # Single pass over the file: block, billing date and page metadata together
+    with PdfSession(source) as session:
+        return session.extract(raw_block=raw_block)
+
+
+def extract_billing_date(source) -> str:
+    with PdfSession(source) as session:
+        return session.billing_date()
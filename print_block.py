@@ -1,4 +1,4 @@
-from backend import extract_relevant_block
+from pdf_session import PdfSession
 import sys
 
 if __name__ == "__main__":
@@ -6,7 +6,8 @@ if __name__ == "__main__":
         print("Usage: python print_block.py <yourfile.pdf>")
         sys.exit(1)
     pdf_path = sys.argv[1]
-    block = extract_relevant_block(pdf_path)
+    with PdfSession(pdf_path) as session:
+        block = session.relevant_block(raw=True)
     if block:
         print("\n--- BLOCK TO SEND TO AI ---\n")
         print(block)
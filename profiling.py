@@ -0,0 +1,193 @@
+import cProfile
+import datetime
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from flask import g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+# Share of requests to PROFILE_PATHS that are profiled without being asked (0 = only on request)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+# Requests sending this value in X-Profile-Token are always profiled, and only they may
+# list and download profiles. Unset disables the header and the profile endpoints.
+PROFILE_ADMIN_TOKEN = os.getenv('PROFILE_ADMIN_TOKEN', '')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'dzr-profiles'))
+# Oldest profiles are deleted beyond this many
+PROFILE_MAX_KEPT = int(os.getenv('PROFILE_MAX_KEPT', '50'))
+PROFILE_PATHS = ('/api/upload', '/api/rows')
+TOKEN_HEADER = 'X-Profile-Token'
+PROFILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# One profiler at a time: concurrent requests are not profiled rather than blocked
+_profile_lock = threading.Lock()
+
+
+def is_admin() -> bool:
+    token = request.headers.get(TOKEN_HEADER, '')
+    # Constant time, so response timing does not leak the token
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), PROFILE_ADMIN_TOKEN.encode('utf-8'))
+
+
+def _wanted() -> bool:
+    if request.path not in PROFILE_PATHS:
+        return False
+    return is_admin() or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+
+
+def note_file(parsed_file: Dict, **fields):
+    """Add per-file details (pages, rows, stage timings, ...) to the current request's profile, if any.
+
+    Safe to call anywhere: outside a profiled request it does nothing.
+    """
+    if not has_request_context() or getattr(g, 'profile', None) is None:
+        return
+    key = (parsed_file.get('filename'), parsed_file.get('sha256'))
+    files = g.profile['files']
+    if key not in files:
+        pages = parsed_file.get('pages') or {}
+        files[key] = {
+            'filename': parsed_file.get('filename'),
+            'page_count': pages.get('page_count'),
+            'pages_read': pages.get('pages_read'),
+            'extraction': parsed_file.get('extraction'),
+        }
+    files[key].update(fields)
+
+
+def _start():
+    g.profile = None
+    if not _wanted():
+        return
+    request_id = request.headers.get('X-Request-ID', '')[:200]
+    # Read the form before taking the lock: a too-large upload raises here
+    filenames = [f.filename for f in request.files.getlist('files')]
+    if not _profile_lock.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    profile_id = uuid.uuid4().hex
+    g.profile = {
+        'profile_id': profile_id,
+        'request_id': request_id or profile_id,
+        'method': request.method,
+        'path': request.path,
+        'query': request.query_string.decode('utf-8', 'replace'),
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'reason': 'header' if is_admin() else 'sampled',
+        'filenames': filenames,
+        'files': {},
+        'profiler': profiler,
+        'start': time.perf_counter(),
+    }
+    profiler.enable()
+
+
+def _finish(profile: Dict, status: int):
+    try:
+        profile['profiler'].disable()
+        metadata = {k: v for k, v in profile.items() if k not in ('profiler', 'start', 'files', 'streaming')}
+        metadata['status'] = profile.get('status', status)
+        metadata['duration_s'] = round(time.perf_counter() - profile['start'], 6)
+        metadata['files'] = list(profile['files'].values())
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile['profiler'].dump_stats(os.path.join(PROFILE_DIR, profile['profile_id'] + '.prof'))
+        with open(os.path.join(PROFILE_DIR, profile['profile_id'] + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=2)
+        _prune()
+        logger.info('Stored profile %s for %s %s (%.3fs)', profile['profile_id'], profile['path'],
+                    profile['request_id'], metadata['duration_s'])
+    except Exception:
+        logger.exception('Could not store profile %s', profile['profile_id'])
+    finally:
+        _profile_lock.release()
+
+
+def _after(response):
+    profile = getattr(g, 'profile', None)
+    if profile is None:
+        return response
+    response.headers['X-Profile-Id'] = profile['profile_id']
+    profile['status'] = response.status_code
+    if response.is_streamed:
+        # NDJSON uploads do their work while the body is sent, after the request's teardown;
+        # g.profile stays set so the streaming generator can still note files
+        profile['streaming'] = True
+        # The server closes the response once the body is sent, or when the client goes away,
+        # even before the body's generator ever started; the profile (and its lock) end there
+        status = response.status_code
+        response.call_on_close(lambda: _finish(profile, status))
+    else:
+        g.profile = None
+        _finish(profile, response.status_code)
+    return response
+
+
+def _teardown(exc):
+    # The view raised, so _after never ran
+    profile = getattr(g, 'profile', None)
+    if profile is not None and not profile.get('streaming'):
+        g.profile = None
+        _finish(profile, 500)
+
+
+def init_app(app):
+    """Profile requests to PROFILE_PATHS with cProfile when asked via X-Profile-Token or sampled.
+
+    The profile goes to PROFILE_DIR as <profile id>.prof (load it with pstats
+    or snakeviz), next to <profile id>.json with the request id (X-Request-ID,
+    if sent), filenames, status, duration and per-file page and row counts.
+    The profile id is returned in X-Profile-Id. PDF parsing in PDF worker processes is not part of the profile;
+    the per-file stage timings in the .json cover it.
+    """
+    app.before_request(_start)
+    app.after_request(_after)
+    app.teardown_request(_teardown)
+
+
+def list_profiles() -> List[Dict]:
+    # Metadata of stored profiles, newest first
+    profiles = []
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name), 'r', encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    profiles.sort(key=lambda p: p.get('started_at', ''), reverse=True)
+    return profiles
+
+
+def profile_path(profile_id: str) -> Optional[str]:
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, profile_id + '.prof')
+    return path if os.path.exists(path) else None
+
+
+def _prune():
+    try:
+        entries = [os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith('.prof')]
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:max(0, len(entries) - PROFILE_MAX_KEPT)]:
+            for extension in ('.prof', '.json'):
+                try:
+                    os.unlink(path[:-len('.prof')] + extension)
+                except FileNotFoundError:
+                    pass
+    except OSError as e:
+        logger.warning('Could not prune profiles: %s', e)
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Set ROWS_CACHE=0 to always read /api/rows straight from Firestore
+ROWS_CACHE_ENABLED = os.getenv('ROWS_CACHE', '1') not in ('0', 'false', 'no')
+# How long the first request waits for the listener's initial snapshot before falling back
+INITIAL_SNAPSHOT_TIMEOUT = float(os.getenv('ROWS_CACHE_INITIAL_TIMEOUT', '10'))
+# Serialized responses kept per version, one per distinct assignee filter
+RESPONSE_CACHE_ITEMS = 32
+
+
+def _doc_hash(doc_id: str, update_time) -> int:
+    stamp = update_time.isoformat() if update_time is not None else ''
+    return int.from_bytes(hashlib.sha1(f"{doc_id}\x1f{stamp}".encode('utf-8')).digest()[:8], 'big')
+
+
+class RowsCache:
+    """Materialized copy of the invoices collection kept current by on_snapshot.
+
+    The version is an XOR of (id, update_time) hashes over all documents, so
+    every process that has seen the same state reports the same ETag, no matter
+    which gunicorn worker answers a poll. Rows are also indexed by assignee.
+    """
+
+    def __init__(self, db, collection='invoices'):
+        self._db = db
+        self._collection = collection
+        self._rows = {}  # id -> row dict (with 'id')
+        self._hashes = {}  # id -> _doc_hash
+        self._by_assignee = {}  # assigned_to -> set of ids
+        self._digest = 0
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()  # separate: the listener may call back while starting
+        self._ready = threading.Event()
+        self._waited = False
+        self._watch = None
+        self._responses = OrderedDict()
+
+    def start(self):
+        # Started on first use so the listener lives in the gunicorn worker, not the master
+        with self._start_lock:
+            if self._watch is None:
+                self._watch = self._db.collection(self._collection).on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        with self._start_lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+            self._ready.clear()
+
+    def wait_ready(self, timeout=INITIAL_SNAPSHOT_TIMEOUT) -> bool:
+        # Only the first caller blocks; afterwards callers fall back at once until it is ready
+        self.start()
+        if self._waited:
+            return self._ready.is_set()
+        ready = self._ready.wait(timeout)
+        self._waited = True
+        return ready
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                self._discard(doc.id)
+                if change.type.name != 'REMOVED':
+                    row = doc.to_dict()
+                    row['id'] = doc.id
+                    self._rows[doc.id] = row
+                    self._hashes[doc.id] = _doc_hash(doc.id, doc.update_time)
+                    self._digest ^= self._hashes[doc.id]
+                    self._by_assignee.setdefault(row.get('assigned_to', ''), set()).add(doc.id)
+            if changes:
+                self._responses.clear()
+        self._ready.set()
+
+    def _discard(self, doc_id):
+        row = self._rows.pop(doc_id, None)
+        if row is None:
+            return
+        self._digest ^= self._hashes.pop(doc_id)
+        ids = self._by_assignee.get(row.get('assigned_to', ''))
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del self._by_assignee[row.get('assigned_to', '')]
+
+    def _etag(self, assigned_to):
+        scope = ','.join(sorted(assigned_to)) if assigned_to else '*'
+        scope_hash = hashlib.sha1(scope.encode('utf-8')).hexdigest()[:8]
+        return f"{self._digest:016x}-{len(self._rows)}-{scope_hash}"
+
+    def etag(self, assigned_to: Optional[List[str]] = None) -> str:
+        with self._lock:
+            return self._etag(assigned_to)
+
+    def split_rows(self, assigned_to: Optional[List[str]] = None) -> Tuple[str, List[Dict], List[Dict]]:
+        """(etag, active, archived), optionally limited to some assignees.
+
+        The ETag is taken under the same lock as the rows, so it always
+        describes exactly the rows returned.
+        """
+        with self._lock:
+            etag = self._etag(assigned_to)
+            if assigned_to:
+                ids = set()
+                for name in assigned_to:
+                    ids |= self._by_assignee.get(name, set())
+                rows = [self._rows[i] for i in sorted(ids)]
+            else:
+                rows = [self._rows[i] for i in sorted(self._rows)]
+        active = [row for row in rows if not row.get('archived')]
+        archived = [row for row in rows if row.get('archived')]
+        return etag, active, archived
+
+    def cached_response(self, etag: str):
+        with self._lock:
+            return self._responses.get(etag)
+
+    def store_response(self, etag: str, body):
+        with self._lock:
+            self._responses[etag] = body
+            while len(self._responses) > RESPONSE_CACHE_ITEMS:
+                self._responses.popitem(last=False)
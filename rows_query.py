@@ -0,0 +1,206 @@
+import base64
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from change_log import stamp, versioned_write
+from normalize import billing_date_iso
+from summary_totals import add_to_summary, summary_delta
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# Firestore 'in' filters accept at most 30 values
+MAX_IN_VALUES = 30
+ORDER_FIELDS = ['billing_date_iso', 'Name', 'Betrag', 'betrag_cents', 'Ihre Rechnungs-Nr.', 'Rechnungs-Nr. DZR', 'assigned_to']
+
+
+def query_fields(row: Dict) -> Dict:
+    # Fields every stored row needs so /api/rows can filter and order in Firestore;
+    # billing_date_iso comes with the other normalized fields from normalize.normalize_rows
+    return {
+        'archived': bool(row.get('archived', False)),
+        'starred': bool(row.get('starred', False)),
+    }
+
+
+def _flag(value: Optional[str]) -> Optional[bool]:
+    if value is None or value == '':
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f"expected true or false, got '{value}'")
+
+
+def encode_page_token(doc_id: str) -> str:
+    return base64.urlsafe_b64encode(doc_id.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8')
+    except Exception:
+        raise ValueError('invalid page_token')
+
+
+def parse_rows_args(args) -> Dict:
+    """Turn /api/rows query arguments into query_rows() keyword arguments.
+
+    Raises ValueError with a user-facing message for bad input.
+    """
+    assigned_to = args.get('assigned_to', 'all')
+    try:
+        page_size = int(args.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('page_size must be a number')
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f'page_size must be between 1 and {MAX_PAGE_SIZE}')
+    order_by = args.get('order_by', 'billing_date_iso')
+    if order_by not in ORDER_FIELDS:
+        raise ValueError(f"order_by must be one of {', '.join(ORDER_FIELDS)}")
+    direction = args.get('direction', 'desc').lower()
+    if direction not in ('asc', 'desc'):
+        raise ValueError("direction must be 'asc' or 'desc'")
+    billing_from = args.get('billing_date_from')
+    billing_to = args.get('billing_date_to')
+    if billing_from and not billing_date_iso(billing_from):
+        raise ValueError('billing_date_from must be DD.MM.YYYY or YYYY-MM-DD')
+    if billing_to and not billing_date_iso(billing_to):
+        raise ValueError('billing_date_to must be DD.MM.YYYY or YYYY-MM-DD')
+    fields = args.get('fields')
+    return {
+        'archived': _flag(args.get('archived')),
+        'assigned_to': [x.strip() for x in assigned_to.split(',')] if assigned_to != 'all' else None,
+        'starred': _flag(args.get('starred')),
+        'billing_date_from': billing_date_iso(billing_from) if billing_from else None,
+        'billing_date_to': billing_date_iso(billing_to) if billing_to else None,
+        'order_by': order_by,
+        'direction': direction,
+        'fields': [f.strip() for f in fields.split(',') if f.strip()] if fields else None,
+        'page_size': page_size,
+        'page_token': args.get('page_token') or None,
+    }
+
+
+def field_path(name: str) -> str:
+    # select() and order_by() parse their argument as a field path, so names with
+    # spaces, dots or dashes ('Ihre Rechnungs-Nr.') have to be quoted
+    return FieldPath(name).to_api_repr()
+
+
+def build_query(db, archived=None, assigned_to=None, starred=None,
+                billing_date_from=None, billing_date_to=None, fields=None):
+    FieldFilter = firestore.FieldFilter
+    query = db.collection('invoices')
+    if archived is not None:
+        query = query.where(filter=FieldFilter('archived', '==', archived))
+    if assigned_to:
+        if len(assigned_to) == 1:
+            query = query.where(filter=FieldFilter('assigned_to', '==', assigned_to[0]))
+        else:
+            query = query.where(filter=FieldFilter('assigned_to', 'in', assigned_to[:MAX_IN_VALUES]))
+    if starred is not None:
+        query = query.where(filter=FieldFilter('starred', '==', starred))
+    if billing_date_from:
+        query = query.where(filter=FieldFilter('billing_date_iso', '>=', billing_date_from))
+    if billing_date_to:
+        query = query.where(filter=FieldFilter('billing_date_iso', '<=', billing_date_to))
+    if fields:
+        query = query.select([field_path(name) for name in fields])
+    return query
+
+
+def query_rows(db, archived=None, assigned_to=None, starred=None,
+               billing_date_from=None, billing_date_to=None, order_by='billing_date_iso',
+               direction='desc', fields=None, page_size=DEFAULT_PAGE_SIZE,
+               page_token=None) -> Tuple[List[Dict], Optional[str]]:
+    """One page of invoices, filtered, ordered and projected by Firestore.
+
+    Returns (rows, next_page_token); next_page_token is None on the last page.
+    """
+    if assigned_to and len(assigned_to) > MAX_IN_VALUES:
+        raise ValueError(f'at most {MAX_IN_VALUES} assigned_to values per request')
+    query = build_query(db, archived, assigned_to, starred, billing_date_from, billing_date_to, fields)
+    firestore_direction = firestore.Query.DESCENDING if direction == 'desc' else firestore.Query.ASCENDING
+    if (billing_date_from or billing_date_to) and order_by != 'billing_date_iso':
+        # Firestore needs the range-filtered field as the first sort key
+        query = query.order_by('billing_date_iso', direction=firestore_direction)
+    query = query.order_by(field_path(order_by), direction=firestore_direction)
+    query = query.order_by('__name__', direction=firestore_direction)
+    if page_token:
+        cursor = db.collection('invoices').document(decode_page_token(page_token)).get()
+        if not cursor.exists:
+            raise ValueError('page_token refers to a deleted row; restart from the first page')
+        query = query.start_after(cursor)
+    # One extra document tells us whether there is a next page
+    docs = list(query.limit(page_size + 1).stream())
+    rows = []
+    for doc in docs[:page_size]:
+        row = doc.to_dict()
+        row['id'] = doc.id
+        rows.append(row)
+    next_page_token = encode_page_token(docs[page_size - 1].id) if len(docs) > page_size else None
+    return rows, next_page_token
+
+
+def backfill_query_fields(db, chunk_size=498) -> int:
+    """Give rows stored before paged /api/rows existed the fields it filters on, chunk_size rows per change set.
+
+    Adds 'archived' and 'billing_date_iso' and turns '' in 'starred' into False.
+    Each chunk is a versioned write (see change_log.versioned_write), so delta
+    clients and the summary totals pick the new fields up.
+    """
+    updated = 0
+    chunk = []
+
+    def missing(docs):
+        out = []
+        for doc in docs:
+            data = doc.to_dict()
+            fields = dict(query_fields(data), billing_date_iso=billing_date_iso(data.get('Billing Date')))
+            changed = {k: v for k, v in fields.items() if data.get(k) != v}
+            if changed:
+                out.append((doc, changed))
+        return out
+
+    def flush():
+        nonlocal updated
+        refs = [doc.reference for doc, _ in missing(chunk)]
+        chunk.clear()
+        if not refs:
+            return
+        changed = []
+
+        def write(transaction, version):
+            # Read again in the transaction, so rows edited or deleted since the scan are not overwritten
+            changed[:] = missing([doc for doc in db.get_all(refs, transaction=transaction) if doc.exists])
+            for doc, fields in changed:
+                transaction.update(doc.reference, stamp(dict(fields), version))
+            add_to_summary(db, transaction, summary_delta(
+                removed=[doc.to_dict() for doc, _ in changed],
+                added=[dict(doc.to_dict(), **fields) for doc, fields in changed],
+            ))
+
+        versioned_write(db, write)
+        updated += len(changed)
+
+    for doc in db.collection('invoices').stream():
+        chunk.append(doc)
+        if len(chunk) == chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return updated
+
+
+if __name__ == '__main__':
+    # python rows_query.py [path/to/service-account.json]
+    import firebase_admin
+    from firebase_admin import credentials
+
+    cred_path = sys.argv[1] if len(sys.argv) > 1 else '/etc/secrets/fire-base.json'
+    firebase_admin.initialize_app(credentials.Certificate(cred_path))
+    print(f"Backfilled {backfill_query_fields(firestore.client())} rows")
@@ -0,0 +1,299 @@
+import functools
+import heapq
+import math
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+from dedup_index import normalize_nr
+
+logger = logging.getLogger(__name__)
+
+SEARCH_FIELDS = ['Name', 'Rechnungsempfängers', 'Rechnungs-Nr. DZR', 'Ihre Rechnungs-Nr.']
+# Invoice numbers are also indexed whole, normalized like the dedup index does
+NR_FIELDS = ('Rechnungs-Nr. DZR', 'Ihre Rechnungs-Nr.')
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MIN_QUERY_LENGTH = 2
+# Share of the query's trigrams a row must contain to match without a prefix hit
+MIN_SIMILARITY = float(os.getenv('SEARCH_MIN_SIMILARITY', '0.5'))
+# Writes by other processes (gunicorn workers, ingest jobs) show up after at most this long
+SEARCH_REFRESH_S = float(os.getenv('SEARCH_REFRESH_S', '5'))
+# How long a search waits for the initial build before giving up
+SEARCH_READY_TIMEOUT = float(os.getenv('SEARCH_READY_TIMEOUT', '10'))
+# A build that failed on a storage error is tried again after this long, doubling up to SEARCH_RETRY_MAX_S
+SEARCH_RETRY_S = float(os.getenv('SEARCH_RETRY_S', '30'))
+SEARCH_RETRY_MAX_S = 600
+# Failures no retry can fix (a query storage rejects, a bad row): the index stays off until a restart
+PERMANENT_ERRORS = (ValueError, TypeError, KeyError)
+TOKEN_PATTERN = re.compile(r'[0-9a-z]+')
+# Word starts of up to this many characters are indexed directly
+PREFIX_LENGTH = 4
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.75
+
+
+@functools.lru_cache(maxsize=65536)
+def fold(text: Optional[str]) -> str:
+    """Lower-case text with umlauts and ß folded, so 'Müller', 'Mueller' and 'muller' compare equal."""
+    text = (text or '').casefold()  # casefold turns ß into ss
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return text.replace('ae', 'a').replace('oe', 'o').replace('ue', 'u')
+
+
+def _tokens(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text)
+
+
+def _grams(tokens: Iterable[str]) -> set:
+    grams = set()
+    for token in tokens:
+        padded = f' {token} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _prefixes(tokens: Iterable[str]) -> set:
+    return {token[:length] for token in tokens for length in range(MIN_QUERY_LENGTH, PREFIX_LENGTH + 1)
+            if len(token) >= length}
+
+
+def row_tokens(row: Dict) -> set:
+    tokens = set()
+    for field in SEARCH_FIELDS:
+        tokens.update(_tokens(fold(row.get(field))))
+    for field in NR_FIELDS:
+        whole = fold(normalize_nr(row.get(field)))
+        if whole:
+            tokens.add(whole)
+    return tokens
+
+
+def query_tokens(query: str) -> List[str]:
+    folded = fold(query)
+    tokens = _tokens(folded)
+    # '984581/12' should also prefix-match the whole invoice number
+    whole = normalize_nr(folded)
+    if any(c.isdigit() for c in whole) and whole not in tokens:
+        tokens.append(whole)
+    return tokens
+
+
+class SearchIndex:
+    """In-process prefix and trigram index over names, recipients and invoice numbers.
+
+    Built from storage on first use (start() builds in the background).
+    Write endpoints of this process call note_rows / note_update /
+    note_delete so their changes are searchable at once; changes made
+    elsewhere are picked up from the change log (storage.changes_since)
+    at most every SEARCH_REFRESH_S seconds. If the build fails, error
+    holds why; storage errors are retried with backoff, other failures
+    are not retried at all.
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._entries = {}  # id -> {'fields', 'archived', 'tokens', 'words', 'grams'}
+        self._token_ids = {}  # token -> set of ids
+        self._prefix_ids = {}  # first 2..PREFIX_LENGTH characters of a token -> set of ids
+        self._gram_ids = {}  # trigram -> set of ids (word starts padded with a space)
+        self._version = 0
+        self._refreshed = 0.0
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._ready = threading.Event()
+        # Set once the first build attempt has finished, whether it worked or not
+        self._settled = threading.Event()
+        self._started_pid = None
+        self.error = None
+        self._failures = 0
+        self._retry_at = None
+
+    def start(self):
+        # Once per process, so a forked gunicorn worker builds its own copy
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                if self._retry_at is None or time.monotonic() < self._retry_at:
+                    return
+                self._retry_at = None
+            else:
+                self._started_pid = os.getpid()
+        threading.Thread(target=self._build, daemon=True).start()
+
+    def wait_ready(self, timeout=SEARCH_READY_TIMEOUT) -> bool:
+        # False while the build runs, and at once if it failed (see error)
+        self.start()
+        self._settled.wait(timeout)
+        return self._ready.is_set()
+
+    def _build(self):
+        try:
+            start = time.perf_counter()
+            # Read the version first: anything committed during the scan is replayed by refresh()
+            version = self._storage.current_version()
+            rows = [(row['id'], row) for page in self._storage.iter_pages(
+                fields=SEARCH_FIELDS + ['archived'], by_billing_date=False, page_size=None) for row in page]
+            with self._lock:
+                self._clear()
+                for row_id, row in rows:
+                    self._add(row_id, row)
+                self._version = version
+                self._refreshed = time.monotonic()
+            logger.info('Search index built: %d rows in %.2fs', len(self._entries), time.perf_counter() - start)
+            self.error = None
+            self._failures = 0
+            self._ready.set()
+        except Exception as e:
+            logger.exception('Could not build the search index')
+            self.error = str(e) or type(e).__name__
+            with self._start_lock:
+                if not isinstance(e, PERMANENT_ERRORS):
+                    self._failures += 1
+                    delay = min(SEARCH_RETRY_S * 2 ** (self._failures - 1), SEARCH_RETRY_MAX_S)
+                    self._retry_at = time.monotonic() + delay
+        finally:
+            self._settled.set()
+
+    def _clear(self):
+        self._entries.clear()
+        self._token_ids.clear()
+        self._prefix_ids.clear()
+        self._gram_ids.clear()
+
+    def _add(self, row_id: str, row: Dict):
+        self._remove(row_id)
+        tokens = row_tokens(row)
+        grams = _grams(tokens)
+        self._entries[row_id] = {
+            'fields': {field: row.get(field, '') for field in SEARCH_FIELDS},
+            'archived': bool(row.get('archived', False)),
+            'tokens': tokens,
+            # ' word word ...', so a word start is one substring search
+            'words': ' ' + ' '.join(tokens),
+            'grams': grams,
+        }
+        for token in tokens:
+            self._token_ids.setdefault(token, set()).add(row_id)
+        for prefix in _prefixes(tokens):
+            self._prefix_ids.setdefault(prefix, set()).add(row_id)
+        for gram in grams:
+            self._gram_ids.setdefault(gram, set()).add(row_id)
+
+    def _remove(self, row_id: str):
+        entry = self._entries.pop(row_id, None)
+        if entry is None:
+            return
+        for token in entry['tokens']:
+            ids = self._token_ids[token]
+            ids.discard(row_id)
+            if not ids:
+                del self._token_ids[token]
+        for prefix in _prefixes(entry['tokens']):
+            ids = self._prefix_ids[prefix]
+            ids.discard(row_id)
+            if not ids:
+                del self._prefix_ids[prefix]
+        for gram in entry['grams']:
+            ids = self._gram_ids[gram]
+            ids.discard(row_id)
+            if not ids:
+                del self._gram_ids[gram]
+
+    def note_rows(self, rows: Iterable[Dict]):
+        # Rows just written by this process (with their 'id'); before the build
+        # finishes there is nothing to update, the build or refresh() sees them
+        if not self._ready.is_set():
+            return
+        with self._lock:
+            for row in rows:
+                if row.get('id'):
+                    self._add(row['id'], row)
+
+    def note_update(self, row_id: str, data: Dict):
+        if not self._ready.is_set():
+            return
+        with self._lock:
+            entry = self._entries.get(row_id)
+            if entry is not None:
+                row = dict(entry['fields'], archived=entry['archived'])
+                row.update(data)
+                self._add(row_id, row)
+
+    def note_delete(self, row_id: str):
+        with self._lock:
+            self._remove(row_id)
+
+    def refresh(self, force=False):
+        """Apply changes other processes committed since the last refresh (throttled)."""
+        if not force and time.monotonic() - self._refreshed < SEARCH_REFRESH_S:
+            return
+        self._refreshed = time.monotonic()
+        while True:
+            changes = self._storage.changes_since(self._version)
+            if changes['reset']:
+                # More changed at once than the change log hands out: read everything again
+                self._build()
+                return
+            with self._lock:
+                for row in changes['rows']:
+                    self._add(row['id'], row)
+                for row_id in changes['deleted']:
+                    self._remove(row_id)
+                self._version = max(self._version, changes['version'])
+            if not changes['has_more']:
+                return
+
+    def _prefix_matches(self, token: str) -> set:
+        # Rows with a word starting with token; longer tokens narrow the indexed
+        # word start down with their trigrams and check the remaining rows' words
+        ids = self._prefix_ids.get(token[:PREFIX_LENGTH], set())
+        if len(token) <= PREFIX_LENGTH:
+            return ids
+        postings = sorted([ids] + [self._gram_ids.get(gram, set()) for gram in _grams([token])
+                                   if not gram.endswith(' ')], key=len)
+        start = ' ' + token
+        return {row_id for row_id in postings[0].intersection(*postings[1:])
+                if start in self._entries[row_id]['words']}
+
+    def search(self, query: str, limit=DEFAULT_SEARCH_LIMIT) -> List[Dict]:
+        """Best matching rows for query, best first: [{'id', 'score', 'archived', <SEARCH_FIELDS>}].
+
+        Rows where query words match a whole word (1.0) or the start of one
+        (0.75) score 1 plus those points averaged over the query words.
+        Only when they do not fill the limit are rows without a word match
+        considered (typos); they score the share of the query's trigrams
+        they contain, at least MIN_SIMILARITY. Ties are ordered by Name.
+        """
+        tokens = query_tokens(query)
+        if not tokens:
+            return []
+        grams = _grams(_tokens(fold(query)))
+        with self._lock:
+            word_scores = Counter()
+            for token in tokens:
+                exact = self._token_ids.get(token, set())
+                word_scores.update(dict.fromkeys(exact, EXACT_SCORE))
+                if len(token) >= MIN_QUERY_LENGTH:
+                    word_scores.update(dict.fromkeys(self._prefix_matches(token) - exact, PREFIX_SCORE))
+            scores = {row_id: 1 + points / len(tokens) for row_id, points in word_scores.items()}
+            if len(scores) < limit and grams:
+                # A row with `needed` of the trigrams has at least one of the rarest len - needed + 1
+                needed = math.ceil(MIN_SIMILARITY * len(grams))
+                postings = sorted((self._gram_ids.get(gram, set()) for gram in grams), key=len)
+                for row_id in set().union(*postings[:len(grams) - needed + 1]) - scores.keys():
+                    hits = len(grams & self._entries[row_id]['grams'])
+                    if hits >= needed:
+                        scores[row_id] = hits / len(grams)
+            ranked = [(-score, self._entries[row_id]['fields']['Name'], row_id) for row_id, score in scores.items()]
+            return [dict(self._entries[row_id]['fields'], id=row_id, archived=self._entries[row_id]['archived'],
+                         score=round(-negative, 3))
+                    for negative, _, row_id in heapq.nsmallest(limit, ranked)]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,521 @@
+import datetime
+import json
+import os
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+from batch_writer import commit_rows
+from bulk_ops import apply_bulk, check_items, plan_bulk
+from change_log import DEFAULT_CHANGES_LIMIT, changes_since, complete_change_sets, current_version, \
+    delete_invoice, update_invoice
+from dedup_index import DedupIndex, dedup_key
+from metrics import observe_stage, timed_stage
+from rows_query import DEFAULT_PAGE_SIZE, MAX_IN_VALUES, ORDER_FIELDS, build_query, decode_page_token, \
+    encode_page_token, query_rows
+from summary_totals import NONE_KEY, format_summary, read_summary, row_cents
+
+# 'firestore' (production) or 'sqlite' (one local file: no credentials or network needed)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'firestore').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'invoices.sqlite3')
+# Rows read per round trip by iter_pages()
+SCAN_PAGE_SIZE = 500
+# Bound parameters per IN (...) list, well below SQLite's limit
+SQLITE_IN_CHUNK = 500
+
+
+class StorageError(Exception):
+    pass
+
+
+class InvoiceStorage(ABC):
+    """Where invoices live: add, batch add, get, update, delete, filtered queries and dedup lookups.
+
+    Rows are plain dicts; rows handed back carry their 'id'. Every write is a
+    versioned change set, so changes_since() works the same on each backend.
+    """
+
+    backend = None
+
+    @abstractmethod
+    def add_rows(self, rows: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """Store new rows; returns (written, failed) like batch_writer.commit_rows."""
+
+    def add(self, row: Dict) -> Dict:
+        written, failed = self.add_rows([row])
+        if failed:
+            raise StorageError(failed[0]['error'])
+        return written[0]
+
+    @abstractmethod
+    def get(self, row_id: str) -> Optional[Dict]:
+        """The row with its 'id', or None."""
+
+    @abstractmethod
+    def update(self, row_id: str, data: Dict, before: Optional[Dict] = None) -> int:
+        """Set the fields in data; pass the row as read before if data can change its dedup key."""
+
+    @abstractmethod
+    def delete(self, row_id: str) -> bool:
+        """Delete a row and leave a tombstone; False if there was no such row."""
+
+    @abstractmethod
+    def query(self, archived=None, assigned_to=None, starred=None, billing_date_from=None, billing_date_to=None,
+              order_by='billing_date_iso', direction='desc', fields=None, page_size=DEFAULT_PAGE_SIZE,
+              page_token=None) -> Tuple[List[Dict], Optional[str]]:
+        """One page of rows for the parse_rows_args() arguments; returns (rows, next_page_token)."""
+
+    @abstractmethod
+    def iter_pages(self, archived=None, assigned_to=None, starred=None, billing_date_from=None,
+                   billing_date_to=None, fields=None, by_billing_date=True,
+                   page_size: Optional[int] = SCAN_PAGE_SIZE) -> Iterator[List[Dict]]:
+        """Every matching row, page by page, in billing date order (or id order).
+
+        page_size=None reads everything in one go.
+        """
+
+    @abstractmethod
+    def existing_keys(self, keys: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+        """The subset of dedup keys (dedup_index.dedup_key) that already belong to a row."""
+
+    @abstractmethod
+    def apply_bulk(self, items: List) -> List[Dict]:
+        """/api/rows/bulk items applied in order; one {id, op, status} result per item."""
+
+    @abstractmethod
+    def current_version(self) -> int:
+        """The newest change version written."""
+
+    @abstractmethod
+    def changes_since(self, since: int, limit=DEFAULT_CHANGES_LIMIT) -> Dict:
+        """Rows changed and deleted after version since, as change_log.changes_since returns them."""
+
+    @abstractmethod
+    def summary(self) -> Dict:
+        """Totals as summary_totals.read_summary returns them."""
+
+
+class FirestoreStorage(InvoiceStorage):
+    """The invoices collection, through the versioned writers and the persistent dedup index."""
+
+    backend = 'firestore'
+
+    def __init__(self, db):
+        self.db = db
+        self.dedup_index = DedupIndex(db)
+
+    def add_rows(self, rows):
+        return commit_rows(self.db, rows, dedup_index=self.dedup_index)
+
+    def get(self, row_id):
+        snapshot = self.db.collection('invoices').document(row_id).get()
+        if not snapshot.exists:
+            return None
+        row = snapshot.to_dict()
+        row['id'] = snapshot.id
+        return row
+
+    def update(self, row_id, data, before=None):
+        return update_invoice(self.db, row_id, data, dedup_index=self.dedup_index, before=before)
+
+    def delete(self, row_id):
+        row = self.get(row_id)
+        if row is None:
+            return False
+        delete_invoice(self.db, row_id, dedup_index=self.dedup_index, before=row)
+        return True
+
+    def query(self, **kwargs):
+        return query_rows(self.db, **kwargs)
+
+    def iter_pages(self, archived=None, assigned_to=None, starred=None, billing_date_from=None,
+                   billing_date_to=None, fields=None, by_billing_date=True, page_size=SCAN_PAGE_SIZE):
+        if fields and by_billing_date and 'billing_date_iso' not in fields:
+            # The cursor snapshot needs the ordered field
+            fields = list(fields) + ['billing_date_iso']
+        query = build_query(self.db, archived, assigned_to, starred, billing_date_from, billing_date_to, fields)
+        if by_billing_date:
+            query = query.order_by('billing_date_iso')
+        query = query.order_by('__name__')
+        if page_size is None:
+            yield [dict(doc.to_dict(), id=doc.id) for doc in query.stream()]
+            return
+        query = query.limit(page_size)
+        last = None
+        while True:
+            # Each page continues after the last document of the previous one
+            docs = list((query.start_after(last) if last is not None else query).stream())
+            if docs:
+                yield [dict(doc.to_dict(), id=doc.id) for doc in docs]
+            if len(docs) < page_size:
+                return
+            last = docs[-1]
+
+    def existing_keys(self, keys):
+        return self.dedup_index.existing(keys)
+
+    def apply_bulk(self, items):
+        return apply_bulk(self.db, items, dedup_index=self.dedup_index)
+
+    def current_version(self):
+        return current_version(self.db)
+
+    def changes_since(self, since, limit=DEFAULT_CHANGES_LIMIT):
+        return changes_since(self.db, since, limit)
+
+    def summary(self):
+        return read_summary(self.db)
+
+
+# Columns next to the JSON row: what /api/rows filters on, the dedup key and the summary amount
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS invoices (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    nr_key TEXT NOT NULL,
+    betrag TEXT NOT NULL,
+    archived INTEGER NOT NULL,
+    assigned_to TEXT NOT NULL,
+    starred INTEGER NOT NULL,
+    billing_date_iso TEXT NOT NULL,
+    cents INTEGER NOT NULL,
+    change_version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invoices_dedup ON invoices (nr_key, betrag);
+-- Also covers summary(), which then never reads the rows themselves
+CREATE INDEX IF NOT EXISTS invoices_archived ON invoices (archived, billing_date_iso, assigned_to, cents);
+CREATE INDEX IF NOT EXISTS invoices_assigned_to ON invoices (assigned_to, billing_date_iso);
+CREATE INDEX IF NOT EXISTS invoices_billing_date ON invoices (billing_date_iso);
+CREATE INDEX IF NOT EXISTS invoices_change_version ON invoices (change_version);
+CREATE TABLE IF NOT EXISTS tombstones (
+    id TEXT PRIMARY KEY,
+    change_version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tombstones_change_version ON tombstones (change_version);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+SQLITE_COLUMNS = ('id', 'data', 'nr_key', 'betrag', 'archived', 'assigned_to', 'starred', 'billing_date_iso',
+                  'cents', 'change_version')
+SQLITE_INSERT = f"INSERT INTO invoices ({', '.join(SQLITE_COLUMNS)}) VALUES ({', '.join('?' * len(SQLITE_COLUMNS))})"
+SQLITE_REPLACE = SQLITE_INSERT.replace('INSERT', 'INSERT OR REPLACE', 1)
+# Fields with a column of their own; other order_by fields are read from the JSON
+SQLITE_ORDER_COLUMNS = ('billing_date_iso', 'assigned_to')
+
+
+def _placeholders(values) -> str:
+    return ', '.join('?' * len(values))
+
+
+def _order_key(order_by: str) -> str:
+    if order_by not in ORDER_FIELDS:
+        raise ValueError(f"order_by must be one of {', '.join(ORDER_FIELDS)}")
+    if order_by in SQLITE_ORDER_COLUMNS:
+        return order_by
+    # Rows without the field sort first, like an empty string
+    return f"IFNULL(json_extract(data, '$.\"{order_by}\"'), '')"
+
+
+def _where(archived=None, assigned_to=None, starred=None, billing_date_from=None,
+           billing_date_to=None) -> Tuple[List[str], List]:
+    clauses, params = [], []
+    if archived is not None:
+        clauses.append('archived = ?')
+        params.append(int(archived))
+    if assigned_to:
+        clauses.append(f'assigned_to IN ({_placeholders(assigned_to)})')
+        params.extend(assigned_to)
+    if starred is not None:
+        clauses.append('starred = ?')
+        params.append(int(starred))
+    if billing_date_from:
+        clauses.append('billing_date_iso >= ?')
+        params.append(billing_date_from)
+    if billing_date_to:
+        clauses.append('billing_date_iso <= ?')
+        params.append(billing_date_to)
+    return clauses, params
+
+
+def _where_sql(clauses: List[str]) -> str:
+    return ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+
+
+def _record(row_id: str, row: Dict, version: int) -> Tuple:
+    # One invoices row for SQLITE_INSERT / SQLITE_REPLACE; row is stamped like change_log.stamp
+    data = {k: v for k, v in row.items() if k != 'id'}
+    data['updated_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    data['change_version'] = version
+    nr, betrag = dedup_key(data)
+    return (row_id, json.dumps(data, ensure_ascii=False), nr, betrag or '', int(bool(data.get('archived'))),
+            data.get('assigned_to') or '', int(bool(data.get('starred'))), data.get('billing_date_iso') or '',
+            row_cents(data), version)
+
+
+def _row(record) -> Dict:
+    row = json.loads(record['data'])
+    row['id'] = record['id']
+    return row
+
+
+def _project(row: Dict, fields: Optional[List[str]]) -> Dict:
+    # Like a Firestore select(): only the requested fields the row has, plus its id
+    if not fields:
+        return row
+    projected = {field: row[field] for field in fields if field in row}
+    projected['id'] = row['id']
+    return projected
+
+
+class SqliteStorage(InvoiceStorage):
+    """Invoices in one local SQLite file, for development, tests and benchmarks without credentials.
+
+    Each row is stored as JSON next to indexed columns for the dedup key
+    (normalized Ihre Rechnungs-Nr., Betrag), archived and assigned_to. Writes
+    take the next change version in the same transaction, like
+    change_log.versioned_write. WAL mode lets the gunicorn workers of one host
+    share the file.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SQLITE_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _version(conn) -> int:
+        record = conn.execute("SELECT value FROM meta WHERE key = 'change_version'").fetchone()
+        return record['value'] if record else 0
+
+    @contextmanager
+    def _versioned(self):
+        # Yields (conn, version); the counter is bumped in the same transaction as the writes
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = self._version(conn) + 1
+                yield conn, version
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('change_version', ?)", (version,))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    @contextmanager
+    def _snapshot(self):
+        # Several reads that see the same committed state
+        with self._connect() as conn:
+            conn.execute('BEGIN')
+            try:
+                yield conn
+            finally:
+                conn.execute('COMMIT')
+
+    def add_rows(self, rows):
+        if not rows:
+            return [], []
+        started = time.perf_counter()
+        for row in rows:
+            row['id'] = uuid.uuid4().hex
+        try:
+            # One transaction for the whole batch
+            with self._versioned() as (conn, version):
+                conn.executemany(SQLITE_INSERT, [_record(row['id'], row, version) for row in rows])
+        except sqlite3.Error as e:
+            for row in rows:
+                row.pop('id', None)
+            return [], [{'row': row, 'error': str(e)} for row in rows]
+        for row in rows:
+            row['change_version'] = version
+        # Same stage name as the Firestore writer, so both backends show up on one dashboard
+        observe_stage('firestore_write', time.perf_counter() - started, len(rows))
+        return rows, []
+
+    def get(self, row_id):
+        with self._connect() as conn:
+            record = conn.execute('SELECT id, data FROM invoices WHERE id = ?', (row_id,)).fetchone()
+        return _row(record) if record else None
+
+    def update(self, row_id, data, before=None):
+        # The dedup columns are recomputed from the merged row, so before is not needed here
+        with self._versioned() as (conn, version):
+            record = conn.execute('SELECT id, data FROM invoices WHERE id = ?', (row_id,)).fetchone()
+            if record is None:
+                raise KeyError(f'No invoice {row_id}')
+            row = _row(record)
+            row.update(data)
+            conn.execute(SQLITE_REPLACE, _record(row_id, row, version))
+        return version
+
+    def delete(self, row_id):
+        with self._versioned() as (conn, version):
+            deleted = conn.execute('DELETE FROM invoices WHERE id = ?', (row_id,)).rowcount
+            if deleted:
+                conn.execute('INSERT OR REPLACE INTO tombstones (id, change_version) VALUES (?, ?)',
+                             (row_id, version))
+        return bool(deleted)
+
+    def query(self, archived=None, assigned_to=None, starred=None, billing_date_from=None, billing_date_to=None,
+              order_by='billing_date_iso', direction='desc', fields=None, page_size=DEFAULT_PAGE_SIZE,
+              page_token=None):
+        # Same limits as the Firestore query, so a request is valid on either backend
+        if assigned_to and len(assigned_to) > MAX_IN_VALUES:
+            raise ValueError(f'at most {MAX_IN_VALUES} assigned_to values per request')
+        key = _order_key(order_by)
+        sort = 'DESC' if direction == 'desc' else 'ASC'
+        clauses, params = _where(archived, assigned_to, starred, billing_date_from, billing_date_to)
+        with self._snapshot() as conn:
+            if page_token:
+                cursor_id = decode_page_token(page_token)
+                cursor = conn.execute(f'SELECT {key} AS k FROM invoices WHERE id = ?', (cursor_id,)).fetchone()
+                if cursor is None:
+                    raise ValueError('page_token refers to a deleted row; restart from the first page')
+                clauses.append(f"({key}, id) {'<' if sort == 'DESC' else '>'} (?, ?)")
+                params += [cursor['k'], cursor_id]
+            # One extra row tells us whether there is a next page
+            records = conn.execute(
+                f'SELECT id, data FROM invoices {_where_sql(clauses)} ORDER BY {key} {sort}, id {sort} LIMIT ?',
+                params + [page_size + 1]
+            ).fetchall()
+        rows = [_project(_row(record), fields) for record in records[:page_size]]
+        next_page_token = encode_page_token(records[page_size - 1]['id']) if len(records) > page_size else None
+        return rows, next_page_token
+
+    def iter_pages(self, archived=None, assigned_to=None, starred=None, billing_date_from=None,
+                   billing_date_to=None, fields=None, by_billing_date=True, page_size=SCAN_PAGE_SIZE):
+        keys = ('billing_date_iso', 'id') if by_billing_date else ('id',)
+        clauses, params = _where(archived, assigned_to, starred, billing_date_from, billing_date_to)
+        order = ', '.join(keys)
+        last = None
+        while True:
+            page_clauses, page_params = list(clauses), list(params)
+            if last is not None:
+                # Each page continues after the last row of the previous one
+                page_clauses.append(f"({order}) > ({_placeholders(keys)})")
+                page_params += last
+            sql = f'SELECT id, data, billing_date_iso FROM invoices {_where_sql(page_clauses)} ORDER BY {order}'
+            if page_size is not None:
+                sql += f' LIMIT {int(page_size)}'
+            with self._connect() as conn:
+                records = conn.execute(sql, page_params).fetchall()
+            if records:
+                yield [_project(_row(record), fields) for record in records]
+            if page_size is None or len(records) < page_size:
+                return
+            last = [records[-1][key] for key in keys]
+
+    def existing_keys(self, keys):
+        with timed_stage('dedup_load') as sample:
+            keys = {key for key in keys if key[0]}
+            sample['size'] = len(keys)
+            numbers = sorted({nr for nr, _ in keys})
+            found = set()
+            with self._connect() as conn:
+                for start in range(0, len(numbers), SQLITE_IN_CHUNK):
+                    chunk = numbers[start:start + SQLITE_IN_CHUNK]
+                    # Answered from the (nr_key, betrag) index alone
+                    found.update((record['nr_key'], record['betrag']) for record in conn.execute(
+                        f'SELECT DISTINCT nr_key, betrag FROM invoices WHERE nr_key IN ({_placeholders(chunk)})',
+                        chunk
+                    ))
+            return found & keys
+
+    def _read_rows(self, conn, row_ids: List[str]) -> Dict[str, Dict]:
+        rows = {}
+        for start in range(0, len(row_ids), SQLITE_IN_CHUNK):
+            chunk = row_ids[start:start + SQLITE_IN_CHUNK]
+            for record in conn.execute(f'SELECT id, data FROM invoices WHERE id IN ({_placeholders(chunk)})', chunk):
+                rows[record['id']] = json.loads(record['data'])
+        return rows
+
+    def apply_bulk(self, items):
+        # Read, plan and write in one transaction: the whole request is one change set
+        results = check_items(items)
+        try:
+            with self._versioned() as (conn, version):
+                rows = self._read_rows(conn, sorted({r['id'] for r in results if r['status'] == 'ok'}))
+                planned = plan_bulk(items, results, rows)
+                for _, kind, row_id, data, before in planned:
+                    if kind == 'update':
+                        conn.execute(SQLITE_REPLACE, _record(row_id, dict(before, **data), version))
+                        continue
+                    conn.execute('DELETE FROM invoices WHERE id = ?', (row_id,))
+                    conn.execute('INSERT OR REPLACE INTO tombstones (id, change_version) VALUES (?, ?)',
+                                 (row_id, version))
+        except sqlite3.Error as e:
+            for result in results:
+                if result['status'] == 'ok':
+                    result['status'] = 'error'
+                    result['error'] = str(e)
+            return results
+        for index, *_ in planned:
+            results[index]['change_version'] = version
+        return results
+
+    def current_version(self):
+        with self._connect() as conn:
+            return self._version(conn)
+
+    def changes_since(self, since, limit=DEFAULT_CHANGES_LIMIT):
+        with self._snapshot() as conn:
+            latest = self._version(conn)
+            rows = [_row(record) for record in conn.execute(
+                'SELECT id, data FROM invoices WHERE change_version > ? ORDER BY change_version LIMIT ?',
+                (since, limit + 1)
+            )]
+            tombstones = [dict(record) for record in conn.execute(
+                'SELECT id, change_version FROM tombstones WHERE change_version > ? ORDER BY change_version LIMIT ?',
+                (since, limit + 1)
+            )]
+        return complete_change_sets(since, latest, rows, tombstones, limit)
+
+    def summary(self):
+        # Counted on read, in one pass over the covering archived index
+        data = {'status': {}, 'open_by_billing_date': {}, 'open_by_assignee': {}}
+        with self._connect() as conn:
+            records = conn.execute(
+                'SELECT archived, billing_date_iso, assigned_to, COUNT(*) AS count, SUM(cents) AS cents'
+                ' FROM invoices GROUP BY archived, billing_date_iso, assigned_to'
+            ).fetchall()
+        for record in records:
+            buckets = [('status', 'archived')] if record['archived'] else [
+                ('status', 'active'),
+                ('open_by_billing_date', record['billing_date_iso'] or NONE_KEY),
+                ('open_by_assignee', record['assigned_to'] or NONE_KEY),
+            ]
+            for group, key in buckets:
+                totals = data[group].setdefault(key, {'count': 0, 'cents': 0})
+                totals['count'] += record['count']
+                totals['cents'] += record['cents']
+        return format_summary(data)
+
+
+def open_storage(credentials_path: str) -> InvoiceStorage:
+    """The storage STORAGE_BACKEND selects; Firebase is only initialized for 'firestore'."""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage(SQLITE_PATH)
+    if STORAGE_BACKEND != 'firestore':
+        raise ValueError(f"STORAGE_BACKEND must be 'firestore' or 'sqlite', got '{STORAGE_BACKEND}'")
+    firebase_admin.initialize_app(credentials.Certificate(credentials_path))
+    return FirestoreStorage(firestore.client())
@@ -0,0 +1,145 @@
+from typing import Dict, Iterable, Optional
+
+from firebase_admin import firestore
+
+from normalize import format_betrag, parse_betrag_cents
+
+# One document holds every total, so a dashboard costs one read; it sits next to
+# change_log's version counter
+SUMMARY_COLLECTION = 'meta'
+SUMMARY_DOC_ID = 'invoice_totals'
+# Map keys for rows without a billing date or assignee (Firestore field names cannot be empty)
+NONE_KEY = '(none)'
+# Only changes to these fields can move a row between totals
+SUMMARY_FIELDS = ('archived', 'assigned_to', 'billing_date_iso', 'betrag_cents', 'Betrag')
+REBUILD_PAGE_SIZE = 1000
+
+
+def summary_ref(db):
+    return db.collection(SUMMARY_COLLECTION).document(SUMMARY_DOC_ID)
+
+
+def row_cents(row: Dict) -> int:
+    # Rows stored before betrag_cents existed are counted from their Betrag string
+    cents = row.get('betrag_cents')
+    if isinstance(cents, int):
+        return cents
+    return parse_betrag_cents(row.get('Betrag')) or 0
+
+
+def _buckets(row: Dict):
+    # Every total a row counts towards: archived vs. active, and open rows by billing date and assignee
+    if row.get('archived'):
+        return [('status', 'archived')]
+    return [
+        ('status', 'active'),
+        ('open_by_billing_date', row.get('billing_date_iso') or NONE_KEY),
+        ('open_by_assignee', row.get('assigned_to') or NONE_KEY),
+    ]
+
+
+def _tally(removed: Iterable[Dict], added: Iterable[Dict]) -> Dict:
+    totals = {}
+    for sign, rows in ((-1, removed), (1, added)):
+        for row in rows:
+            cents = row_cents(row)
+            for bucket in _buckets(row):
+                count_cents = totals.setdefault(bucket, [0, 0])
+                count_cents[0] += sign
+                count_cents[1] += sign * cents
+    return totals
+
+
+def summary_delta(removed: Iterable[Dict] = (), added: Iterable[Dict] = ()) -> Optional[Dict]:
+    """Increments that take the totals from rows `removed` to rows `added`; None if nothing changes.
+
+    An edit is the row before as removed and the row after as added.
+    """
+    delta = {}
+    for (group, key), (count, cents) in _tally(removed, added).items():
+        if count or cents:
+            delta.setdefault(group, {})[key] = {'count': firestore.Increment(count),
+                                                'cents': firestore.Increment(cents)}
+    return delta or None
+
+
+def add_to_summary(db, writer, delta: Optional[Dict]):
+    # writer is the transaction or batch of the invoice writes, so totals move with them
+    if delta:
+        writer.set(summary_ref(db), delta, merge=True)
+
+
+def touches_summary(data: Dict) -> bool:
+    return any(field in data for field in SUMMARY_FIELDS)
+
+
+def _with_betrag(totals: Dict) -> Dict:
+    return {'count': totals.get('count', 0), 'cents': totals.get('cents', 0),
+            'Betrag': format_betrag(totals.get('cents', 0))}
+
+
+def read_summary(db) -> Dict:
+    """The current totals: {'active', 'archived', 'open_by_billing_date', 'open_by_assignee'}.
+
+    Each total is {'count', 'cents', 'Betrag'}; empty totals are left out of the maps.
+    """
+    snapshot = summary_ref(db).get()
+    return format_summary((snapshot.to_dict() if snapshot.exists else None) or {})
+
+
+def format_summary(data: Dict) -> Dict:
+    # The stored totals document (or the same shape computed elsewhere) as read_summary() returns it
+    status = data.get('status', {})
+    summary = {
+        'active': _with_betrag(status.get('active', {})),
+        'archived': _with_betrag(status.get('archived', {})),
+    }
+    for group in ('open_by_billing_date', 'open_by_assignee'):
+        summary[group] = {key: _with_betrag(totals) for key, totals in sorted(data.get(group, {}).items())
+                          if totals.get('count')}
+    summary['rebuilt_at'] = data.get('rebuilt_at')
+    return summary
+
+
+def rebuild_summary(db, page_size=REBUILD_PAGE_SIZE) -> Dict:
+    """Recount every total from the invoices collection and overwrite the summary document.
+
+    Reconciles drift (e.g. rows written before the totals existed). Writes
+    that land while the collection is being read may be missed, so run it
+    when uploads are quiet. Returns the new totals as stored.
+    """
+    totals = {}
+    last = None
+    while True:
+        query = (db.collection('invoices')
+                 .select(list(SUMMARY_FIELDS))
+                 .order_by('__name__')
+                 .limit(page_size))
+        if last is not None:
+            query = query.start_after(last)
+        docs = list(query.stream())
+        for bucket, (count, cents) in _tally((), (doc.to_dict() for doc in docs)).items():
+            count_cents = totals.setdefault(bucket, [0, 0])
+            count_cents[0] += count
+            count_cents[1] += cents
+        if len(docs) < page_size:
+            break
+        last = docs[-1]
+    data = {'status': {}, 'open_by_billing_date': {}, 'open_by_assignee': {}}
+    for (group, key), (count, cents) in totals.items():
+        data[group][key] = {'count': count, 'cents': cents}
+    summary_ref(db).set(dict(data, rebuilt_at=firestore.SERVER_TIMESTAMP))
+    return data
+
+
+if __name__ == '__main__':
+    # python summary_totals.py [path/to/service-account.json]
+    import sys
+
+    import firebase_admin
+    from firebase_admin import credentials
+
+    cred_path = sys.argv[1] if len(sys.argv) > 1 else '/etc/secrets/fire-base.json'
+    firebase_admin.initialize_app(credentials.Certificate(cred_path))
+    rebuilt = rebuild_summary(firestore.client())
+    print(f"Rebuilt totals: {sum(t['count'] for t in rebuilt['status'].values())} rows")
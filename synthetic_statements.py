@@ -0,0 +1,180 @@
+import random
+import sys
+from typing import Dict, List, Tuple
+
+# Column headers as they appear at the top of the Ab-/Zusetzungen table (and again after page breaks),
+# one cell per column: Name / Rechnungsempfänger, Rechnungs-Nr. DZR, Ihre Rechnungs-Nr., Betrag
+HEADER_CELLS = [
+    ("Name des Patienten/", "Rechnungs-Nr.", "Ihre Rechnungs-Nr.", "Betrag"),
+    ("Rechnungsempfängers", "DZR", "", ""),
+]
+# Left edge of each column in points, for PDFs laid out as a table
+COLUMN_X = (30, 250, 330, 470)
+
+_FIRST_NAMES = ['Lisa', 'Emine', 'Jonas', 'Marta', 'Karl', 'Aylin', 'Peter', 'Sofia', 'Lukas', 'Hanna']
+_LAST_NAMES = ['Sibbing', 'Sarihan', 'Becker', 'Nowak', 'Schulz', 'Yilmaz', 'Wagner', 'Rossi', 'Meier', 'Klein']
+_FEE_CODES = ['GOZ', 'EA', 'BEMA', 'KFO']
+_NOTES = [
+    'Telefonisch: Direktzahlung vom 19.02.2024',
+    'Telefonat - Hakam El Daghma',
+    'Rückbuchung Lastschrift',
+    'Zahlung durch Versicherung',
+    'Ratenzahlung vereinbart',
+]
+
+
+def _amount(cents: int) -> str:
+    # -12345 -> '-123,45', -123456 -> '-1.234,56'
+    sign = '-' if cents < 0 else ''
+    euros, rest = divmod(abs(cents), 100)
+    return f"{sign}{euros:,}".replace(',', '.') + f",{rest:02d}"
+
+
+def _line(cells: Tuple[str, ...]) -> str:
+    # A table line as text extraction flattens it
+    return ' '.join(cell for cell in cells if cell)
+
+
+def synthetic_cells(rows: int, continuation_lines=1, malformed_every=0, seed=0) -> Tuple[List[Tuple[str, ...]], List[Dict]]:
+    """Lines (one cell per column) of an Ab-/Zusetzungen table and the rows the parser should find in them.
+
+    Every row gets a unique Ihre Rechnungs-Nr. so uploads never hit the
+    duplicate check. With malformed_every=n, every n-th entry has "()" as
+    its Rechnungs-Nr. and must be skipped.
+    """
+    rng = random.Random(seed)
+    lines = []
+    expected = []
+    for i in range(rows):
+        name = f"{rng.choice(_FIRST_NAMES)} {rng.choice(_LAST_NAMES)}"
+        ihre_nr = f"{seed * 1000000 + i + 1} ({rng.choice(_FEE_CODES)})"
+        betrag = _amount(-rng.randint(100, 500000))
+        notes = [rng.choice(_NOTES) for _ in range(continuation_lines)]
+        if malformed_every and (i + 1) % malformed_every == 0:
+            lines.append((name, "()", ihre_nr, betrag))
+        else:
+            nr = f"{rng.randint(100000, 999999)}/{rng.randint(1, 12):02d}/{rng.randint(2022, 2025)}"
+            lines.append((name, nr, ihre_nr, betrag))
+            expected.append({
+                'Name': name,
+                'Rechnungs-Nr. DZR': nr,
+                'Ihre Rechnungs-Nr.': ihre_nr,
+                'Betrag': betrag,
+                'Rechnungsempfängers': ' '.join(notes),
+            })
+        lines.extend((note, "", "", "") for note in notes)
+    return lines, expected
+
+
+def synthetic_entries(rows: int, continuation_lines=1, malformed_every=0, seed=0) -> Tuple[List[str], List[Dict]]:
+    # Same as synthetic_cells, with every line flattened to text
+    cells, expected = synthetic_cells(rows, continuation_lines, malformed_every, seed)
+    return [_line(line) for line in cells], expected
+
+
+def synthetic_block(rows: int, continuation_lines=1, malformed_every=0, seed=0) -> str:
+    # The block as find_relevant_block returns it: table lines only, headers stripped
+    lines, _ = synthetic_entries(rows, continuation_lines, malformed_every, seed)
+    return '\n'.join(lines)
+
+
+def synthetic_statement_pages(rows: int, rows_per_page=40, continuation_lines=1, malformed_every=0,
+                              repeat_headers=True, billing_date='15.03.2024', seed=0, columns=False) -> List[List]:
+    """Page lines of a DZR statement: cover page, the table split over pages, the Summe line.
+
+    With repeat_headers, the column headers are printed again at the top of
+    every continued table page, like the real statements do. With columns,
+    table lines are tuples of cells that pdf_from_pages places in columns.
+    """
+    entry_lines, expected = synthetic_cells(rows, continuation_lines, malformed_every, seed)
+    header_lines = list(HEADER_CELLS)
+    if not columns:
+        entry_lines = [_line(line) for line in entry_lines]
+        header_lines = [_line(line) for line in header_lines]
+    total = sum(-int(row['Betrag'].replace('.', '').replace(',', '').lstrip('-')) for row in expected)
+    pages = [[
+        'DZR Deutsches Zahnärztliches Rechenzentrum',
+        f'Abrechnungsdatum {billing_date}',
+        'Abrechnung Nr. 4711 Seite 1',
+        'Übersicht der Zahlungen',
+    ]]
+    per_row = 1 + continuation_lines
+    page_lines = max(1, rows_per_page) * per_row
+    for start in range(0, max(len(entry_lines), 1), page_lines):
+        page = []
+        if start == 0:
+            page.append('Ab- und Zusetzungen')
+            page.extend(header_lines)
+        elif repeat_headers:
+            page.extend(header_lines)
+        page.extend(entry_lines[start:start + page_lines])
+        pages.append(page)
+    pages[-1].append(f'Summe Ab- und Zusetzungen {_amount(total)}')
+    return pages
+
+
+def _pdf_string(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def _text_op(x: float, y: float, text: str) -> str:
+    return f"BT /F1 8 Tf {x} {y} Td ({_pdf_string(text)}) Tj ET"
+
+
+def pdf_from_pages(pages: List[List]) -> bytes:
+    """A minimal text-only PDF (Helvetica, WinAnsi), one line per entry.
+
+    A line is a string, or a tuple of cells placed at COLUMN_X.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = ' '.join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode('ascii'))
+    font_id = 3 + 2 * len(pages)
+    for i, lines in enumerate(pages):
+        objects.append((
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {4 + 2 * i} 0 R >>"
+        ).encode('ascii'))
+        parts = []
+        # Squeeze long pages so every line stays inside the page
+        spacing = min(10.0, 790.0 / max(len(lines), 1))
+        for number, line in enumerate(lines):
+            y = round(810 - spacing * number, 2)
+            if isinstance(line, tuple):
+                parts.extend(_text_op(x, y, cell) for x, cell in zip(COLUMN_X, line) if cell)
+            else:
+                parts.append(_text_op(COLUMN_X[0], y, line))
+        stream = "\n".join(parts).encode('cp1252')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode('ascii') + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('ascii')
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode('ascii')
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('ascii')
+    return out
+
+
+def synthetic_pdf(rows: int, rows_per_page=40, continuation_lines=1, malformed_every=0,
+                  repeat_headers=True, billing_date='15.03.2024', seed=0, columns=False) -> bytes:
+    pages = synthetic_statement_pages(rows, rows_per_page, continuation_lines, malformed_every,
+                                      repeat_headers, billing_date, seed, columns)
+    return pdf_from_pages(pages)
+
+
+if __name__ == '__main__':
+    # python synthetic_statements.py out.pdf [rows] [rows_per_page] [--columns]
+    args = [a for a in sys.argv[1:] if a != '--columns']
+    if not args:
+        sys.exit('usage: python synthetic_statements.py out.pdf [rows] [rows_per_page] [--columns]')
+    row_count = int(args[1]) if len(args) > 1 else 100
+    per_page = int(args[2]) if len(args) > 2 else 40
+    with open(args[0], 'wb') as f:
+        f.write(synthetic_pdf(row_count, per_page, columns='--columns' in sys.argv))
+    print(f"Wrote {sys.argv[1]} with {row_count} rows")
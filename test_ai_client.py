@@ -0,0 +1,145 @@
+import time
+
+import pytest
+import requests
+
+import ai_parser
+from ai_parser import AI_ERROR, ai_map, ask_ai, parse_block_with_ai
+from synthetic_statements import synthetic_block
+
+
+def fragment_prompt(number=1):
+    # The stub answers fragment prompts with an empty list per fragment number
+    return f"Fragment {number}:\nLisa Anne Sibbing 297426/12/2023 () -123,64"
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(ai_parser, 'AI_BACKOFF_S', 0.0)
+    monkeypatch.setattr(ai_parser, 'AI_MAX_RETRIES', 4)
+
+
+def test_rate_limited_requests_are_retried(ai_stub):
+    ai_stub.fail_every = 2
+    assert ask_ai(fragment_prompt()) == {'1': []}
+    assert ask_ai(fragment_prompt()) == {'1': []}
+    # The second call got a 429 first and was answered on its retry
+    assert ai_stub.requests == 3
+
+
+def test_retries_are_bounded(ai_stub, monkeypatch):
+    ai_stub.fail_every = 1
+    monkeypatch.setattr(ai_parser, 'AI_MAX_RETRIES', 2)
+    assert ask_ai(fragment_prompt()) == AI_ERROR
+    assert ai_stub.requests == 3
+
+
+def test_server_errors_are_retried(ai_stub, monkeypatch):
+    calls = []
+    real_post = requests.Session.post
+
+    def flaky_post(self, *args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            response = requests.Response()
+            response.status_code = 503
+            return response
+        return real_post(self, *args, **kwargs)
+
+    monkeypatch.setattr(requests.Session, 'post', flaky_post)
+    assert ask_ai(fragment_prompt()) == {'1': []}
+    assert len(calls) == 2
+
+
+def test_retry_after_wins_over_shorter_backoff(monkeypatch):
+    monkeypatch.setattr(ai_parser, 'AI_BACKOFF_S', 0.1)
+    response = requests.Response()
+    response.headers['Retry-After'] = '7'
+    assert ai_parser._retry_wait(0, response) == 7.0
+    # Backoff doubles per attempt, with jitter down to half
+    response.headers['Retry-After'] = '0'
+    assert 0.4 <= ai_parser._retry_wait(3, response) <= 0.8
+    response.headers['Retry-After'] = 'Wed, 21 Oct 2026 07:28:00 GMT'
+    assert 0.05 <= ai_parser._retry_wait(0, response) <= 0.1
+    assert 0.05 <= ai_parser._retry_wait(0, None) <= 0.1
+
+
+def test_retry_after_from_stub_is_honoured(ai_stub, monkeypatch):
+    ai_stub.fail_every = 1
+    seen = []
+    real_wait = ai_parser._retry_wait
+
+    def recording_wait(attempt, response):
+        seen.append((response.status_code, response.headers.get('Retry-After')))
+        return real_wait(attempt, response)
+
+    monkeypatch.setattr(ai_parser, '_retry_wait', recording_wait)
+    monkeypatch.setattr(ai_parser, 'AI_MAX_RETRIES', 1)
+    assert ask_ai(fragment_prompt()) == AI_ERROR
+    assert seen == [(429, '0'), (429, '0')]
+
+
+def test_request_timeout_gives_ai_error(ai_stub, monkeypatch):
+    ai_stub.latency = 0.5
+    monkeypatch.setattr(ai_parser, 'AI_REQUEST_TIMEOUT_S', 0.1)
+    monkeypatch.setattr(ai_parser, 'AI_MAX_RETRIES', 1)
+    started = time.monotonic()
+    assert ask_ai(fragment_prompt()) == AI_ERROR
+    assert time.monotonic() - started < 0.5
+    assert ai_stub.requests == 2
+
+
+def test_upload_deadline_gives_ai_error(ai_stub):
+    ai_stub.latency = 0.5
+    started = time.monotonic()
+    answers = ai_map(lambda prompt, deadline: ask_ai(prompt, deadline),
+                     [fragment_prompt(n) for n in range(1, 4)], deadline_s=0.2)
+    assert answers == [AI_ERROR] * 3
+    assert time.monotonic() - started < 0.5
+
+
+def test_deadline_in_the_past_sends_nothing(ai_stub):
+    assert ask_ai(fragment_prompt(), deadline=time.monotonic()) == AI_ERROR
+    assert ai_stub.requests == 0
+
+
+def test_ai_map_bounds_concurrency_and_keeps_order(ai_stub, monkeypatch):
+    ai_stub.latency = 0.05
+    monkeypatch.setattr(ai_parser, 'AI_CONCURRENCY', 3)
+    answers = ai_map(lambda prompt, deadline: ask_ai(prompt, deadline),
+                     [fragment_prompt(n) for n in range(1, 11)])
+    assert answers == [{str(n): []} for n in range(1, 11)]
+    assert ai_stub.requests == 10
+    assert ai_stub.max_in_flight == 3
+
+
+def test_ai_map_gives_default_for_failed_items(monkeypatch):
+    def fn(item, deadline):
+        if item == 2:
+            raise ValueError('boom')
+        return item * 10
+
+    assert ai_map(fn, [1, 2, 3], default=None) == [10, None, 30]
+
+
+def test_answers_are_cached_by_block_and_model(ai_stub, monkeypatch):
+    block = synthetic_block(5, seed=1)
+    first = parse_block_with_ai(block)
+    assert len(first) == 5
+    assert parse_block_with_ai(block) == first
+    assert ai_stub.requests == 1
+    parse_block_with_ai(synthetic_block(5, seed=2))
+    assert ai_stub.requests == 2
+    monkeypatch.setattr(ai_parser, 'AI_MODEL', 'anthropic/other-model')
+    assert parse_block_with_ai(block) == first
+    assert ai_stub.requests == 3
+
+
+def test_failed_answers_are_not_cached(ai_stub, monkeypatch):
+    ai_stub.fail_every = 1
+    monkeypatch.setattr(ai_parser, 'AI_MAX_RETRIES', 0)
+    block = synthetic_block(5, seed=1)
+    assert parse_block_with_ai(block) == AI_ERROR
+    ai_stub.fail_every = 0
+    assert len(parse_block_with_ai(block)) == 5
+    assert ai_stub.requests == 2
@@ -0,0 +1,18 @@
+from dedup_index import dedup_key
+from memory_firestore import MemoryFirestore
+from storage import FirestoreStorage
+
+ROW = {'Name': 'Muster', 'Ihre Rechnungs-Nr.': '100 (EA)', 'Betrag': '12,50', 'Billing Date': '15.03.2024'}
+
+
+def test_delete_in_one_worker_then_reupload_in_another():
+    db = MemoryFirestore()
+    # Two workers with their own dedup cache on the same database
+    first, second = FirestoreStorage(db), FirestoreStorage(db)
+    row = first.add(dict(ROW))
+    key = dedup_key(ROW)
+    assert second.existing_keys([key]) == {key}
+    assert first.delete(row['id'])
+    assert second.existing_keys([key]) == set()
+    second.add(dict(ROW))
+    assert first.existing_keys([key]) == {key}
@@ -0,0 +1,39 @@
+import csv
+import io
+
+import pytest
+
+import export_rows
+from ingest import CSV_COLUMNS
+from memory_firestore import MemoryFirestore
+from normalize import normalize_rows
+from rows_query import query_fields
+from storage import FirestoreStorage
+from synthetic_statements import synthetic_entries
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    # MemoryFirestore parses select() and order_by() paths with the SDK's own parser
+    monkeypatch.setattr(export_rows, 'EXPORT_PAGE_SIZE', 4)
+    storage = FirestoreStorage(MemoryFirestore())
+    _, expected = synthetic_entries(10, seed=3)
+    rows = [dict(entry, **{'Billing Date': '15.03.2024', 'notes': '', 'assigned_to': ''}) for entry in expected]
+    rows, errors = normalize_rows([dict(row, **query_fields(row)) for row in rows])
+    assert errors == []
+    storage.add_rows(rows)
+    return storage
+
+
+def test_unquoted_field_paths_are_rejected():
+    with pytest.raises(ValueError):
+        MemoryFirestore().collection('invoices').select(['Ihre Rechnungs-Nr.'])
+
+
+def test_csv_export_projects_every_column(storage):
+    body = b''.join(export_rows.export_chunks(storage, 'csv', {})).decode('utf-8-sig')
+    rows = list(csv.DictReader(io.StringIO(body)))
+    assert len(rows) == 10
+    assert list(rows[0]) == CSV_COLUMNS
+    for column in ('Rechnungs-Nr. DZR', 'Ihre Rechnungs-Nr.', 'Rechnungsempfängers', 'Billing Date'):
+        assert all(row[column] for row in rows)
@@ -0,0 +1,114 @@
+import time
+
+import ai_parser
+import hybrid_parser
+import ingest
+from hybrid_parser import hybrid_parse
+from memory_firestore import MemoryFirestore
+from parse_pool import parse_pdf
+from storage import FirestoreStorage
+from synthetic_statements import synthetic_pdf
+
+
+def multi_page_statement(**kwargs):
+    # Three pages, so the column headers are repeated on two continued pages
+    return parse_pdf(synthetic_pdf(100, seed=5, **kwargs), 'statement.pdf')
+
+
+def test_repeated_headers_never_reach_the_ai(ai_stub):
+    parsed = multi_page_statement()
+    assert parsed['skipped_any']
+    rows, unresolved, ai_error = hybrid_parse(parsed['block'])
+    assert len(rows) == 100
+    assert unresolved == []
+    assert not ai_error
+    assert ai_stub.requests == 0
+
+
+def test_ai_fallback_accepts_header_only_skips(ai_stub, monkeypatch):
+    monkeypatch.setattr(ingest, 'AI_FALLBACK', True)
+    parsed = multi_page_statement()
+    assert ingest.ai_fallback(parsed, time.monotonic() + 60) is None
+    rows, invalid_files, incomplete = ingest.rows_for_file(parsed)
+    assert len(rows) == 100
+    assert invalid_files == []
+    assert incomplete == []
+    assert ai_stub.requests == 0
+
+
+def test_malformed_lines_still_go_to_the_ai(ai_stub):
+    rows, unresolved, ai_error = hybrid_parse(multi_page_statement(malformed_every=25)['block'])
+    assert ai_stub.requests == 1
+    assert not ai_error
+    # The stub resolves no fragments, so only the malformed entries come back
+    assert len(rows) == 96
+    assert unresolved and all(line['reason'] not in ('header', 'separator') for line in unresolved)
+
+
+def test_ai_outage_is_reported_as_ai_error(ai_stub, monkeypatch):
+    ai_stub.fail_every = 1
+    monkeypatch.setattr(ai_parser, 'AI_MAX_RETRIES', 0)
+    monkeypatch.setattr(ingest, 'AI_FALLBACK', True)
+    parsed = multi_page_statement(malformed_every=25)
+    rows, invalid_files, incomplete = ingest.rows_for_file(parsed, ingest.ai_fallback(parsed, time.monotonic() + 60))
+    assert rows == []
+    assert invalid_files == [{'filename': 'statement.pdf', 'reason': 'ai_error'}]
+    assert incomplete == []
+
+
+def test_slow_ai_is_cut_off_by_the_upload_deadline(ai_stub, monkeypatch):
+    # Three files whose fallback calls run side by side; none answers within the deadline
+    ai_stub.latency = 1.0
+    monkeypatch.setattr(ingest, 'AI_FALLBACK', True)
+    monkeypatch.setattr(ingest, 'AI_UPLOAD_DEADLINE_S', 0.3)
+    parsed_files = [dict(multi_page_statement(malformed_every=25), filename=f'{n}.pdf') for n in range(3)]
+    started = time.monotonic()
+    *_, summary = ingest.ingest_parsed_files(FirestoreStorage(MemoryFirestore()), parsed_files)
+    assert time.monotonic() - started < 1.0
+    # The regex rows go in and every file is flagged for review
+    assert len(summary['data']) == 96
+    assert summary['invalid_files'] == [{'filename': f'{n}.pdf', 'reason': 'incomplete_entry'} for n in range(3)]
+    assert not summary['ai_error']
+
+
+BLOCK = """Lisa Anne Sibbing 297426/12/2023 130 (GOZ) -123,64
+Telefonisch: Direktzahlung vom 19.02.2024
+Emine Sarihan () 459 (EA) -179,26
+Jonas Nowak () 460 (EA) -10,00
+Telefonat
+Karl Becker 506433/03/2024 461 (BEMA) -20,50"""
+
+
+def ai_entry(name, number, betrag):
+    return {'Name': name, 'Rechnungsempfängers': 'Telefonat', 'Rechnungs-Nr. DZR': number,
+            'Ihre Rechnungs-Nr.': '459 (EA)', 'Betrag': betrag}
+
+
+def test_fragments_go_out_with_their_parsed_neighbours(ai_stub, monkeypatch):
+    prompts = []
+    monkeypatch.setattr(ai_parser, 'ask_ai', lambda prompt, deadline=None: prompts.append(prompt) or {})
+    hybrid_parse(BLOCK)
+    assert ("Fragment 1:\n"
+            "Context: Telefonisch: Direktzahlung vom 19.02.2024\n"
+            "Emine Sarihan () 459 (EA) -179,26\n"
+            "Jonas Nowak () 460 (EA) -10,00\n"
+            "Telefonat\n"
+            "Context: Karl Becker 506433/03/2024 461 (BEMA) -20,50") in prompts[0]
+
+
+def test_fragment_with_missing_entries_stays_unresolved(monkeypatch):
+    # Two main lines in the fragment, only one entry back: nothing is merged and the lines stay flagged
+    monkeypatch.setattr(hybrid_parser, 'parse_fragments_with_ai', lambda fragments, deadline, context: {
+        1: [ai_entry('Emine Sarihan', '506432/03/2024', '-179,26')]})
+    rows, unresolved, ai_error = hybrid_parse(BLOCK)
+    assert [row['Name'] for row in rows] == ['Lisa Anne Sibbing', 'Karl Becker']
+    assert [line['line'] for line in unresolved] == [3, 4, 5]
+    assert not ai_error
+
+
+def test_fragment_with_every_entry_is_resolved(monkeypatch):
+    monkeypatch.setattr(hybrid_parser, 'parse_fragments_with_ai', lambda fragments, deadline, context: {
+        1: [ai_entry('Emine Sarihan', '506432/03/2024', '-179,26'), ai_entry('Jonas Nowak', '506434/03/2024', '-10,00')]})
+    rows, unresolved, _ = hybrid_parse(BLOCK)
+    assert [row['Name'] for row in rows] == ['Lisa Anne Sibbing', 'Emine Sarihan', 'Jonas Nowak', 'Karl Becker']
+    assert unresolved == []
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+import ingest_jobs
+from ingest_jobs import IngestWorkers, JobStore
+
+
+@pytest.fixture
+def spool(monkeypatch, tmp_path):
+    monkeypatch.setattr(ingest_jobs, 'SPOOL_DIR', str(tmp_path))
+    return tmp_path
+
+
+def queued_job(store, spool, job_id='job1'):
+    os.makedirs(spool / job_id)
+    path = spool / job_id / '0.pdf'
+    path.write_bytes(b'%PDF')
+    store.create(job_id, [{'path': str(path), 'filename': 'a.pdf'}])
+
+
+def age(store, job_id, seconds):
+    # Pretend the job's last heartbeat and progress were `seconds` ago
+    with store._connect() as conn:
+        conn.execute('UPDATE jobs SET heartbeat_at = heartbeat_at - ?, updated_at = updated_at - ? WHERE id = ?',
+                     (seconds, seconds, job_id))
+
+
+def test_slow_job_with_heartbeats_is_not_requeued(spool):
+    store = JobStore(str(spool / 'jobs.sqlite3'))
+    queued_job(store, spool)
+    store.claim('owner-a')
+    age(store, 'job1', 3600)
+    store.heartbeat(['owner-a'])
+    store.requeue_stale(max_age=60)
+    assert store.get('job1')['status'] == 'running'
+    assert store.claim('owner-b') is None
+
+
+def test_job_of_a_dead_owner_is_requeued_and_taken_over(spool):
+    store = JobStore(str(spool / 'jobs.sqlite3'))
+    queued_job(store, spool)
+    first = store.claim('owner-a')
+    age(store, 'job1', 3600)
+    store.requeue_stale(max_age=60)
+    second = store.claim('owner-b')
+    assert second['id'] == 'job1'
+    # The first run may no longer record progress or finish the job
+    assert not store.add_file_result('job1', first['owner'], {'filename': 'a.pdf'})
+    assert not store.finish('job1', first['owner'], result={})
+    assert store.finish('job1', second['owner'], result={'type': 'summary'})
+    assert store.get('job1')['status'] == 'done'
+
+
+def test_run_that_lost_its_job_keeps_the_spool(spool, monkeypatch):
+    store = JobStore(str(spool / 'jobs.sqlite3'))
+    queued_job(store, spool)
+    workers = IngestWorkers(storage=None, store=store)
+    job = store.claim('owner-a')
+
+    def taken_over(storage, parsed_files, commit_each_file):
+        # Another process re-queues and claims the job while this run parses its file
+        age(store, 'job1', 3600)
+        store.requeue_stale(max_age=60)
+        store.claim('owner-b')
+        yield {'type': 'file', 'filename': 'a.pdf'}
+        yield {'type': 'summary'}
+
+    monkeypatch.setattr(ingest_jobs, 'ingest_parsed_files', taken_over)
+    workers.run_job(job)
+    assert os.path.exists(spool / 'job1' / '0.pdf')
+    assert store.get('job1')['status'] == 'running'
+    assert store.get('job1')['processed_files'] == 0
+
+
+def test_finished_run_removes_its_spool(spool, monkeypatch):
+    store = JobStore(str(spool / 'jobs.sqlite3'))
+    queued_job(store, spool)
+    workers = IngestWorkers(storage=None, store=store)
+    monkeypatch.setattr(ingest_jobs, 'ingest_parsed_files', lambda storage, parsed_files, commit_each_file: iter([
+        {'type': 'file', 'filename': 'a.pdf'}, {'type': 'summary'}]))
+    workers.run_job(store.claim('owner-a'))
+    assert not os.path.exists(spool / 'job1')
+    assert store.get('job1')['status'] == 'done'
+    assert store.get('job1')['processed_files'] == 1
@@ -48,18 +48,8 @@
 
 
 import os
-from extract_ab_block_from_pdf import extract_relevant_block_from_pdf
 from extract_entries_from_ab_block import extract_ab_und_zusetzungen
-
-def extract_billing_date(pdf_path):
-    import pdfplumber
-    import re
-    with pdfplumber.open(pdf_path) as pdf:
-        first_page_text = pdf.pages[0].extract_text()
-    match = re.search(r'Abrechnungsdatum\s+(\d{2}[.\/]\d{2}[.\/]\d{4})', first_page_text)
-    if match:
-        return match.group(1)
-    return ''
+from pdf_session import extract_pdf
 
 pdf_files = [
     "b.pdf",
@@ -75,7 +65,8 @@ for pdf_file in pdf_files:
         continue
 
     print(f"\n=== Processing: {pdf_file} ===")
-    block = extract_relevant_block_from_pdf(pdf_file)
+    extracted = extract_pdf(pdf_file)
+    block = extracted['block']
     print("\n--- Extracted Block ---")
     print(block)
     print("--- End Extracted Block ---\n")
@@ -84,7 +75,7 @@ for pdf_file in pdf_files:
         print("No valid block found in PDF!")
         continue
 
-    billing_date = extract_billing_date(pdf_file)
+    billing_date = extracted['billing_date']
     rows, skipped_any = extract_ab_und_zusetzungen(block)
 
     print("\n--- Parsed Entries ---")
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+from flask import Flask, Response, stream_with_context
+
+import profiling
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, 'PROFILE_ADMIN_TOKEN', 'secret')
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    app = Flask(__name__)
+    profiling.init_app(app)
+
+    @app.route('/api/upload', methods=['POST'])
+    def upload():
+        def events():
+            for n in range(3):
+                yield json.dumps({'n': n}) + '\n'
+        return Response(stream_with_context(events()), mimetype='application/x-ndjson')
+
+    return app.test_client()
+
+
+def test_streamed_profile_is_stored(client, tmp_path):
+    # A WSGI server closes the response once the body is sent
+    with client.post('/api/upload', headers={profiling.TOKEN_HEADER: 'secret'}) as response:
+        assert response.get_data().count(b'\n') == 3
+    profile_id = response.headers['X-Profile-Id']
+    assert (tmp_path / f'{profile_id}.prof').exists()
+    assert not profiling._profile_lock.locked()
+
+
+def test_client_gone_before_the_body_starts_releases_the_lock(client, tmp_path):
+    # The server closes the response without ever iterating it
+    response = client.post('/api/upload', headers={profiling.TOKEN_HEADER: 'secret'}, buffered=False)
+    response.close()
+    assert not profiling._profile_lock.locked()
+    assert (tmp_path / f"{response.headers['X-Profile-Id']}.json").exists()
+    # and the next request is profiled again
+    with client.post('/api/upload', headers={profiling.TOKEN_HEADER: 'secret'}) as response:
+        assert 'X-Profile-Id' in response.headers
+    assert not profiling._profile_lock.locked()
@@ -0,0 +1,61 @@
+import pytest
+
+from change_log import changes_since, current_version
+from memory_firestore import MemoryFirestore
+from rows_query import ORDER_FIELDS, backfill_query_fields, parse_rows_args, query_rows
+from summary_totals import read_summary, rebuild_summary
+
+
+@pytest.fixture
+def db():
+    db = MemoryFirestore()
+    for number, nr in enumerate(['300 (GOZ)', '100 (EA)', '200 (KFO)']):
+        db.collection('invoices').document(f'r{number}').set({
+            'Name': f'Name {number}', 'Rechnungs-Nr. DZR': f'{number + 1}00000/03/2024', 'Ihre Rechnungs-Nr.': nr,
+            'archived': False, 'starred': False, 'billing_date_iso': '2024-03-15',
+        })
+    return db
+
+
+@pytest.mark.parametrize('order_by', ['Ihre Rechnungs-Nr.', 'Rechnungs-Nr. DZR'])
+def test_order_by_spaced_and_dotted_columns(db, order_by):
+    args = parse_rows_args({'order_by': order_by, 'direction': 'asc', 'fields': f'Name,{order_by}'})
+    rows, next_page_token = query_rows(db, **args)
+    values = [row[order_by] for row in rows]
+    assert values == sorted(values)
+    assert next_page_token is None
+    assert set(rows[0]) == {'id', 'Name', order_by}
+
+
+def test_pages_continue_after_a_spaced_order_column(db):
+    args = parse_rows_args({'order_by': 'Ihre Rechnungs-Nr.', 'direction': 'desc', 'page_size': '2'})
+    first, token = query_rows(db, **args)
+    rest, token = query_rows(db, **dict(args, page_token=token))
+    assert [row['Ihre Rechnungs-Nr.'] for row in first + rest] == ['300 (GOZ)', '200 (KFO)', '100 (EA)']
+    assert token is None
+
+
+def test_every_order_field_is_accepted(db):
+    for order_by in ORDER_FIELDS:
+        query_rows(db, **parse_rows_args({'order_by': order_by}))
+
+
+def test_backfill_is_versioned_and_keeps_the_summary():
+    db = MemoryFirestore()
+    db.collection('invoices').document('legacy').set({
+        'Name': 'Legacy', 'Betrag': '12,50', 'betrag_cents': 1250, 'Billing Date': '15.03.2024', 'starred': '',
+    })
+    db.collection('invoices').document('current').set({
+        'Name': 'Current', 'Billing Date': '01.02.2024', 'billing_date_iso': '2024-02-01',
+        'archived': False, 'starred': True,
+    })
+    rebuild_summary(db)
+    before = current_version(db)
+    assert backfill_query_fields(db, chunk_size=2) == 1
+    row = db.collection('invoices').document('legacy').get().to_dict()
+    assert (row['archived'], row['starred'], row['billing_date_iso']) == (False, False, '2024-03-15')
+    assert [r['id'] for r in changes_since(db, before)['rows']] == ['legacy']
+    summary = read_summary(db)
+    rebuild_summary(db)
+    assert dict(summary, rebuilt_at=None) == dict(read_summary(db), rebuilt_at=None)
+    assert backfill_query_fields(db) == 0
@@ -0,0 +1,39 @@
+import time
+
+from memory_firestore import MemoryFirestore
+from search_index import SearchIndex
+from storage import FirestoreStorage
+
+
+def test_index_builds_from_firestore():
+    # The build projects 'Rechnungs-Nr. DZR' and friends, which Firestore only takes quoted
+    storage = FirestoreStorage(MemoryFirestore())
+    storage.add_rows([{'Name': 'Lisa Müller', 'Rechnungsempfängers': 'Telefonat', 'Rechnungs-Nr. DZR': '297426/12/2023',
+                       'Ihre Rechnungs-Nr.': '130 (GOZ)', 'Betrag': '-123,64', 'archived': False}])
+    index = SearchIndex(storage)
+    assert index.wait_ready()
+    assert [row['Name'] for row in index.search('mueller')] == ['Lisa Müller']
+    assert [row['Name'] for row in index.search('297426/12')] == ['Lisa Müller']
+
+
+class BrokenStorage:
+    def __init__(self):
+        self.scans = 0
+
+    def current_version(self):
+        return 0
+
+    def iter_pages(self, **kwargs):
+        self.scans += 1
+        raise ValueError('Path Ihre Rechnungs-Nr. not consumed')
+
+
+def test_failed_build_is_reported_and_not_retried():
+    storage = BrokenStorage()
+    index = SearchIndex(storage)
+    started = time.monotonic()
+    assert not index.wait_ready(timeout=5)
+    assert time.monotonic() - started < 5
+    assert 'not consumed' in index.error
+    assert not index.wait_ready(timeout=0.1)
+    assert storage.scans == 1
@@ -0,0 +1,52 @@
+import pytest
+
+import extract_ab_block_from_pdf
+from extract_ab_block_from_pdf import extract_relevant_block_from_pdf
+from pdf_session import PdfSession
+from synthetic_statements import pdf_from_pages, synthetic_block, synthetic_statement_pages
+
+
+def two_section_pdf():
+    # A statement whose Ab-/Zusetzungen table appears twice, e.g. for two practices
+    first = synthetic_statement_pages(30, seed=1)
+    second = synthetic_statement_pages(20, seed=2)
+    return pdf_from_pages(first + second[1:])
+
+
+@pytest.fixture
+def all_sections(monkeypatch):
+    monkeypatch.setattr(extract_ab_block_from_pdf, 'PDF_ALL_SECTIONS', True)
+
+
+def test_reading_stops_after_the_summe_page():
+    # Cover page, two table pages (the second closes the section), then five pages nobody needs
+    pages = synthetic_statement_pages(60, rows_per_page=40, repeat_headers=False, seed=4)
+    pages += [[f'Anlage Seite {n}', 'Kontoauszug'] for n in range(5)]
+    with PdfSession(pdf_from_pages(pages)) as session:
+        assert session.relevant_block() == synthetic_block(60, seed=4)
+        assert session.page_metadata()['page_count'] == 8
+        assert session.page_metadata()['pages_read'] == 3
+
+
+def test_only_the_first_section_is_read_by_default():
+    pdf = two_section_pdf()
+    assert extract_relevant_block_from_pdf(pdf) == synthetic_block(30, seed=1)
+    with PdfSession(pdf) as session:
+        assert len(session.sections()) == 1
+        assert session.page_metadata()['pages_read'] == 2
+
+
+def test_every_section_is_read_when_asked(all_sections):
+    pdf = two_section_pdf()
+    expected = synthetic_block(30, seed=1) + '\n' + synthetic_block(20, seed=2)
+    assert extract_relevant_block_from_pdf(pdf) == expected
+    with PdfSession(pdf) as session:
+        assert session.relevant_block() == expected
+        assert len(session.sections()) == 2
+
+
+def test_raw_block_keeps_every_section_when_asked(all_sections):
+    with PdfSession(two_section_pdf()) as session:
+        raw = session.relevant_block(raw=True)
+    assert raw.count('Ab- und Zusetzungen') == 2
+    assert 'Summe Ab- und Zusetzungen' not in raw